@@ -0,0 +1,116 @@
+"""
+管理页监控：按订阅转发消息 + 滚动窗口统计。
+
+原来每条群聊 / 私聊都原样转发给 admin_room，流量越大管理页和服务器的扇出开销越大。
+现在管理端只收自己订阅的房间，其余房间按 sample_every 抽样；
+整体情况改看服务器汇总的统计 (定时推送，与消息量无关)：
+
+- 每个房间的消息速率、活跃用户数、发言最多的用户
+- 统计窗口由固定数量的时间桶组成 (默认 60 个 1 秒桶)，每条消息只加一次计数，
+  桶过期时把它的计数从合计里减掉，取统计不需要遍历窗口内的消息
+"""
+import heapq
+import threading
+import time
+
+
+class RollingCounter:
+    """最近 buckets * bucket_seconds 秒内每个 key 的计数，按桶增量维护"""
+
+    def __init__(self, buckets=60, bucket_seconds=1.0, clock=time.monotonic):
+        self.buckets = buckets
+        self.bucket_seconds = bucket_seconds
+        self.clock = clock
+        self.slots = [{} for _ in range(buckets)]
+        self.totals = {}
+        self.current = int(clock() // bucket_seconds)
+        self.started = clock()
+
+    def _advance(self):
+        now = int(self.clock() // self.bucket_seconds)
+        # 跳过的桶最多清 buckets 个，长时间没有消息时也不会逐个空转
+        for index in range(max(self.current + 1, now - self.buckets + 1), now + 1):
+            slot = self.slots[index % self.buckets]
+            for key, n in slot.items():
+                left = self.totals[key] - n
+                if left:
+                    self.totals[key] = left
+                else:
+                    del self.totals[key]
+            slot.clear()
+        self.current = max(self.current, now)
+
+    def add(self, key, n=1):
+        self._advance()
+        slot = self.slots[self.current % self.buckets]
+        slot[key] = slot.get(key, 0) + n
+        self.totals[key] = self.totals.get(key, 0) + n
+
+    def snapshot(self):
+        """{key: 窗口内计数}"""
+        self._advance()
+        return dict(self.totals)
+
+    def span(self):
+        """窗口实际覆盖的秒数 (刚启动时不满一个窗口)"""
+        return max(self.bucket_seconds, min(self.buckets * self.bucket_seconds, self.clock() - self.started))
+
+
+class AdminMonitor:
+    def __init__(self, window=60, bucket_seconds=1.0, sample_every=10, top_n=10, clock=time.monotonic):
+        buckets = max(1, int(window / bucket_seconds))
+        self.rooms = RollingCounter(buckets, bucket_seconds, clock)
+        self.talkers = RollingCounter(buckets, bucket_seconds, clock)
+        self.sample_every = sample_every
+        self.top_n = top_n
+        self.names = {}         # uid -> 最近一次的昵称 (只保留窗口内还在的)
+        self.seen = {}          # room -> 该房间累计条数，用于抽样
+        self.recorded = 0
+        self.sampled = 0
+        self.lock = threading.Lock()
+
+    def record(self, room, uid, sender=None):
+        """记一条消息，返回它是否被抽中 (发给开了抽样的管理端)"""
+        with self.lock:
+            return self._record(room, uid, sender)
+
+    def _record(self, room, uid, sender):
+        self.rooms.add(room)
+        if uid is not None:
+            self.talkers.add(str(uid))
+            if sender:
+                self.names[str(uid)] = sender
+        self.recorded += 1
+        if len(self.seen) > 10000:
+            self.seen.clear()
+        n = self.seen.get(room, 0)
+        self.seen[room] = n + 1
+        if self.sample_every and n % self.sample_every == 0:
+            self.sampled += 1
+            return True
+        return False
+
+    def snapshot(self, room_label=str):
+        """定时推给管理页的汇总；room_label 把日志房间 key 转成管理页的房间名"""
+        with self.lock:
+            span = self.rooms.span()
+            rooms = self.rooms.snapshot()
+            talkers = self.talkers.snapshot()
+            self.names = {uid: name for uid, name in self.names.items() if uid in talkers}
+            names = dict(self.names)
+        busiest = heapq.nlargest(self.top_n, rooms.items(), key=lambda kv: kv[1])
+        top = heapq.nlargest(self.top_n, talkers.items(), key=lambda kv: kv[1])
+        return {
+            'window_seconds': round(span, 1),
+            'messages': sum(rooms.values()),
+            'per_sec': round(sum(rooms.values()) / span, 2),
+            'active_rooms': len(rooms),
+            'active_users': len(talkers),
+            'rooms': [{'room': room_label(room), 'count': n, 'per_sec': round(n / span, 2)} for room, n in busiest],
+            'top_talkers': [{'uid': uid, 'sender': names.get(uid, uid), 'count': n} for uid, n in top],
+        }
+
+    def stats(self):
+        with self.lock:
+            return {'recorded': self.recorded, 'sampled': self.sampled, 'active_rooms': len(self.rooms.snapshot()),
+                    'active_users': len(self.talkers.snapshot())}
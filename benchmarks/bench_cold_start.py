@@ -0,0 +1,85 @@
+"""
+冷启动基准：从启动服务器进程到能处理 HTTP 请求的时间，按隧道模式 (CHAT_TUNNEL) 分别测量。
+
+用法:
+    python benchmarks/bench_cold_start.py [每种模式的次数]
+
+    off         只在局域网内使用
+    background  隧道在后台建立 (默认)
+    blocking    启动前同步建隧道并发布一次 (旧行为)
+
+以 0 号进程启动 (会开隧道、做后台任务)，不打开浏览器。另外在新进程里导入服务器模块，
+列出 pyngrok / requests / webbrowser 中已被导入的 (requests 由 python-engineio 的客户端模块导入，去不掉)。
+"""
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ('off', 'background', 'blocking')
+DEFERRED = ('pyngrok', 'requests', 'webbrowser')
+TIMEOUT = 60
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def time_to_ready(mode, workdir):
+    """返回 (启动到 /admin/tunnel 返回 200 的秒数, 当时的隧道状态)；超时返回 (None, None)"""
+    port = free_port()
+    env = dict(os.environ, CHAT_TUNNEL=mode, CHAT_PORT=str(port), CHAT_WORKER_ID='0', CHAT_OPEN_BROWSER='0',
+               CHAT_STORAGE_ROOT=os.path.join(workdir, 'server_storage'))
+    with open(os.path.join(workdir, f'server_{mode}.log'), 'a') as log:
+        t0 = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'server_online_new.py')],
+                                cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            while time.perf_counter() - t0 < TIMEOUT:
+                if proc.poll() is not None:
+                    raise RuntimeError(f"server exited, see {workdir}/server_{mode}.log")
+                try:
+                    with urllib.request.urlopen(f'http://127.0.0.1:{port}/admin/tunnel', timeout=1) as r:
+                        return time.perf_counter() - t0, json.load(r)['state']
+                except OSError:
+                    time.sleep(0.02)
+            return None, None
+        finally:
+            proc.terminate()
+            proc.wait(10)
+
+
+def import_check(workdir):
+    """在临时目录里导入 (导入时会建数据目录和用户库)，不在仓库里留下文件"""
+    code = ("import sys, time; sys.path.insert(0, %r); t = time.perf_counter(); import server_online_new; "
+            "print(round(time.perf_counter() - t, 3), [m for m in %r if m in sys.modules])" % (ROOT, DEFERRED))
+    env = dict(os.environ, CHAT_STORAGE_ROOT=os.path.join(workdir, 'server_storage'))
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=workdir, env=env, stderr=subprocess.DEVNULL)
+    return out.decode().strip().splitlines()[-1]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"import server_online_new: {import_check(workdir)}  (seconds, deferred modules already loaded)\n")
+        print(f"{'CHAT_TUNNEL':<12} {'median':>9} {'min':>9} {'max':>9}  tunnel state when ready")
+        for mode in MODES:
+            results = [time_to_ready(mode, workdir) for _ in range(runs)]
+            times = [t for t, _ in results if t is not None]
+            if not times:
+                print(f"{mode:<12} {'timeout':>9}")
+                continue
+            print(f"{mode:<12} {statistics.median(times):>7.2f} s {min(times):>7.2f} s {max(times):>7.2f} s"
+                  f"  {', '.join(sorted({s for _, s in results if s}))}")
+
+
+if __name__ == '__main__':
+    main()
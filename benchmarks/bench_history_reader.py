@@ -0,0 +1,84 @@
+"""
+历史读取基准：旧的整文件解析 vs history_reader 倒序块读取。
+
+用法:
+    python benchmarks/bench_history_reader.py [每天行数] [天数]
+
+在临时目录生成 global_chat 的合成日志 (默认 500k 行 x 3 天)，
+分别测量取最近 128 / 256 条以及连续向前翻 10 页的耗时。
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import history_reader  # noqa: E402
+
+
+def legacy_read_recent_logs(folder, limit=128):
+    """原 server_online_new.py 中的实现 (整文件逐行 json 解析)"""
+    files = [f for f in os.listdir(folder) if f.endswith('.log')]
+    files.sort(reverse=True)
+    messages = []
+    for filename in files:
+        day_msgs = []
+        with open(os.path.join(folder, filename), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    day_msgs.append(json.loads(line))
+                except ValueError:
+                    pass
+        messages = day_msgs + messages
+        if len(messages) >= limit:
+            return messages[-limit:]
+    return messages
+
+
+def make_logs(folder, lines_per_day, days):
+    os.makedirs(folder, exist_ok=True)
+    for d in range(days):
+        date = f"2024-01-{d + 1:02d}"
+        with open(os.path.join(folder, f"{date}.log"), 'w', encoding='utf-8') as f:
+            for i in range(lines_per_day):
+                entry = {"sender": f"user{i % 500}", "uid": f"{i % 500:06d}", "target_uid": None,
+                         "content": f"message number {i} on {date}", "type": "text",
+                         "timestamp": f"{date} {i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}"}
+                f.write(json.dumps(entry) + "\n")
+
+
+def timed(fn, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - t0) / repeat * 1000, result
+
+
+if __name__ == '__main__':
+    lines_per_day = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = os.path.join(tmp, 'global_chat')
+        print(f"Generating {days} days x {lines_per_day} lines ...")
+        make_logs(folder, lines_per_day, days)
+
+        for limit in (128, 256):
+            legacy_ms, legacy = timed(lambda: legacy_read_recent_logs(folder, limit), 3)
+            new_ms, new = timed(lambda: history_reader.read_recent_logs(folder, limit), 50)
+            assert legacy == new
+            print(f"limit={limit:<4} legacy {legacy_ms:9.1f} ms | tail-seek {new_ms:7.2f} ms | x{legacy_ms / new_ms:,.0f}")
+
+        def scroll_back(pages=10, limit=128):
+            cursor, total = None, 0
+            for _ in range(pages):
+                msgs, cursor = history_reader.read_logs_page(folder, limit, before=cursor)
+                total += len(msgs)
+            return total
+
+        ms, total = timed(scroll_back, 10)
+        print(f"10 pages x 128 via cursor: {ms:.2f} ms total ({total} messages)")
+
+        ms, msgs = timed(lambda: history_reader.read_logs_page(folder, 128, before_ts="2024-01-02 00:00:00")[0], 10)
+        print(f"128 before a day boundary (crosses files): {ms:.2f} ms, last={msgs[-1]['timestamp']}")
@@ -0,0 +1,71 @@
+"""
+日志归档基准：.log 与 .logz 的磁盘占用、压缩耗时，以及冷读 (新进程 / 缓存清空后) 翻页的耗时。
+
+用法:
+    python benchmarks/bench_log_archive.py [消息条数]
+
+在临时目录生成合成日志 (与 bench_wire_format.py 相同的中英混合数据)，复制一份压缩后
+分别从最新一页一直翻到最开始，再做 200 次按时间定位 (before_ts)。
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import history_reader  # noqa: E402
+import log_archive  # noqa: E402
+from bench_wire_format import make_logs  # noqa: E402
+
+
+def folder_bytes(folder):
+    return sum(os.path.getsize(os.path.join(folder, n)) for n in os.listdir(folder))
+
+
+def scroll_all(folder, page=128):
+    cursor, pages = None, 0
+    while True:
+        msgs, cursor = history_reader.read_logs_page(folder, page, before=cursor)
+        pages += 1
+        if not cursor:
+            return pages, msgs
+
+
+def seek_by_time(folder, stamps):
+    for ts in stamps:
+        history_reader.read_logs_page(folder, 50, before_ts=ts)
+
+
+def timed(fn):
+    log_archive._readers.clear()  # 冷读：不用已打开的归档与块缓存
+    t0 = time.perf_counter()
+    result = fn()
+    return (time.perf_counter() - t0) * 1000, result
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    with tempfile.TemporaryDirectory() as tmp:
+        plain = os.path.join(tmp, 'plain', 'global_chat')
+        packed = os.path.join(tmp, 'packed', 'global_chat')
+        print(f"Generating {n:,} messages ...")
+        make_logs(plain, n)
+        shutil.copytree(plain, packed)
+        stats = log_archive.compact_logs(os.path.dirname(packed), min_age=0, today='9999-12-31')
+        before, after = folder_bytes(plain), folder_bytes(packed)
+        print(f"{stats['files']} day files: {before:,} B -> {after:,} B (x{before / after:.1f}), "
+              f"compaction {stats['seconds']:.2f} s")
+
+        stamps = [m['timestamp'] for m in random.Random(1).sample(history_reader.read_logs_page(plain, 5000)[0], 200)]
+        for label, folder in (('.log ', plain), ('.logz', packed)):
+            scroll_ms, (pages, _) = timed(lambda: scroll_all(folder))
+            seek_ms, _ = timed(lambda: seek_by_time(folder, stamps))
+            print(f"{label}  scroll back {pages} pages {scroll_ms:8.1f} ms | 200 x before_ts {seek_ms:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
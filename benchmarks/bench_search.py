@@ -0,0 +1,69 @@
+"""
+全文检索基准：把合成日志建成索引的耗时与大小，以及检索延迟，和逐行扫描日志找关键词对比。
+
+用法:
+    python benchmarks/bench_search.py [消息条数]
+
+合成日志与 bench_wire_format.py 相同 (中英混合)；扫描对照用 history_reader 从新到旧读完整个房间。
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import history_reader  # noqa: E402
+from bench_wire_format import make_logs  # noqa: E402
+from search_index import SearchIndex  # noqa: E402
+
+QUERIES = ["吃饭", "饭", "明天再看", "latest build", "收到 好的", "不存在的词"]
+
+
+def scan(folder, needle):
+    """没有索引时的做法：逐天逐行读，找包含关键词的消息"""
+    hits = 0
+    for filename in history_reader.list_log_files(folder):
+        for _, msg in history_reader.iter_day_reverse(os.path.join(folder, filename)):
+            if needle in str(msg.get('content', '')):
+                hits += 1
+    return hits
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    with tempfile.TemporaryDirectory() as tmp:
+        logs = os.path.join(tmp, 'chat_logs')
+        print(f"Generating {n:,} messages ...")
+        make_logs(os.path.join(logs, 'global_chat'), n)
+
+        index = SearchIndex(os.path.join(tmp, 'search.db'))
+        t0 = time.perf_counter()
+        added = index.backfill(logs)
+        stats = index.stats()
+        print(f"indexed {added:,} text messages in {time.perf_counter() - t0:.2f} s, "
+              f"{stats['db_bytes'] / 1e6:.1f} MB\n")
+
+        print(f"{'query':<14} {'first page':>11} {'5 pages':>9} {'scan':>10}")
+        for q in QUERIES:
+            t0 = time.perf_counter()
+            first = index.search(q)
+            page_ms = (time.perf_counter() - t0) * 1000
+            t0 = time.perf_counter()
+            offset = 0
+            for _ in range(5):
+                offset = index.search(q, offset=offset)['next_offset']
+                if offset is None:
+                    break
+            pages_ms = (time.perf_counter() - t0) * 1000
+            t0 = time.perf_counter()
+            scan(os.path.join(logs, 'global_chat'), q.split()[0])
+            scan_ms = (time.perf_counter() - t0) * 1000
+            print(f"{q:<14} {page_ms:>8.2f} ms {pages_ms:>6.1f} ms {scan_ms:>7.0f} ms"
+                  f"   ({len(first['results'])} on first page)")
+        index.conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+重启后的重连风暴基准：N 个客户端同时带着旧 Token 静默重连。
+
+用法:
+    python benchmarks/bench_session_tokens.py [客户端数]     # 默认 5000
+
+在临时目录生成 N 个用户的 users.db，签发 N 个 Token，然后模拟服务器重启
+(重新打开 SessionTokens 与 UserRepository)，对每个 Token 做一次完整的重连检查：
+签名校验 + 吊销检查 + 取用户名 / 头像。分别测单进程 (内存索引) 和多进程共享模式
+(get_by_uid 每次查库 vs get_profile 用启动时加载的副本)。
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import shared_state  # noqa: E402
+import user_store  # noqa: E402
+from session_tokens import SessionTokens, load_secret  # noqa: E402
+
+
+def reconnect_all(tokens, sessions, lookup):
+    t0 = time.perf_counter()
+    ok = 0
+    for uid, token in tokens:
+        valid, _ = sessions.verify(uid, token)
+        if valid and lookup(uid):
+            ok += 1
+    return ok, time.perf_counter() - t0
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'users.db')
+        backend = user_store.SqliteUserBackend(db_path)
+        backend.insert_many([{'uid': f"{i:06d}", 'username': f"user{i}", 'password': 'pw', 'avatar': ''}
+                             for i in range(n)])
+        backend.close()
+        secret_path = os.path.join(tmp, 'session_secret.key')
+        revocations = os.path.join(tmp, 'session_revocations.json')
+        before = SessionTokens(load_secret(secret_path), shared_state.LocalStateStore(), revocation_path=revocations)
+        tokens = [(f"{i:06d}", before.issue(f"{i:06d}")) for i in range(n)]
+        before.revoke_token(tokens[0][1])  # 吊销列表里有一条记录
+
+        # ---- 重启 ----
+        sessions = SessionTokens(load_secret(secret_path), shared_state.LocalStateStore(), revocation_path=revocations)
+        single = user_store.open_repository('sqlite', os.path.join(tmp, 'none.csv'), db_path)
+        shared = user_store.open_repository('sqlite', os.path.join(tmp, 'none.csv'), db_path, shared=True)
+        print(f"{n:,} reconnects after restart ({n - 1:,} valid tokens)")
+        for label, lookup in (('single process   get_by_uid ', single.get_by_uid),
+                              ('shared sqlite    get_by_uid ', shared.get_by_uid),
+                              ('shared sqlite    get_profile', shared.get_profile)):
+            ok, seconds = reconnect_all(tokens, sessions, lookup)
+            print(f"{label}  {seconds * 1000:8.1f} ms  {n / seconds:10,.0f} /s  accepted {ok:,}")
+        t0 = time.perf_counter()
+        for uid, token in tokens:
+            sessions.verify(uid, token)
+        print(f"signature + revocation check only {(time.perf_counter() - t0) / n * 1e6:.2f} us per token")
+        single.close()
+        shared.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+登录吞吐量基准：旧的 users.csv 全表扫描 vs user_store 内存索引。
+
+用法:
+    python benchmarks/bench_user_store.py                 # 默认 10k / 100k / 1M
+    python benchmarks/bench_user_store.py 10000 50000     # 自定义规模
+
+每个规模会在临时目录里生成同样的 CSV 和 SQLite 数据，
+分别测量启动加载时间和随机账号登录 (用户名 + 密码校验) 的每秒次数。
+全表扫描方案在大规模下极慢，只跑少量次数估算。
+"""
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import user_store  # noqa: E402
+
+
+def make_rows(n):
+    """uid 用服务器注册时同样的分配器生成 (6 位，快用完时自动加位)"""
+    taken = set()
+    rows = []
+    for i in range(n):
+        uid = user_store.allocate_uid(taken.__contains__)
+        taken.add(uid)
+        rows.append({'uid': uid, 'username': f"user{i}", 'password': f"pw{i}", 'avatar': ''})
+    return rows
+
+
+def legacy_check_login(csv_path, login_input, password):
+    """原 server_online_new.py 中 get_all_users + check_user_login 的逻辑"""
+    with open(csv_path, mode='r', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            if (row['username'] == login_input or row['uid'] == login_input) and row['password'] == password:
+                return row
+    return None
+
+
+def bench(n, tmp):
+    rows = make_rows(n)
+    csv_path = os.path.join(tmp, f"users_{n}.csv")
+    db_path = os.path.join(tmp, f"users_{n}.db")
+    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=user_store.USER_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    t0 = time.perf_counter()
+    user_store.migrate_csv_to_sqlite(csv_path, db_path)
+    migrate_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    repo = user_store.UserRepository(user_store.SqliteUserBackend(db_path))
+    load_s = time.perf_counter() - t0
+
+    picks = [random.randrange(n) for _ in range(200000)]
+    t0 = time.perf_counter()
+    for i in picks:
+        assert repo.check_login(f"user{i}", f"pw{i}") is not None
+    indexed_rate = len(picks) / (time.perf_counter() - t0)
+    repo.close()
+
+    legacy_iters = max(3, min(200, 2_000_000 // n))
+    t0 = time.perf_counter()
+    for i in picks[:legacy_iters]:
+        assert legacy_check_login(csv_path, f"user{i}", f"pw{i}") is not None
+    legacy_rate = legacy_iters / (time.perf_counter() - t0)
+
+    print(f"{n:>9} | migrate {migrate_s:7.2f}s | load {load_s:6.2f}s | "
+          f"indexed {indexed_rate:12,.0f} logins/s | csv scan {legacy_rate:10,.1f} logins/s | "
+          f"x{indexed_rate / legacy_rate:,.0f}")
+
+
+if __name__ == '__main__':
+    sizes = [int(a) for a in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            bench(n, tmp)
@@ -0,0 +1,134 @@
+"""
+消息编码基准：json / compact / msgpack 三种编码在真实历史页上的包大小与编解码吞吐。
+
+用法:
+    python benchmarks/bench_wire_format.py [房间日志目录] [每页条数]
+
+给出目录 (例如 server_storage/chat_logs/global_chat) 时用 history_reader 从真实日志里翻页；
+不给则在临时目录生成一份中英混合、带图片的合成日志再读取。
+大小按 Socket.IO 实际发出的包计算 (含事件名，msgpack 为二进制附件)，
+另列 zlib 压缩后的大小，对应开启 permessage-deflate 的情况。
+"""
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from socketio import packet  # noqa: E402
+
+import history_reader  # noqa: E402
+import wire_format  # noqa: E402
+
+PHRASES = ["你好", "今天晚上一起吃饭吗", "收到", "好的，我马上过来", "哈哈哈哈", "ok", "see you later",
+           "这个问题我明天再看一下", "文件已经发到群里了", "Did you check the latest build?", "👍"]
+
+
+def make_logs(folder, n=20000, users=40):
+    """按服务器日志格式生成 n 条消息 (每天一个文件)"""
+    rnd = random.Random(1)
+    os.makedirs(folder, exist_ok=True)
+    t = datetime.datetime(2024, 3, 1, 9, 0, 0)
+    files = {}
+    try:
+        for i in range(n):
+            t += datetime.timedelta(seconds=rnd.randint(0, 90))
+            u = rnd.randrange(users)
+            if rnd.random() < 0.1:
+                digest = '%064x' % rnd.getrandbits(256)
+                content, msg_type = f"/uploads/media/{digest}.jpg", 'image'
+            else:
+                content, msg_type = ' '.join(rnd.choice(PHRASES) for _ in range(rnd.randint(1, 4))), 'text'
+            entry = {"sender": f"用户{u}", "uid": f"{100000 + u}", "target_uid": None,
+                     "content": content, "type": msg_type, "timestamp": t.strftime("%Y-%m-%d %H:%M:%S")}
+            day = t.strftime("%Y-%m-%d")
+            if day not in files:
+                files[day] = open(os.path.join(folder, f"{day}.log"), 'w', encoding='utf-8')
+            files[day].write(json.dumps(entry, ensure_ascii=False) + "\n")
+    finally:
+        for f in files.values():
+            f.close()
+
+
+def load_pages(folder, page_size, max_pages=50):
+    pages, cursor = [], None
+    while len(pages) < max_pages:
+        msgs, cursor = history_reader.read_logs_page(folder, page_size, before=cursor)
+        if not msgs:
+            break
+        for m in msgs:  # 与服务器 attach_media_variants 一致
+            if m.get('type') == 'image' and 'thumb' not in m:
+                m['thumb'] = f"{m['content']}?w=240"
+        pages.append({'messages': msgs, 'target_uid': 'global', 'cursor': cursor, 'before': None})
+        if not cursor:
+            break
+    return pages
+
+
+def wire_bytes(event, data, fmt):
+    """Socket.IO 对这个事件实际发出的字节 (文本帧 + 二进制附件)"""
+    encoded = packet.Packet(packet.EVENT, data=[event, wire_format.encode(event, data, fmt)]).encode()
+    parts = encoded if isinstance(encoded, list) else [encoded]
+    return [p.encode('utf-8') if isinstance(p, str) else p for p in parts]
+
+
+def roundtrip(event, data, fmt):
+    parts = wire_bytes(event, data, fmt)
+    pkt = packet.Packet(encoded_packet=parts[0].decode('utf-8'))
+    for attachment in parts[1:]:
+        pkt.add_attachment(attachment)
+    return wire_format.decode(event, pkt.data[1])
+
+
+def rate(fn, items, min_seconds=1.0):
+    """items 为历史页，返回每秒处理的消息条数"""
+    done, t0 = 0, time.perf_counter()
+    while True:
+        for item in items:
+            fn(item)
+        done += 1
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_seconds:
+            return done * sum(len(p['messages']) for p in items) / elapsed
+
+
+def main():
+    page_size = int(sys.argv[2]) if len(sys.argv) > 2 else 128
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = sys.argv[1] if len(sys.argv) > 1 else os.path.join(tmp, 'global_chat')
+        if len(sys.argv) <= 1:
+            make_logs(folder)
+        pages = load_pages(folder, page_size)
+    if not pages:
+        print(f"No messages in {folder}")
+        return
+    singles = [m for p in pages for m in p['messages']][:2000]
+    formats = wire_format.available_formats()
+    print(f"{len(pages)} pages x {page_size} msgs from {folder}\n")
+
+    print(f"{'format':<9} {'history page':>14} {'deflate':>9} {'message':>9} {'deflate':>9}"
+          f" {'encode msg/s':>14} {'round-trip/s':>14}")
+    base = None
+    for fmt in formats:
+        page_parts = [b''.join(wire_bytes('history_loaded', p, fmt)) for p in pages]
+        msg_parts = [b''.join(wire_bytes('receive_message', m, fmt)) for m in singles]
+        page_avg = sum(map(len, page_parts)) / len(page_parts)
+        page_z = sum(len(zlib.compress(p)) for p in page_parts) / len(page_parts)
+        msg_avg = sum(map(len, msg_parts)) / len(msg_parts)
+        msg_z = sum(len(zlib.compress(p)) for p in msg_parts) / len(msg_parts)
+        enc = rate(lambda p: wire_bytes('history_loaded', p, fmt), pages)
+        trip = rate(lambda p: roundtrip('history_loaded', p, fmt), pages)
+        base = base or page_avg
+        print(f"{fmt:<9} {page_avg:>9,.0f} B {page_z:>7,.0f} B {msg_avg:>7,.0f} B {msg_z:>7,.0f} B"
+              f" {enc:>14,.0f} {trip:>14,.0f}   ({page_avg / base:.0%} of json)")
+    print("\nhistory page / message 为 history_loaded 整页与单条 receive_message 的平均包大小；"
+          "round-trip/s 为服务器编码 + 客户端解码。")
+
+
+if __name__ == '__main__':
+    main()
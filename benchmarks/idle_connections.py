@@ -0,0 +1,98 @@
+"""
+空闲连接容量测试：打开 N 个原始 Engine.IO WebSocket 连接并保持，期间正常应答心跳。
+
+用法:
+    python benchmarks/idle_connections.py [连接数] [保持秒数] [host:port]
+
+客户端用 eventlet 协程 (pip install eventlet)，单进程即可打开上万连接，
+不经过 python-socketio 客户端 (那个每个连接要开好几个线程)。
+服务器需另外启动，例如:
+    CHAT_ASYNC_MODE=eventlet python server_online_new.py
+保持时间应超过服务器的 ping_interval (25 秒)，才能确认连接能撑过心跳。
+服务器的 RSS / 线程数请在保持期间用 ps -o rss,nlwp -p <pid> 查看。
+"""
+import eventlet
+
+eventlet.monkey_patch()
+
+import base64  # noqa: E402
+import os  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+from eventlet.green import socket  # noqa: E402
+
+RAMP_BATCH = 100     # 每批新建的连接数
+RAMP_PAUSE = 0.1     # 每批之间的间隔 (秒)，避免打满服务器的 listen 队列
+
+
+def ws_frame(text):
+    """客户端发出的帧必须加掩码"""
+    payload = text.encode()
+    mask = os.urandom(4)
+    return bytes([0x81, 0x80 | len(payload)]) + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+
+class Stats:
+    def __init__(self):
+        self.connected = 0
+        self.closed = 0
+        self.errors = {}
+
+    def error(self, e):
+        key = f"{type(e).__name__}: {str(e)[:60]}"
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+
+def hold_connection(host, port, stats):
+    try:
+        s = socket.create_connection((host, port), timeout=60)
+        key = base64.b64encode(os.urandom(16)).decode()
+        s.sendall((f"GET /socket.io/?EIO=4&transport=websocket HTTP/1.1\r\nHost: {host}\r\n"
+                   f"Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                   f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n").encode())
+        buf = b''
+        while b'\r\n\r\n' not in buf:
+            data = s.recv(4096)
+            if not data:
+                raise IOError('closed during handshake')
+            buf += data
+        if b' 101 ' not in buf.split(b'\r\n', 1)[0]:
+            raise IOError(buf.split(b'\r\n', 1)[0].decode(errors='replace'))
+        s.sendall(ws_frame('40'))  # Socket.IO CONNECT
+        stats.connected += 1
+        s.settimeout(None)
+        while True:
+            data = s.recv(4096)
+            if not data:
+                stats.closed += 1
+                return
+            # 服务器心跳: 文本帧 "2"，应答 "3"
+            if data[:3] == b'\x81\x012':
+                s.sendall(ws_frame('3'))
+    except Exception as e:
+        stats.error(e)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    hold = float(sys.argv[2]) if len(sys.argv) > 2 else 60
+    host, port = (sys.argv[3] if len(sys.argv) > 3 else '127.0.0.1:5005').rsplit(':', 1)
+    stats = Stats()
+    pool = eventlet.GreenPool(n + 1)
+
+    started = time.time()
+    for i in range(n):
+        pool.spawn_n(hold_connection, host, int(port), stats)
+        if i % RAMP_BATCH == 0:
+            eventlet.sleep(RAMP_PAUSE)
+    while stats.connected + sum(stats.errors.values()) < n and time.time() - started < 300:
+        eventlet.sleep(1)
+    print(f"connected={stats.connected}/{n} in {time.time() - started:.1f}s errors={stats.errors}")
+
+    eventlet.sleep(hold)
+    alive = stats.connected - stats.closed
+    print(f"after {hold:.0f}s hold: alive={alive} closed_by_server={stats.closed} errors={stats.errors}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,469 @@
+"""
+聊天服务器负载生成器 (离线、可复现)。
+
+用 python-socketio 的 AsyncClient 在一个进程里模拟大量用户 (需要 pip install aiohttp)：
+    1. 登录    request_verification_code -> submit_login_verify (首次运行自动注册)
+    2. 收发    按 --rate 发消息，群聊 / 私聊按 --private-ratio 混合
+    3. 历史    每个用户按 --history-rate 请求 request_chat_history
+    4. 重连风暴 (可选) 运行到一半时 --storm 比例的用户同时断开，再用 Token 同时重连
+
+统计端到端投递延迟 (发送到每个接收者收到，群聊每个接收者各算一次) 的 p50/p90/p99、
+吞吐量、历史请求往返延迟、登录 / 重连耗时、收到的在线状态条目数，
+以及服务器进程的 CPU 与 RSS (自带服务器或给出 --server-pid 时)。结果写成 JSON。
+
+默认在临时目录里自己启动一个服务器进程 (不开 ngrok)，这样每次运行的数据都是干净的:
+    python benchmarks/loadgen.py --users 200 --duration 30 --output results/base.json
+    python benchmarks/loadgen.py --users 5000 --rate 0.05 --async-mode eventlet
+连接已在运行的服务器:
+    python benchmarks/loadgen.py --server http://127.0.0.1:5005 --server-pid 12345
+和上一次结果对比 (p99 延迟或吞吐变差超过 --tolerance 时退出码为 1):
+    python benchmarks/loadgen.py ... --compare results/base.json
+
+注意：服务器按 IP 保存验证码，同一台机器上的虚拟用户必须逐个登录，登录阶段耗时与用户数成正比。
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import wire_format  # noqa: E402
+PASSWORD = 'loadgen-pw'
+
+
+# ==========================================
+#   统计
+# ==========================================
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = min(len(sorted_values) - 1, max(0, round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def summarize_ms(samples):
+    values = sorted(samples)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p90_ms': round(percentile(values, 90) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3),
+        'mean_ms': round(sum(values) / len(values) * 1000, 3),
+    }
+
+
+class ProcessSampler:
+    """每秒读一次 /proc/<pid> 的 CPU 时间与 RSS (Linux)；有 psutil 时用 psutil"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.samples = []  # (wall, cpu_seconds, rss_bytes)
+        try:
+            import psutil
+            self.proc = psutil.Process(pid)
+        except ImportError:
+            self.proc = None
+
+    def sample(self):
+        try:
+            if self.proc is not None:
+                t = self.proc.cpu_times()
+                cpu, rss = t.user + t.system, self.proc.memory_info().rss
+            else:
+                with open(f"/proc/{self.pid}/stat") as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                tick = os.sysconf('SC_CLK_TCK')
+                cpu = (int(fields[11]) + int(fields[12])) / tick
+                rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, IndexError, ValueError):
+            return
+        self.samples.append((time.monotonic(), cpu, rss))
+
+    async def run(self, stop):
+        while not stop.is_set():
+            self.sample()
+            await asyncio.sleep(1.0)
+
+    def summary(self):
+        if len(self.samples) < 2:
+            return None
+        (w0, c0, _), (w1, c1, _) = self.samples[0], self.samples[-1]
+        per_sec = [(b[1] - a[1]) / (b[0] - a[0]) * 100 for a, b in zip(self.samples, self.samples[1:]) if b[0] > a[0]]
+        return {
+            'cpu_avg_percent': round((c1 - c0) / (w1 - w0) * 100, 1),
+            'cpu_max_percent': round(max(per_sec), 1) if per_sec else None,
+            'rss_max_mb': round(max(s[2] for s in self.samples) / 1024 / 1024, 1),
+            'rss_end_mb': round(self.samples[-1][2] / 1024 / 1024, 1),
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.delivery = []        # 秒
+        self.history = []
+        self.login = []
+        self.reconnect = []
+        self.sent = {'group': 0, 'private': 0}
+        self.delivered = 0
+        self.history_requests = 0
+        self.errors = {}
+        self.presence_events = 0
+        self.presence_entries = 0
+        self.measuring = False
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+# ==========================================
+#   虚拟用户
+# ==========================================
+
+class VirtualUser:
+    def __init__(self, index, url, metrics, login_lock, wire='json'):
+        self.index = index
+        self.wire = wire
+        self.name = f"lg_user_{index}"
+        self.url = url
+        self.metrics = metrics
+        self.login_lock = login_lock
+        self.uid = None
+        self.token = None
+        self.pending = {}  # 事件名 -> Future
+        self.sio = None
+
+    def _new_client(self):
+        sio = socketio.AsyncClient(reconnection=False)
+        sio.on('*', self._on_event)
+        return sio
+
+    async def _on_event(self, event, data=None):
+        m = self.metrics
+        data = wire_format.decode(event, data)
+        if event == 'receive_message':
+            content = data.get('content') if isinstance(data, dict) else None
+            if isinstance(content, str) and content.startswith('lg|'):
+                sent_at = float(content.split('|', 2)[1])
+                if m.measuring:
+                    m.delivery.append(time.perf_counter() - sent_at)
+                    m.delivered += 1
+        elif event in ('presence_delta', 'presence_snapshot', 'update_user_list'):
+            m.presence_events += 1
+            if isinstance(data, dict):
+                m.presence_entries += sum(len(data.get(k, [])) for k in ('joins', 'updates', 'leaves', 'users'))
+            elif isinstance(data, list):
+                m.presence_entries += len(data)
+        fut = self.pending.pop(event, None)
+        if fut is not None and not fut.done():
+            fut.set_result(data)
+
+    def _expect(self, event):
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[event] = fut
+        return fut
+
+    async def _wait_any(self, events, timeout=30):
+        futs = {e: self._expect(e) for e in events}
+        done, _ = await asyncio.wait(futs.values(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for e, f in futs.items():
+            if f not in done:
+                self.pending.pop(e, None)
+        for e, f in futs.items():
+            if f in done:
+                return e, f.result()
+        raise asyncio.TimeoutError(f"{self.name}: none of {events}")
+
+    async def connect(self):
+        self.sio = self._new_client()
+        await self.sio.connect(self.url, transports=['websocket'], wait_timeout=30, auth={'wire': self.wire})
+
+    async def login(self):
+        """验证码登录 (按 IP 存储，必须串行)，用户不存在时先注册"""
+        started = time.perf_counter()
+        async with self.login_lock:
+            for _ in range(2):
+                wait_code = self._expect('system_send_code')
+                await self.sio.emit('request_verification_code')
+                code = (await asyncio.wait_for(wait_code, 30))['code']
+                await self.sio.emit('submit_login_verify', {'username': self.name, 'password': PASSWORD, 'code': code})
+                event, data = await self._wait_any(('verification_success', 'show_notification', 'verification_failed'))
+                if event == 'verification_success':
+                    self.uid, self.token = data['uid'], data.get('token')
+                    self.metrics.login.append(time.perf_counter() - started)
+                    return
+                if event == 'verification_failed':
+                    raise RuntimeError(f"{self.name}: login failed: {data}")
+                # show_notification: 刚注册成功，再登录一次
+        raise RuntimeError(f"{self.name}: could not register")
+
+    async def token_login(self):
+        started = time.perf_counter()
+        wait = self._expect('verification_success')
+        await self.sio.emit('submit_login_verify', {'uid': self.uid, 'token': self.token})
+        await asyncio.wait_for(wait, 30)
+        return time.perf_counter() - started
+
+    async def send(self, target_uid):
+        kind = 'group' if target_uid == 'global' else 'private'
+        self.metrics.sent[kind] += 1
+        await self.sio.emit('client_message', {
+            'content': f"lg|{time.perf_counter()!r}|{self.index}",
+            'type': 'text', 'target_uid': target_uid
+        })
+
+    async def fetch_history(self):
+        started = time.perf_counter()
+        wait = self._expect('history_loaded')
+        await self.sio.emit('request_chat_history', {'target_uid': 'global', 'limit': 128})
+        await asyncio.wait_for(wait, 30)
+        self.metrics.history.append(time.perf_counter() - started)
+        self.metrics.history_requests += 1
+
+    async def reconnect(self):
+        await self.sio.disconnect()
+        started = time.perf_counter()
+        await self.connect()
+        await self.token_login()
+        self.metrics.reconnect.append(time.perf_counter() - started)
+
+
+async def user_loop(user, users, args, metrics, deadline, rnd):
+    """按泊松过程发消息 / 请求历史"""
+    rate = args.rate + args.history_rate
+    if rate <= 0:
+        return
+    while True:
+        wait = rnd.expovariate(rate)
+        if time.monotonic() + wait >= deadline:
+            return
+        await asyncio.sleep(wait)
+        if not user.sio.connected:
+            continue
+        try:
+            if rnd.random() < args.history_rate / rate:
+                await user.fetch_history()
+            elif rnd.random() < args.private_ratio and len(users) > 1:
+                peer = users[rnd.randrange(len(users))]
+                await user.send(peer.uid if peer is not user else 'global')
+            else:
+                await user.send('global')
+        except Exception as e:
+            metrics.error(type(e).__name__)
+
+
+# ==========================================
+#   服务器进程 (自带模式)
+# ==========================================
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(async_mode, port):
+    workdir = tempfile.mkdtemp(prefix='chat_loadgen_')
+    env = dict(os.environ, CHAT_ASYNC_MODE=async_mode, CHAT_PORT=str(port), CHAT_WORKER_ID='loadgen',
+               CHAT_STORAGE_ROOT=os.path.join(workdir, 'server_storage'))
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'server_online_new.py')],
+                            cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited, see {workdir}/server.log")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc, workdir
+        except OSError:
+            time.sleep(0.3)
+    proc.terminate()
+    raise RuntimeError('server did not start listening')
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ==========================================
+#   主流程
+# ==========================================
+
+async def run(args, url, server_pid):
+    metrics = Metrics()
+    rnd = random.Random(args.seed)
+    login_lock = asyncio.Lock()
+    users = [VirtualUser(i, url, metrics, login_lock, args.wire) for i in range(args.users)]
+    phases = {}
+
+    stop_sampling = asyncio.Event()
+    sampler = ProcessSampler(server_pid) if server_pid else None
+    sampler_task = asyncio.create_task(sampler.run(stop_sampling)) if sampler else None
+
+    # --- 连接与登录 ---
+    started = time.perf_counter()
+    sem = asyncio.Semaphore(args.connect_concurrency)
+
+    async def bring_up(u):
+        async with sem:
+            try:
+                await u.connect()
+                await u.login()
+            except Exception as e:
+                metrics.error(f"login:{type(e).__name__}")
+
+    await asyncio.gather(*(bring_up(u) for u in users))
+    online = [u for u in users if u.uid]
+    phases['login_s'] = round(time.perf_counter() - started, 2)
+    print(f"[loadgen] {len(online)}/{len(users)} users logged in in {phases['login_s']}s")
+
+    # --- 稳态收发 ---
+    await asyncio.sleep(args.settle)
+    metrics.measuring = True
+    steady_started = time.perf_counter()
+    deadline = time.monotonic() + args.duration
+    loops = [asyncio.create_task(user_loop(u, online, args, metrics, deadline, random.Random(rnd.random())))
+             for u in online]
+
+    if args.storm > 0:
+        await asyncio.sleep(args.duration / 2)
+        victims = rnd.sample(online, max(1, int(len(online) * args.storm)))
+        storm_started = time.perf_counter()
+
+        async def storm(u):
+            try:
+                await u.reconnect()
+            except Exception as e:
+                metrics.error(f"reconnect:{type(e).__name__}")
+
+        await asyncio.gather(*(storm(u) for u in victims))
+        phases['storm_users'] = len(victims)
+        phases['storm_s'] = round(time.perf_counter() - storm_started, 2)
+        print(f"[loadgen] reconnect storm: {len(victims)} users back in {phases['storm_s']}s")
+
+    await asyncio.gather(*loops)
+    await asyncio.sleep(args.drain)  # 等最后一批消息送达
+    metrics.measuring = False
+    steady_s = time.perf_counter() - steady_started
+    phases['steady_s'] = round(steady_s, 2)
+
+    stop_sampling.set()
+    if sampler_task:
+        await sampler_task
+    await asyncio.gather(*(u.sio.disconnect() for u in users if u.sio and u.sio.connected),
+                         return_exceptions=True)
+
+    sent = sum(metrics.sent.values())
+    return {
+        'phases': phases,
+        'users_online': len(online),
+        'messages_sent': metrics.sent,
+        'deliveries': metrics.delivered,
+        'send_throughput_per_s': round(sent / steady_s, 1),
+        'delivery_throughput_per_s': round(metrics.delivered / steady_s, 1),
+        'delivery_latency': summarize_ms(metrics.delivery),
+        'history_latency': summarize_ms(metrics.history),
+        'login_latency': summarize_ms(metrics.login),
+        'reconnect_latency': summarize_ms(metrics.reconnect),
+        'presence': {'events': metrics.presence_events, 'entries': metrics.presence_entries},
+        'server_process': sampler.summary() if sampler else None,
+        'errors': metrics.errors,
+    }
+
+
+def compare(current, baseline, tolerance):
+    """返回退化项列表：p99 延迟变大或吞吐变小超过 tolerance (比例)"""
+    regressions = []
+    checks = [('delivery_latency', 'p99_ms', 1), ('history_latency', 'p99_ms', 1),
+              ('delivery_throughput_per_s', None, -1)]
+    for key, sub, direction in checks:
+        old = baseline['results'].get(key)
+        new = current['results'].get(key)
+        if sub:
+            old, new = (old or {}).get(sub), (new or {}).get(sub)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        label = f"{key}.{sub}" if sub else key
+        print(f"[compare] {label}: {old} -> {new} ({change:+.1%})")
+        if change * direction > tolerance:
+            regressions.append(label)
+    return regressions
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument('--server', help='已在运行的服务器地址；不给则自带一个临时服务器')
+    p.add_argument('--server-pid', type=int, help='外部服务器的进程号，用于采样 CPU / RSS')
+    p.add_argument('--async-mode', default='threading', help='自带服务器的运行模式')
+    p.add_argument('--users', type=int, default=100)
+    p.add_argument('--duration', type=float, default=30, help='稳态收发时长 (秒)')
+    p.add_argument('--rate', type=float, default=0.5, help='每个用户每秒发送的消息数')
+    p.add_argument('--private-ratio', type=float, default=0.3, help='私聊消息占比')
+    p.add_argument('--history-rate', type=float, default=0.02, help='每个用户每秒请求历史的次数')
+    p.add_argument('--storm', type=float, default=0.0, help='运行到一半时同时重连的用户比例 (0~1)')
+    p.add_argument('--wire', default='json', choices=wire_format.FORMATS, help='向服务器协商的消息编码')
+    p.add_argument('--connect-concurrency', type=int, default=200)
+    p.add_argument('--settle', type=float, default=2.0, help='登录完成后等待在线状态广播平息的秒数')
+    p.add_argument('--drain', type=float, default=2.0)
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--output', help='结果 JSON 路径')
+    p.add_argument('--compare', help='与之前的结果 JSON 对比')
+    p.add_argument('--tolerance', type=float, default=0.2)
+    args = p.parse_args()
+
+    proc = None
+    url, server_pid = args.server, args.server_pid
+    if not url:
+        port = free_port()
+        proc, workdir = start_server(args.async_mode, port)
+        url, server_pid = f"http://127.0.0.1:{port}", proc.pid
+        print(f"[loadgen] started {args.async_mode} server pid={proc.pid} in {workdir}")
+    try:
+        results = asyncio.run(run(args, url, server_pid))
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+    report = {
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        'environment': {'git': git_revision(), 'python': platform.python_version(),
+                        'platform': platform.platform(), 'cpus': os.cpu_count(),
+                        'time': time.strftime('%Y-%m-%d %H:%M:%S')},
+        'results': results,
+    }
+    print(json.dumps(report['results'], indent=2))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"[loadgen] saved {args.output}")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"[loadgen] REGRESSION: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
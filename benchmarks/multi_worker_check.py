@@ -0,0 +1,141 @@
+"""
+多进程部署的端到端检查：两个服务器进程 + 共享 Redis，验证跨进程的私聊、群聊、在线状态与 Token 重连。
+
+用法:
+    python benchmarks/multi_worker_check.py [redis://host:port/db]
+
+不给 Redis 地址时用 fakeredis 在本机起一个临时的 Redis 兼容服务 (pip install fakeredis)。
+两个进程在临时目录中运行 (共用 users.db 与日志目录)，分别监听 15101 / 15102 端口。
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PORTS = (15101, 15102)
+
+
+def start_fake_redis(port=16379):
+    from fakeredis import TcpFakeServer
+    server = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"redis://127.0.0.1:{port}/0"
+
+
+def start_worker(workdir, redis_url, worker_id, port):
+    env = dict(os.environ, CHAT_MESSAGE_QUEUE=redis_url, CHAT_STATE_STORE=redis_url,
+               CHAT_WORKER_ID=str(worker_id), CHAT_PORT=str(port),
+               CHAT_STORAGE_ROOT=os.path.join(workdir, 'server_storage'))
+    log = open(os.path.join(workdir, f"worker{worker_id}.log"), 'w')
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, 'server_online_new.py')],
+                            cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+class User:
+    def __init__(self, name, port):
+        self.name = name
+        self.port = port
+        self.events = []
+        self.cond = threading.Condition()
+        self.sio = socketio.Client()
+        self.sio.on('*', self._record)
+        self.info = None
+
+    def _record(self, event, *args):
+        with self.cond:
+            self.events.append((event, args[0] if args else None))
+            self.cond.notify_all()
+
+    def wait_for(self, event, pred=lambda d: True, timeout=10):
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                for i, (name, data) in enumerate(self.events):
+                    if name == event and pred(data):
+                        del self.events[i]
+                        return data
+                left = deadline - time.time()
+                if left <= 0:
+                    raise TimeoutError(f"{self.name}: no {event} within {timeout}s")
+                self.cond.wait(left)
+
+    def connect(self):
+        self.sio.connect(f"http://127.0.0.1:{self.port}", wait_timeout=10)
+
+    def login(self, register=False):
+        for _ in range(2 if register else 1):
+            self.sio.emit('request_verification_code')
+            code = self.wait_for('system_send_code')['code']
+            self.sio.emit('submit_login_verify', {'username': self.name, 'password': 'pw', 'code': code})
+            if register:
+                register = False
+                self.wait_for('show_notification')
+        self.info = self.wait_for('verification_success')
+        self.wait_for('presence_snapshot')
+
+
+def wait_port(port, timeout=30):
+    import socket
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.3)
+    raise TimeoutError(f"port {port} not listening")
+
+
+def main():
+    redis_url = sys.argv[1] if len(sys.argv) > 1 else start_fake_redis()
+    workdir = tempfile.mkdtemp(prefix='chat_multi_')
+    workers = [start_worker(workdir, redis_url, i + 1, port) for i, port in enumerate(PORTS)]
+    ok = False
+    try:
+        for port in PORTS:
+            wait_port(port)
+        alice, bob = User('alice', PORTS[0]), User('bob', PORTS[1])
+        alice.connect()
+        alice.login(register=True)
+        bob.connect()
+        bob.login(register=True)
+
+        # 在线状态：bob 上线的 delta 要从 2 号进程传到 1 号进程上的 alice
+        alice.wait_for('presence_delta', lambda d: any(u['uid'] == bob.info['uid'] for u in d['joins']))
+        print("presence delta across workers: ok")
+
+        alice.sio.emit('client_message', {'content': 'hi bob', 'target_uid': bob.info['uid']})
+        bob.wait_for('receive_message', lambda m: m['content'] == 'hi bob')
+        print("private message across workers: ok")
+
+        bob.sio.emit('client_message', {'content': 'hello all', 'target_uid': 'global'})
+        alice.wait_for('receive_message', lambda m: m['content'] == 'hello all')
+        print("global message across workers: ok")
+
+        # 用 1 号进程发的 Token 在 2 号进程上静默重连
+        carol = User('alice', PORTS[1])
+        carol.connect()
+        carol.sio.emit('submit_login_verify', {'uid': alice.info['uid'], 'token': alice.info['token']})
+        carol.wait_for('verification_success')
+        print("token reconnect on another worker: ok")
+        for u in (alice, bob, carol):
+            u.sio.disconnect()
+        ok = True
+    finally:
+        for w in workers:
+            w.terminate()
+            w.wait()
+        if not ok:
+            for i in range(len(PORTS)):
+                print(open(os.path.join(workdir, f"worker{i + 1}.log")).read()[-2000:])
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
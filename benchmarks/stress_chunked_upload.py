@@ -0,0 +1,100 @@
+"""
+分块上传压力测试：多线程并发、乱序上传块，部分上传中途放弃后再续传。
+
+用法:
+    python benchmarks/stress_chunked_upload.py [上传数] [线程数] [每个文件 MB]
+
+直接驱动 chunked_upload.ChunkedUploadManager (临时目录)，不需要启动服务器。
+每个上传随机打乱块顺序；约 1/3 的上传在中途"断线"，之后新建一个管理器
+(模拟服务器重启) 按 missing() 补传剩余块。最后逐个比对落盘文件的 SHA-256。
+"""
+import hashlib
+import io
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chunked_upload import ChunkedUploadManager  # noqa: E402
+
+CHUNK = 256 * 1024
+
+
+def upload_chunks(manager, upload_id, data, indexes):
+    for i in indexes:
+        manager.put_chunk(upload_id, i, io.BytesIO(data[i * CHUNK:(i + 1) * CHUNK]))
+
+
+def main():
+    uploads = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    size_mb = float(sys.argv[3]) if len(sys.argv) > 3 else 4
+    limits = {'other': 1 << 40}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_dir, dest_dir = os.path.join(tmp, 'upload_tmp'), os.path.join(tmp, 'media')
+        os.makedirs(dest_dir)
+        manager = ChunkedUploadManager(tmp_dir, limits)
+
+        payloads, abandoned = {}, []
+        lock = threading.Lock()
+
+        def first_pass(n):
+            rnd = random.Random(n)
+            data = rnd.randbytes(int(size_mb * 1024 * 1024) + rnd.randint(0, CHUNK))
+            session = manager.init('other', 'application/octet-stream', len(data), CHUNK)
+            order = list(range(session.chunks))
+            rnd.shuffle(order)
+            with lock:
+                payloads[session.upload_id] = data
+            if n % 3 == 0:
+                # 只传一部分就"断线"
+                upload_chunks(manager, session.upload_id, data, order[:len(order) // 2])
+                with lock:
+                    abandoned.append(session.upload_id)
+            else:
+                upload_chunks(manager, session.upload_id, data, order)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(first_pass, range(uploads)))
+
+        # 模拟服务器重启：会话从磁盘元数据恢复，只补传缺失的块
+        manager = ChunkedUploadManager(tmp_dir, limits)
+        resumed_chunks = 0
+        for upload_id in abandoned:
+            missing = manager.get(upload_id).missing()
+            resumed_chunks += len(missing)
+
+        def resume(upload_id):
+            missing = manager.get(upload_id).missing()
+            random.shuffle(missing)
+            upload_chunks(manager, upload_id, payloads[upload_id], missing)
+
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(resume, abandoned))
+        with ThreadPoolExecutor(threads) as pool:
+            results = dict(zip(payloads, pool.map(lambda u: manager.finalize(u, dest_dir)[0], payloads)))
+        elapsed = time.perf_counter() - started
+
+        bad = 0
+        for upload_id, file_name in results.items():
+            with open(os.path.join(dest_dir, file_name), 'rb') as f:
+                if hashlib.sha256(f.read()).digest() != hashlib.sha256(payloads[upload_id]).digest():
+                    bad += 1
+        total_mb = sum(len(d) for d in payloads.values()) / 1024 / 1024
+
+        print(f"uploads={uploads} threads={threads} abandoned={len(abandoned)} resumed_chunks={resumed_chunks}")
+        print(f"total {total_mb:.1f} MB in {elapsed:.2f}s ({total_mb / elapsed:.1f} MB/s)")
+        print(f"leftover sessions={manager.stats()['active']} tmp files={len(os.listdir(tmp_dir))}")
+        print("OK" if bad == 0 else f"FAILED: {bad} corrupted files")
+        sys.exit(1 if bad else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""
+可断点续传的分块上传。
+
+协议 (见 server_online_new.py 中的 /api/upload/chunked/* 路由):
+    1. init      声明文件大小与类型，得到 upload_id 和分块大小
+    2. chunk N   上传第 N 块 (顺序任意、可并发、可重传)
+    3. status    查询已收到的字节区间，断线后只补传缺失的块
+    4. finalize  所有块到齐后转为正式文件
+
+每块直接写到预分配的临时文件的对应偏移处，内存占用只有一个读缓冲，组装阶段不用拼接。
+最终文件名与 media_store.save_stream 一样取整个文件内容的 SHA-256，同一文件无论走哪种上传
+都去重到同一个名字；finalize 时按顺序读一遍临时文件计算 (各块的摘要只记录在元数据里)。
+finalize 开始后会话进入 finalizing 状态，之后到达的块一律拒绝，保证哈希与移走的是同一份内容。
+会话元数据以 JSON 落盘，服务器重启后未完成的上传仍可继续。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+import media_store
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+SESSION_TTL = 24 * 3600
+
+
+class UploadSession:
+    def __init__(self, upload_id, kind, content_type, size, chunk_size, created=None, received=None):
+        self.upload_id = upload_id
+        self.kind = kind
+        self.content_type = content_type
+        self.size = size
+        self.chunk_size = chunk_size
+        self.created = created or time.time()
+        # 块序号 -> 该块的 SHA-256 十六进制摘要
+        self.received = received or {}
+        self.lock = threading.Lock()
+        self.writing = 0          # 正在写入的块数
+        self.finalizing = False
+
+    @property
+    def chunks(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    def chunk_length(self, index):
+        if index == self.chunks - 1:
+            return self.size - index * self.chunk_size
+        return self.chunk_size
+
+    def missing(self):
+        return [i for i in range(self.chunks) if i not in self.received]
+
+    def ranges(self):
+        """已收到的字节区间 [[start, end), ...]，相邻块合并"""
+        out = []
+        for i in sorted(self.received):
+            start = i * self.chunk_size
+            end = start + self.chunk_length(i)
+            if out and out[-1][1] == start:
+                out[-1][1] = end
+            else:
+                out.append([start, end])
+        return out
+
+    def to_dict(self):
+        return {'upload_id': self.upload_id, 'kind': self.kind, 'content_type': self.content_type,
+                'size': self.size, 'chunk_size': self.chunk_size, 'created': self.created,
+                'received': {str(k): v for k, v in self.received.items()}}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['upload_id'], d['kind'], d['content_type'], d['size'], d['chunk_size'], d['created'],
+                   {int(k): v for k, v in d['received'].items()})
+
+
+class ChunkedUploadManager:
+    def __init__(self, tmp_dir, limits):
+        """limits: 与 UPLOAD_LIMITS 相同的 {类型: 最大字节数}"""
+        self.tmp_dir = tmp_dir
+        self.limits = limits
+        os.makedirs(tmp_dir, exist_ok=True)
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self._load_sessions()
+
+    # ---------- 会话持久化 ----------
+
+    def _data_path(self, upload_id):
+        return os.path.join(self.tmp_dir, f"{upload_id}.part")
+
+    def _meta_path(self, upload_id):
+        return os.path.join(self.tmp_dir, f"{upload_id}.json")
+
+    def _save_meta(self, session):
+        tmp = self._meta_path(session.upload_id) + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(session.to_dict(), f)
+        os.replace(tmp, self._meta_path(session.upload_id))
+
+    def _load_sessions(self):
+        for name in os.listdir(self.tmp_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.tmp_dir, name), encoding='utf-8') as f:
+                    session = UploadSession.from_dict(json.load(f))
+                if os.path.exists(self._data_path(session.upload_id)):
+                    self.sessions[session.upload_id] = session
+            except (OSError, ValueError, KeyError) as e:
+                print(f"[UPLOAD] skip broken session {name}: {e}")
+
+    def _drop(self, upload_id):
+        self.sessions.pop(upload_id, None)
+        for path in (self._data_path(upload_id), self._meta_path(upload_id)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def expire(self, ttl=SESSION_TTL):
+        """清理超过 ttl 仍未完成的上传，返回清理数量"""
+        now = time.time()
+        with self.lock:
+            stale = [uid for uid, s in self.sessions.items() if now - s.created > ttl]
+            for upload_id in stale:
+                self._drop(upload_id)
+        return len(stale)
+
+    # ---------- 协议 ----------
+
+    def get(self, upload_id):
+        session = self.sessions.get(upload_id)
+        if session is None:
+            raise media_store.UploadError('Unknown upload_id', 404)
+        return session
+
+    def init(self, kind, content_type, size, chunk_size=None):
+        size = int(size)
+        limit = self.limits.get(kind, self.limits['other'])
+        if size <= 0:
+            raise media_store.UploadError('Empty file')
+        if size > limit:
+            raise media_store.UploadError(f"File too large (>{limit // 1024}KB)", 413)
+        chunk_size = min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, int(chunk_size or DEFAULT_CHUNK_SIZE)))
+
+        session = UploadSession(uuid.uuid4().hex, kind, content_type, size, chunk_size)
+        # 预分配 (稀疏) 文件，各块直接写到自己的偏移处
+        with open(self._data_path(session.upload_id), 'wb') as f:
+            f.truncate(size)
+        with self.lock:
+            self.sessions[session.upload_id] = session
+        self._save_meta(session)
+        return session
+
+    def put_chunk(self, upload_id, index, stream):
+        session = self.get(upload_id)
+        index = int(index)
+        if not 0 <= index < session.chunks:
+            raise media_store.UploadError('Chunk index out of range')
+        expected = session.chunk_length(index)
+        with session.lock:
+            if session.finalizing:
+                raise media_store.UploadError('Upload already finalized or aborted', 409)
+            session.writing += 1
+        try:
+            digest = self._write_chunk(session, index, expected, stream)
+            with session.lock:
+                session.received[index] = digest
+                self._save_meta(session)
+        finally:
+            with session.lock:
+                session.writing -= 1
+        return session
+
+    def _write_chunk(self, session, index, expected, stream):
+        digest = hashlib.sha256()
+        written = 0
+        try:
+            f = open(self._data_path(session.upload_id), 'r+b')
+        except FileNotFoundError:
+            raise media_store.UploadError('Upload already finalized or aborted', 409)
+        with f:
+            f.seek(index * session.chunk_size)
+            while True:
+                buf = stream.read(min(media_store.CHUNK_SIZE, expected - written + 1))
+                if not buf:
+                    break
+                written += len(buf)
+                if written > expected:
+                    raise media_store.UploadError(f"Chunk {index} larger than {expected} bytes")
+                digest.update(buf)
+                f.write(buf)
+        if written != expected:
+            # 不完整的块不记录，客户端重传即可覆盖
+            raise media_store.UploadError(f"Chunk {index} incomplete ({written}/{expected} bytes)")
+        return digest.hexdigest()
+
+    def _file_digest(self, upload_id):
+        digest = hashlib.sha256()
+        with open(self._data_path(upload_id), 'rb') as f:
+            while True:
+                buf = f.read(media_store.CHUNK_SIZE)
+                if not buf:
+                    break
+                digest.update(buf)
+        return digest.hexdigest()
+
+    def finalize(self, upload_id, dest_dir):
+        """所有块到齐后把临时文件移入 dest_dir，返回 (文件名, 是否命中已有文件)"""
+        session = self.get(upload_id)
+        with session.lock:
+            if session.finalizing:
+                raise media_store.UploadError('Upload is already being finalized', 409)
+            if session.writing:
+                raise media_store.UploadError('Chunks are still being uploaded', 409)
+            missing = session.missing()
+            if missing:
+                raise media_store.UploadError(f"Missing chunks: {missing[:20]}", 409)
+            session.finalizing = True
+        # 读整个文件较慢，不持有锁；finalizing 已经挡住了新的块
+        try:
+            file_name = f"{self._file_digest(upload_id)}{media_store.guess_extension(session.content_type)}"
+            deduped = media_store.commit_file(self._data_path(upload_id), dest_dir, file_name)
+        except OSError:
+            with session.lock:
+                session.finalizing = False
+            raise
+        with self.lock:
+            self.sessions.pop(upload_id, None)
+        if os.path.exists(self._meta_path(upload_id)):
+            os.remove(self._meta_path(upload_id))
+        return file_name, deduped
+
+    def abort(self, upload_id):
+        with self.lock:
+            self._drop(upload_id)
+
+    def stats(self):
+        with self.lock:
+            return {'active': len(self.sessions),
+                    'bytes_pending': sum(s.size for s in self.sessions.values())}
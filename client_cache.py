@@ -0,0 +1,140 @@
+"""
+客户端本地消息缓存 (SQLite)，每个账号一个文件：client_data/<uid>/messages.db。
+
+收到的、自己发出的消息和拉到的历史页都写进来：
+- 打开会话时直接读本地 (page)，不再每次向服务器要 128 条
+- 重新登录 / 断线重连后用 since_cursor() 生成游标，只向服务器要缺的部分
+- 本地翻到头后换成服务器的时间戳游标 ("@时间#n")，继续向服务器翻更早的
+按 (会话, 发送者, 时间, 内容) 去重，与网页的消息指纹一致，实时消息和历史页重叠不会重复。
+
+本地保存的消息须是连续的 (从本地最早一条到最新一条之间没有缺口)，
+同步中途放弃时调用 drop_older() 丢掉缺口之前的部分。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+LOCAL_CURSOR_PREFIX = 'local:'
+
+
+def _digest(conversation, msg):
+    key = '\x00'.join((conversation, str(msg.get('uid', '')), str(msg.get('timestamp', '')), str(msg.get('content', ''))))
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=12).digest()
+
+
+class LocalMessageCache:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY, conversation TEXT NOT NULL, ts TEXT NOT NULL,
+                digest BLOB NOT NULL UNIQUE, body TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS messages_conversation_ts ON messages (conversation, ts, id);
+            -- complete=1 表示本地已经有这个会话从最开始的全部消息
+            CREATE TABLE IF NOT EXISTS conversations (conversation TEXT PRIMARY KEY, complete INTEGER NOT NULL DEFAULT 0);
+        ''')
+        self.conn.commit()
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    # ---------- 写入 ----------
+
+    def add(self, conversation, messages):
+        """存入一批消息，返回其中本地原来没有的"""
+        conversation = str(conversation)
+        added = []
+        with self.lock:
+            with self.conn:
+                for msg in messages:
+                    body = {k: v for k, v in msg.items() if k != 'seq'}
+                    cur = self.conn.execute(
+                        'INSERT OR IGNORE INTO messages (conversation, ts, digest, body) VALUES (?, ?, ?, ?)',
+                        (conversation, str(msg.get('timestamp') or ''), _digest(conversation, msg),
+                         json.dumps(body, ensure_ascii=False)))
+                    if cur.rowcount:
+                        added.append(msg)
+        return added
+
+    def mark_complete(self, conversation):
+        with self.lock:
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO conversations VALUES (?, 1)', (str(conversation),))
+
+    def drop_older(self, conversation, ts):
+        """删掉早于 ts 的消息 (它们和之后的消息之间有缺口)"""
+        with self.lock:
+            with self.conn:
+                self.conn.execute('DELETE FROM messages WHERE conversation = ? AND ts < ?', (str(conversation), ts))
+                self.conn.execute('DELETE FROM conversations WHERE conversation = ?', (str(conversation),))
+
+    # ---------- 读取 ----------
+
+    def page(self, conversation, limit, before=None):
+        """
+        按时间正序返回 (messages, cursor)，before 为本函数给出的本地游标。
+        cursor 为本地游标 (本地还有更早的)、服务器游标 (本地翻完了，服务器上还有) 或 None (已到最开始)。
+        打开会话 (before 为空) 时本地不够一页且不完整，返回 None，应改向服务器请求。
+        """
+        conversation = str(conversation)
+        sql = 'SELECT id, ts, body FROM messages WHERE conversation = ?'
+        args = [conversation]
+        if before:
+            ts, _, row_id = str(before)[len(LOCAL_CURSOR_PREFIX):].rpartition('#')
+            sql += ' AND (ts < ? OR (ts = ? AND id < ?))'
+            args += [ts, ts, int(row_id)]
+        sql += ' ORDER BY ts DESC, id DESC LIMIT ?'
+        args.append(limit + 1)
+        with self.lock:
+            rows = self.conn.execute(sql, args).fetchall()
+            complete = self.conn.execute('SELECT complete FROM conversations WHERE conversation = ?',
+                                         (conversation,)).fetchone()
+        complete = bool(complete and complete[0])
+        if not before and len(rows) < limit and not complete:
+            return None
+        more = len(rows) > limit
+        rows = rows[:limit][::-1]
+        messages = [json.loads(body) for _, _, body in rows]
+        if more:
+            cursor = f"{LOCAL_CURSOR_PREFIX}{rows[0][1]}#{rows[0][0]}"
+        elif complete or not rows:
+            cursor = None
+        else:
+            # 本地最早的是那一秒里最后的几条，服务器游标 "@时间#n" 正好指向它们之前
+            oldest = rows[0][1]
+            with self.lock:
+                same = self.conn.execute('SELECT COUNT(*) FROM messages WHERE conversation = ? AND ts = ?',
+                                         (conversation, oldest)).fetchone()[0]
+            cursor = f"@{oldest}#{same}"
+        return messages, cursor
+
+    def since_cursor(self, conversation):
+        """增量同步游标 "@最新时间#这一秒已有条数"，本地没有消息时返回 None"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT ts, COUNT(*) FROM messages WHERE conversation = ? AND ts = '
+                '(SELECT MAX(ts) FROM messages WHERE conversation = ?)',
+                (str(conversation), str(conversation))).fetchone()
+        return f"@{row[0]}#{row[1]}" if row and row[0] is not None else None
+
+    def conversations(self, limit=50):
+        """按最近消息时间倒序的会话列表"""
+        with self.lock:
+            rows = self.conn.execute('SELECT conversation FROM messages GROUP BY conversation '
+                                     'ORDER BY MAX(ts) DESC LIMIT ?', (limit,)).fetchall()
+        return [r[0] for r in rows]
+
+    def stats(self):
+        with self.lock:
+            messages, conversations = self.conn.execute(
+                'SELECT COUNT(*), COUNT(DISTINCT conversation) FROM messages').fetchone()
+        return {'messages': messages, 'conversations': conversations,
+                'db_bytes': sum(os.path.getsize(p) for p in (self.path, self.path + '-wal') if os.path.exists(p))}
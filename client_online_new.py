@@ -6,10 +6,13 @@ import logging
 import time
 import requests
 import socket
-import base64
-from datetime import datetime
-from flask import Flask, render_template, request, send_from_directory, redirect, jsonify
+import queue
+from collections import deque
+from flask import Flask, render_template, request, send_from_directory, jsonify, Response
 from threading import *
+from client_store import MessageStore, conversation_key
+from client_cache import LocalMessageCache, LOCAL_CURSOR_PREFIX
+import wire_format
 
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
@@ -24,68 +27,117 @@ if not os.path.exists(CLIENT_DATA_DIR):
 JSON_BIN_URL = "https://api.npoint.io/b45083904e075c083709"
 CLIENT_PORT = 5001
 SERVER_URL = 'http://127.0.0.1:5005'
-
-
-history_sync = {
-    'event': Event(),
-    'data': []
-}
+# 与服务器协商的消息编码 (见 wire_format.py)，装了 msgpack 用二进制，否则用按位置编码的 JSON
+WIRE_FORMAT = os.environ.get('CHAT_WIRE_FORMAT') or ('msgpack' if wire_format.msgpack else 'compact')
+
+
+# 历史记录请求按 id 关联：/api/request_history 发出请求后立即返回，不占着线程等结果；
+# 服务器在 history_loaded 里带回 request_id，结果作为 SSE 的 history 事件推给网页 (按网页自己的 request_id 匹配)。
+# 同一会话、同一游标、同样条数的请求还在途时不重复发给服务器，只把网页的 request_id 挂到那一次请求上。
+HISTORY_REQUEST_TIMEOUT = 5.0  # 超过该时间没有回应的请求不再参与合并 (网页端自己也会超时)
+history_lock = Lock()
+history_inflight = {}  # (target_uid, before, limit) -> {'id': 发给服务器的 request_id, 'waiters': [网页 request_id], 'sent': 时间}
+history_keys = {}      # 发给服务器的 request_id -> 上面的 key
+history_ids = {'next': 0}
+
+# 本地消息缓存 (见 client_cache.py)，登录后按 uid 打开。打开会话先读本地；
+# 每次登录 (含断线重连) 后在后台对最近的会话做增量同步 (since 游标)，并为还没有本地记录的好友预取一页。
+HISTORY_SYNC_INTERVAL = 0.6   # 后台请求之间的间隔，不超过服务器对历史请求的限流 (2 次/秒)
+HISTORY_SYNC_MAX_PAGES = 20   # 一个会话缺的消息超过这么多页就不再往前补，丢掉本地更早的部分
+HISTORY_SYNC_CONVERSATIONS = 30
+HISTORY_SYNC_PAGE = 256
+PREFETCH_LIMIT = 128
+local_cache = {'cache': None, 'uid': None}
+sync_queue = queue.Queue()
+sync_state = {'generation': 0}
 
 app = Flask(__name__)
 sio = socketio.Client()
 
 client_state = {
-    'messages': [],
     'verified': False,
     'username': 'Guest',
     'uid': '',
     'avatar': '',
     'connection_status': 'Disconnected',
     'notification': None,
-    'online_users': []
+    'online_users': [],
+    'presence_version': 0
 }
 
 login_cache = {'username': None, 'password': None, 'token': None, 'uid': None, 'is_active': False}
 
-
-# 保存私聊记录到本地
-def save_chat_locally(data):
-    """
-    保存聊天记录到本地。
-    修改后逻辑：仅保存【自己发送】的消息。接收到的消息不保存。
-    """
-    my_uid = str(client_state.get('uid', ''))
-    if not my_uid: return
-
-    # 强制转字符串比较
-    msg_uid = str(data.get('uid', ''))           # 发送者
-    msg_target = str(data.get('target_uid', '')) # 接收者
-
-    # 核心过滤：如果发送者不是我，直接忽略，不保存
-    if msg_uid != my_uid:
-        return
-
-    # 忽略群聊
-    if not msg_target or msg_target == 'global':
-        return
-
-    # 既然发送者是我，partner_uid 必然是 target_uid
-    partner_uid = msg_target
-
-    # 构建保存路径
-    date_str = datetime.now().strftime("%Y-%m-%d")
-    log_dir = os.path.join(CLIENT_DATA_DIR, my_uid, 'chat_logs', partner_uid)
-
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-
-    log_file = os.path.join(log_dir, f"{date_str}.json")
-
+# ==========================================
+#   推送给网页的事件流 (SSE)
+# ==========================================
+# 网页不再轮询 /api/status，而是订阅 /api/events。
+# 每个事件带递增的 seq，最近 EVENT_LOG_SIZE 条保存在内存里，
+# 网页断线重连时从 Last-Event-ID 续传；断点已被丢弃则发 reset 让网页重新取快照。
+EVENT_LOG_SIZE = 2000
+event_log = deque(maxlen=EVENT_LOG_SIZE)
+event_cond = Condition()
+event_state = {'seq': 0}
+
+
+def push_event(kind, data):
+    with event_cond:
+        event_state['seq'] += 1
+        event_log.append((event_state['seq'], kind, data))
+        event_cond.notify_all()
+
+
+def push_state():
+    push_event('state', {k: client_state[k] for k in ('verified', 'username', 'uid', 'avatar', 'connection_status')})
+
+
+def push_notification(msg):
+    client_state['notification'] = msg
+    push_event('notification', {'msg': msg})
+
+
+# 每个会话最多在内存里保留 MESSAGE_CAP_PER_CONVERSATION 条 (全部消息都在本地缓存里)
+MESSAGE_CAP_PER_CONVERSATION = 300
+MAX_CONVERSATIONS_IN_MEMORY = 200
+message_store = MessageStore(MESSAGE_CAP_PER_CONVERSATION, MAX_CONVERSATIONS_IN_MEMORY)
+
+
+def open_local_cache(uid):
+    """登录成功后打开该账号的本地缓存 (client_data/<uid>/messages.db)"""
+    uid = str(uid)
+    if local_cache['uid'] == uid:
+        return local_cache['cache']
+    old = local_cache['cache']
+    local_cache['cache'] = LocalMessageCache(os.path.join(CLIENT_DATA_DIR, uid, 'messages.db'))
+    local_cache['uid'] = uid
+    legacy_logs = os.path.join(CLIENT_DATA_DIR, uid, 'chat_logs')
+    if os.path.isdir(legacy_logs):
+        print(f"[LOCAL CACHE] {legacy_logs} is no longer read or written (history lives in messages.db), "
+              f"safe to delete")
+    if old is not None:
+        old.close()
+    return local_cache['cache']
+
+
+def cache_messages(conversation, messages):
+    cache = local_cache['cache']
+    if cache is None or not messages:
+        return []
     try:
-        with open(log_file, 'a', encoding='utf-8') as f:
-            f.write(json.dumps(data, ensure_ascii=False) + "\n")
+        return cache.add(conversation, messages)
     except Exception as e:
-        print(f"[LOCAL SAVE ERROR] {e}")
+        print(f"[LOCAL CACHE ERROR] {e}")
+        return []
+
+
+def load_friends(uid):
+    friend_file = os.path.join(CLIENT_DATA_DIR, str(uid), 'friends.json')
+    if os.path.exists(friend_file):
+        try:
+            with open(friend_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except:
+            return []
+    return []
 
 
 def find_server_via_broadcast():
@@ -120,21 +172,29 @@ def find_server_logic():
     print(f"[NET] Default URL: {SERVER_URL}")
 
 
-def save_avatar_locally(b64):
+def server_base_url():
+    """SERVER_URL 可能带有 ?discovery=broadcast 之类的参数，HTTP 接口需要去掉"""
+    return SERVER_URL.split('?', 1)[0].rstrip('/')
+
+
+def upload_file_to_server(path, content_type, kind='media'):
+    """把本地文件以原始二进制请求体流式上传到 Server，返回 (url, 错误信息)"""
     try:
-        if ',' in b64:
-            _, e = b64.split(',', 1)
-        else:
-            return
-        with open(LOCAL_AVATAR_PATH, "wb") as f:
-            f.write(base64.b64decode(e))
-    except:
-        pass
+        with open(path, 'rb') as f:
+            r = requests.post(f"{server_base_url()}/api/upload/{kind}", data=f,
+                              headers={'Content-Type': content_type}, timeout=60)
+        resp = r.json()
+        if resp.get('status') == 'ok':
+            return resp['url'], None
+        return None, resp.get('msg', f'HTTP {r.status_code}')
+    except Exception as e:
+        return None, str(e)
 
 
 @sio.event
 def connect():
     client_state['connection_status'] = 'Connected'
+    push_state()
     if login_cache['is_active'] and login_cache['token']:
         print(f"[NET] Attempting silent Reconnect for UID: {login_cache['uid']}")
         sio.emit('submit_login_verify', {
@@ -145,6 +205,8 @@ def connect():
 
 @sio.event
 def verification_success(data):
+    if client_state['uid'] and client_state['uid'] != data.get('uid', ''):
+        message_store.clear()  # 换了账号，旧账号的会话不再展示
     client_state['verified'] = True
     client_state['username'] = data['username']
     client_state['uid'] = data.get('uid', '')
@@ -152,33 +214,92 @@ def verification_success(data):
     login_cache['token'] = data.get('token')
     login_cache['uid'] = data.get('uid')
     login_cache['is_active'] = True
+    open_local_cache(client_state['uid'])
+    schedule_history_sync()
+    push_state()
+
+
+@sio.event
+def disconnect():
+    client_state['connection_status'] = 'Disconnected'
+    push_state()
+
+
+# 在线列表：登录时收到一次完整快照，之后只收增量；版本号不连续就重新要快照
+@sio.event
+def presence_snapshot(data):
+    data = wire_format.decode('presence_snapshot', data)
+    client_state['online_users'] = data.get('users', [])
+    client_state['presence_version'] = data.get('version', 0)
+    push_event('users', client_state['online_users'])
 
 
 @sio.event
-def update_user_list(users):
-    client_state['online_users'] = users
+def presence_delta(delta):
+    delta = wire_format.decode('presence_delta', delta)
+    version = delta.get('version', 0)
+    if version <= client_state['presence_version']:
+        return
+    if version != client_state['presence_version'] + 1:
+        sio.emit('request_presence_snapshot')
+        return
+    gone = set(delta.get('leaves', []))
+    changed = {u['uid']: u for u in delta.get('joins', []) + delta.get('updates', [])}
+    users = [u for u in client_state['online_users'] if u['uid'] not in gone and u['uid'] not in changed]
+    # Admin 条目保持在末尾
+    admin = [u for u in users if u['uid'] == 'ADMIN']
+    client_state['online_users'] = [u for u in users if u['uid'] != 'ADMIN'] + list(changed.values()) + admin
+    client_state['presence_version'] = version
+    push_event('presence', delta)
 
 
 @sio.event
 def receive_message(data):
-    client_state['messages'].append(data)
-    # --- 新增：调用保存逻辑 ---
-    save_chat_locally(data)
+    data = wire_format.decode('receive_message', data)
+    key = conversation_key(data, client_state.get('uid'))
+    # 存储与推送放在同一把锁里，保证快照里的 seq 与会话摘要一致
+    with event_cond:
+        if key:
+            data = message_store.add(key, data)
+        push_event('message', data)
+    if key:
+        cache_messages(key, [data])
+
+
+@sio.event
+def receive_messages(data):
+    """登录后服务器一次性发来的离线私聊，附每个会话的未读数，网页收到一个 inbox 事件"""
+    data = wire_format.decode('receive_messages', data)
+    me = client_state.get('uid')
+    grouped = {}
+    with event_cond:
+        stored = []
+        for msg in data.get('messages', []):
+            key = conversation_key(msg, me)
+            if key:
+                msg = message_store.add(key, msg)
+                grouped.setdefault(key, []).append(msg)
+            stored.append(msg)
+        push_event('inbox', {'messages': stored, 'unread': data.get('unread', {}), 'dropped': data.get('dropped', 0)})
+    for key, msgs in grouped.items():
+        cache_messages(key, msgs)
+    if data.get('dropped'):
+        push_notification(f"{data['dropped']} older offline messages were not kept, open the chat to load history")
 
 
 @sio.event
 def system_send_code(data):
     code = data['code']
     print(f"\n [CODE] {code} \n")
-    client_state['notification'] = f"Verification Code: {code}"
+    push_notification(f"Verification Code: {code}")
 
 
 @sio.event
-def show_notification(data): client_state['notification'] = data['msg']
+def show_notification(data): push_notification(data['msg'])
 
 
 @sio.event
-def verification_failed(data): client_state['notification'] = data['msg']
+def verification_failed(data): push_notification(data['msg'])
 
 
 @app.route('/')
@@ -190,7 +311,65 @@ def serve_local_file(filename): return send_from_directory(CLIENT_DATA_DIR, file
 
 
 @app.route('/api/status')
-def get_status(): return jsonify(client_state)
+def get_status():
+    """
+    快照，只在网页首次加载或事件流断点丢失时调用。
+    不再包含完整消息列表，只给每个会话的最后一条消息 (侧边栏用)，大小与运行时长无关。
+    """
+    with event_cond:
+        return jsonify(dict(client_state, seq=event_state['seq'], conversations=message_store.summaries()))
+
+
+@app.route('/api/messages')
+def get_messages():
+    """
+    增量拉取某个会话的消息: /api/messages?conversation=X&since_seq=N[&limit=M]
+    truncated=True 时说明中间有消息已归档出内存，应改用 /api/request_history。
+    """
+    conversation = request.args.get('conversation', 'global')
+    try:
+        since_seq = int(request.args.get('since_seq', 0))
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        return jsonify({'status': 'error', 'msg': 'Bad since_seq / limit'}), 400
+    msgs, last_seq, truncated = message_store.since(conversation, since_seq, limit)
+    return jsonify({'status': 'ok', 'messages': msgs, 'last_seq': last_seq, 'truncated': truncated})
+
+
+@app.route('/api/events')
+def stream_events():
+    """SSE 事件流。?since=N 或 Last-Event-ID 头指定从哪个 seq 之后开始推送"""
+    try:
+        since = int(request.headers.get('Last-Event-ID') or request.args.get('since', 0))
+    except ValueError:
+        since = 0
+
+    def generate():
+        last = since
+        yield 'retry: 2000\n\n'
+        while True:
+            with event_cond:
+                if event_state['seq'] == last:
+                    event_cond.wait(timeout=15)
+                oldest = event_log[0][0] if event_log else event_state['seq'] + 1
+                pending = [e for e in event_log if e[0] > last] if event_state['seq'] > last else []
+                current = event_state['seq']
+
+            if last > current or (last < current and last < oldest - 1):
+                # 断点之后的事件已被丢弃，或客户端重启过 (seq 从 0 重新计数、比网页记的还小)，
+                # 只能让网页重新取快照
+                yield f"id: {current}\nevent: reset\ndata: {{}}\n\n"
+                last = current
+                continue
+            if not pending:
+                yield ': keepalive\n\n'
+                continue
+            for seq, kind, data in pending:
+                yield f"id: {seq}\nevent: {kind}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+                last = seq
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/api/clear_notification', methods=['POST'])
@@ -223,17 +402,37 @@ def logout():
         pass
     login_cache['is_active'] = False
     client_state['verified'] = False
+    push_state()
     return jsonify({'status': 'ok'})
 
 
 @app.route('/api/update_profile', methods=['POST'])
 def update_profile():
     data = request.json
-    if data.get('new_avatar'): save_avatar_locally(data.get('new_avatar'))
+    data.pop('new_avatar', None)  # 头像改走 /api/update_avatar 二进制上传
     sio.emit('update_profile', data)
     return jsonify({'status': 'sent'})
 
 
+@app.route('/api/update_avatar', methods=['POST'])
+def update_avatar():
+    """
+    网页以 multipart 提交头像文件：先分块保存到本地，再以二进制流上传到 Server，
+    最后只通过 Socket 发送头像 URL。
+    """
+    file = request.files.get('file')
+    if not file:
+        return jsonify({'status': 'error', 'msg': 'No file part'}), 400
+    content_type = file.content_type or 'image/png'
+    file.save(LOCAL_AVATAR_PATH)
+
+    url, err = upload_file_to_server(LOCAL_AVATAR_PATH, content_type, kind='avatar')
+    if not url:
+        return jsonify({'status': 'error', 'msg': err})
+    sio.emit('update_profile', {'avatar_url': url})
+    return jsonify({'status': 'ok', 'url': url})
+
+
 @app.route('/api/send_message', methods=['POST'])
 def send_message():
     content = request.json.get('content')
@@ -256,50 +455,170 @@ def history_loaded(data):
     当 Server 返回历史记录时触发。
     Server 发给 Python 客户端 (SID已验证)，因此可以收到。
     """
+    data = wire_format.decode('history_loaded', data)
     print(f"[NET] Received history via Socket. Count: {len(data.get('messages', []))}")
 
-    # 将数据存入内存
-    history_sync['data'] = data.get('messages', [])
+    with history_lock:
+        key = history_keys.pop(data.get('request_id'), None)
+        pending = history_inflight.pop(key, None) if key else None
+    if not pending:
+        return  # 已超时或不是本客户端发起的
+
+    conversation = str(data.get('target_uid') or 'global')
+    added = []
+    if pending['uid'] == local_cache['uid']:
+        added = cache_messages(conversation, data.get('messages', []))
+        if not data.get('cursor') and not data.get('since') and local_cache['cache'] is not None:
+            local_cache['cache'].mark_complete(conversation)  # 已经翻到最开始
+    if pending.get('sync'):
+        finish_sync_page(conversation, data, added, pending['sync'])
+        return
+
+    push_event('history', {
+        'request_ids': pending['waiters'],
+        'target_uid': data.get('target_uid'),
+        'messages': data.get('messages', []),
+        'cursor': data.get('cursor'),
+        'before': data.get('before')
+    })
+
+
+def send_history_request(key, payload, waiter=None, sync=None):
+    """
+    登记并发出一次 request_chat_history，返回是否真的发出了 (False 表示并入了 key 相同的在途请求)。
+    waiter 为网页的 request_id，在发出之前挂上，结果不会先于登记到达。
+    sync 不为空表示后台同步 / 预取，结果不推给网页。
+    """
+    with history_lock:
+        expire_history_requests(time.monotonic())
+        pending = history_inflight.get(key)
+        if pending is not None:
+            if waiter:
+                pending['waiters'].append(waiter)
+            return False
+        history_ids['next'] += 1
+        server_id = f"h{history_ids['next']}"
+        pending = history_inflight[key] = {'id': server_id, 'waiters': [waiter] if waiter else [],
+                                           'sent': time.monotonic(), 'uid': local_cache['uid'], 'sync': sync}
+        history_keys[server_id] = key
+    sio.emit('request_chat_history', dict(payload, request_id=server_id))
+    return True
+
+
+def schedule_history_sync():
+    """
+    登录后排队：最近的会话按 since 游标增量同步，没有本地记录的好友预取一页。
+    since 游标必须在这里 (收到新的实时消息之前) 算好，否则断线期间缺的消息会被跳过。
+    """
+    cache = local_cache['cache']
+    if cache is None:
+        return
+    sync_state['generation'] += 1
+    generation = sync_state['generation']
+    conversations = cache.conversations(HISTORY_SYNC_CONVERSATIONS)
+    for conversation in conversations:
+        since = cache.since_cursor(conversation)
+        sync_queue.put((generation, conversation, {'target_uid': conversation, 'limit': HISTORY_SYNC_PAGE,
+                                                   'since': since},
+                        {'kind': 'sync', 'since': since, 'pages': 1, 'added': []}))
+    for friend in load_friends(client_state['uid']):
+        uid = str(friend.get('uid', ''))
+        if uid and uid not in conversations and cache.since_cursor(uid) is None:
+            sync_queue.put((generation, uid, {'target_uid': uid, 'limit': PREFETCH_LIMIT},
+                            {'kind': 'prefetch', 'pages': 1, 'added': []}))
+
+
+def finish_sync_page(conversation, data, added, sync):
+    """同步 / 预取的一页到达：还有缺的就继续往前要，补齐后把新消息推给网页"""
+    sync['added'] = added + sync['added']
+    cursor = data.get('cursor')
+    if sync['kind'] == 'sync' and cursor:
+        if sync['pages'] < HISTORY_SYNC_MAX_PAGES:
+            sync['pages'] += 1
+            sync_queue.put((sync_state['generation'], conversation,
+                            {'target_uid': conversation, 'limit': HISTORY_SYNC_PAGE, 'since': sync['since'],
+                             'before': cursor}, sync))
+            return
+        # 缺得太多，不再往前补：本地更早的部分和刚同步的之间有缺口，丢掉
+        messages = data.get('messages', [])
+        if messages and local_cache['cache'] is not None:
+            local_cache['cache'].drop_older(conversation, str(messages[0].get('timestamp', '')))
+    if sync['kind'] == 'sync' and sync['added']:
+        push_event('history_sync', {'conversation': conversation, 'messages': sync['added']})
+
+
+def history_sync_worker():
+    """按 HISTORY_SYNC_INTERVAL 的间隔发出排队的同步 / 预取请求；重新登录后旧的排队作废"""
+    while True:
+        generation, conversation, payload, sync = sync_queue.get()
+        if generation != sync_state['generation'] or not sio.connected or not client_state['verified']:
+            continue
+        key = ('sync', conversation, payload.get('since'), payload.get('before'))
+        try:
+            send_history_request(key, payload, sync=sync)
+        except Exception as e:
+            print(f"[SYNC ERROR] {e}")
+        time.sleep(HISTORY_SYNC_INTERVAL)
+
+
+def expire_history_requests(now):
+    """丢掉超时未回应的在途请求 (调用方持有 history_lock)"""
+    for key, pending in list(history_inflight.items()):
+        if now - pending['sent'] > HISTORY_REQUEST_TIMEOUT:
+            del history_inflight[key]
+            history_keys.pop(pending['id'], None)
 
-    # 解除 API 接口的阻塞
-    history_sync['event'].set()
 
 @app.route('/api/request_history', methods=['POST'])
 def request_history():
     """
     网页端调用的接口。
-    逻辑：网页 -> Python -> Server -> Python -> 网页
+    逻辑：网页 -> Python -> Server -> Python -> 网页 (SSE 的 history 事件)
+    立即返回 {'status': 'pending', 'request_id': ...}，coalesced 为 True 表示并入了已在途的相同请求
     """
-    target_uid = request.json.get('target_uid')
-    limit = request.json.get('limit', 128)
+    data = request.json or {}
+    target_uid = data.get('target_uid')
+    limit = data.get('limit', 128)
+    before = data.get('before')  # 分页游标，向前翻历史时使用
+
+    # 先看本地缓存：够一页 (或本地游标继续翻) 就直接返回
+    cache = local_cache['cache']
+    if cache is not None and client_state['verified'] and (not before or str(before).startswith(LOCAL_CURSOR_PREFIX)):
+        try:
+            local = cache.page(target_uid or 'global', int(limit), before)
+        except ValueError:
+            return jsonify({'status': 'error', 'msg': 'Bad cursor / limit'})
+        if local is not None:
+            return jsonify({'status': 'ok', 'messages': local[0], 'cursor': local[1], 'source': 'local'})
 
     # 安全检查
     if not sio.connected or not client_state['verified']:
         return jsonify({'status': 'error', 'msg': 'Backend not connected or verified'})
 
-    # 重置同步事件，准备等待
-    history_sync['event'].clear()
-    history_sync['data'] = []
+    page_id = data.get('request_id') or f"api{time.time_ns()}"
+    sent = send_history_request((str(target_uid), before, str(limit)),
+                                {'target_uid': target_uid, 'limit': limit, 'before': before}, waiter=page_id)
+    if sent:
+        print(f"[API] Proxying history request for target: {target_uid}")
+    return jsonify({'status': 'pending', 'request_id': page_id, 'coalesced': not sent})
 
-    print(f"[API] Proxying history request for target: {target_uid}")
 
-    # Python 客户端向 Server 发送请求
-    sio.emit('request_chat_history', {
-        'target_uid': target_uid,
-        'limit': limit
-    })
-
-    # 阻塞等待 Server 返回 (最多等 3 秒)
-    is_received = history_sync['event'].wait(timeout=3.0)
-
-    if is_received:
-        # 成功拿到数据，返回给前端
-        return jsonify({
-            'status': 'ok',
-            'messages': history_sync['data']
-        })
-    else:
+@app.route('/api/search', methods=['POST'])
+def search_history():
+    """全文检索：服务器通过 ack 直接返回结果，不需要像历史记录那样等事件"""
+    if not sio.connected or not client_state['verified']:
+        return jsonify({'status': 'error', 'msg': 'Backend not connected or verified'})
+    data = request.json or {}
+    try:
+        result = sio.call('search_history', {
+            'q': data.get('q', ''),
+            'offset': data.get('offset', 0),
+            'limit': data.get('limit', 20),
+            'target_uid': data.get('target_uid')
+        }, timeout=5)
+    except socketio.exceptions.TimeoutError:
         return jsonify({'status': 'error', 'msg': 'Timeout waiting for server'})
+    return jsonify(result or {'status': 'error', 'msg': 'Empty response'})
 
 
 @app.route('/api/get_friends', methods=['GET'])
@@ -307,15 +626,7 @@ def get_friends():
     current_uid = client_state.get('uid')
     if not current_uid:
         return jsonify([])
-    user_dir = os.path.join(CLIENT_DATA_DIR, str(current_uid))
-    friend_file = os.path.join(user_dir, 'friends.json')
-    if os.path.exists(friend_file):
-        try:
-            with open(friend_file, 'r', encoding='utf-8') as f:
-                return jsonify(json.load(f))
-        except:
-            return jsonify([])
-    return jsonify([])
+    return jsonify(load_friends(current_uid))
 
 
 @app.route('/api/add_friend', methods=['POST'])
@@ -339,6 +650,11 @@ def add_friend():
     friends.append(data)
     with open(friend_file, 'w', encoding='utf-8') as f:
         json.dump(friends, f, ensure_ascii=False)
+    # 预取与新好友的最近一页，打开会话时直接读本地
+    cache = local_cache['cache']
+    if cache is not None and cache.since_cursor(data['uid']) is None:
+        sync_queue.put((sync_state['generation'], str(data['uid']), {'target_uid': data['uid'], 'limit': PREFETCH_LIMIT},
+                        {'kind': 'prefetch', 'pages': 1, 'added': []}))
     return jsonify({'status': 'ok'})
 
 
@@ -347,7 +663,9 @@ def start_socket_loop():
     while True:
         try:
             if not sio.connected:
-                sio.connect(SERVER_URL, transports=['websocket', 'polling'], wait_timeout=5); sio.wait()
+                sio.connect(SERVER_URL, transports=['websocket', 'polling'], wait_timeout=5,
+                            auth={'wire': WIRE_FORMAT})
+                sio.wait()
             else:
                 time.sleep(1)
         except:
@@ -358,8 +676,6 @@ if __name__ == '__main__':
     t = Thread(target=start_socket_loop);
     t.daemon = True;
     t.start()
+    Thread(target=history_sync_worker, daemon=True).start()
     Timer(1.0, lambda: webbrowser.open(f'http://127.0.0.1:{CLIENT_PORT}')).start()
     app.run(port=CLIENT_PORT, debug=False)
-
-
-
@@ -0,0 +1,95 @@
+"""
+客户端内存消息仓库：按会话分桶、每个会话有上限。
+
+原来 client_state['messages'] 无限增长，并且每次 /api/status 都整表序列化。
+现在每条消息分配一个全局递增的 seq，每个会话最多保留 cap 条，
+超出的旧消息 (以及整段不活跃的会话) 直接丢弃：消息在收到时已经写进本地缓存
+client_data/<uid>/messages.db (client_cache.py)，翻到内存以外的部分从那里读。
+网页用 since(conversation, since_seq) 只取新增部分。
+"""
+import threading
+from collections import OrderedDict, deque
+
+
+def conversation_key(msg, my_uid):
+    """与网页端一致：群聊为 'global'，私聊为对方 uid；与自己无关的消息返回 None"""
+    target = msg.get('target_uid')
+    if not target or target == 'global':
+        return 'global'
+    sender = str(msg.get('uid', ''))
+    if sender == str(my_uid):
+        return str(target)
+    if str(target) == str(my_uid):
+        return sender
+    return None
+
+
+class _Conversation:
+    __slots__ = ('messages', 'evicted_seq')
+
+    def __init__(self):
+        self.messages = deque()
+        # 已被挤出内存的最大 seq，用来判断增量拉取是否出现断档
+        self.evicted_seq = 0
+
+
+class MessageStore:
+    def __init__(self, cap_per_conversation=300, max_conversations=200):
+        """每个会话最多常驻 cap * 1.25 条，最多保留 max_conversations 个会话"""
+        self.cap = cap_per_conversation
+        self.max_conversations = max_conversations
+        self.conversations = OrderedDict()  # key -> _Conversation，按最近活跃排序
+        self.seq = 0
+        self.lock = threading.RLock()
+
+    def add(self, conversation, msg):
+        """存入一条消息，返回带 seq 的副本"""
+        with self.lock:
+            self.seq += 1
+            msg = dict(msg, seq=self.seq)
+            conv = self.conversations.get(conversation)
+            if conv is None:
+                conv = self.conversations[conversation] = _Conversation()
+            else:
+                self.conversations.move_to_end(conversation)
+            conv.messages.append(msg)
+
+            # 超出上限 1/4 时才成批挤出，不必每条消息都挪一次
+            if len(conv.messages) > self.cap + self.cap // 4:
+                while len(conv.messages) > self.cap:
+                    conv.evicted_seq = conv.messages.popleft()['seq']
+
+            while len(self.conversations) > self.max_conversations:
+                self.conversations.popitem(last=False)
+            return msg
+
+    def since(self, conversation, since_seq=0, limit=None):
+        """
+        返回 (messages, last_seq, truncated)。
+        truncated=True 表示 since_seq 之后有消息已被挤出内存，调用方应改为拉取历史记录。
+        """
+        with self.lock:
+            conv = self.conversations.get(conversation)
+            if conv is None:
+                return [], self.seq, False
+            msgs = [m for m in conv.messages if m['seq'] > since_seq]
+            truncated = since_seq < conv.evicted_seq
+            if limit is not None and len(msgs) > limit:
+                msgs = msgs[-limit:]
+                truncated = True
+            return msgs, self.seq, truncated
+
+    def summaries(self):
+        """侧边栏用：每个会话只给最后一条消息，seq 为该会话最新的 seq (网页据此调用 since)"""
+        with self.lock:
+            return {key: {'last_msg': conv.messages[-1] if conv.messages else None, 'count': len(conv.messages),
+                          'seq': conv.messages[-1]['seq'] if conv.messages else conv.evicted_seq}
+                    for key, conv in self.conversations.items()}
+
+    def clear(self):
+        with self.lock:
+            self.conversations.clear()
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(c.messages) for c in self.conversations.values())
@@ -0,0 +1,194 @@
+"""
+每个房间最近 N 条消息的内存环形缓冲。
+
+房间 key 与日志文件夹同名 (global_chat / 较小UID_较大UID)。
+首次访问某个房间时从日志文件懒加载，之后新消息直接追加进缓冲，
+能由缓冲满足的历史请求不再触碰磁盘。所有房间共享一个内存预算，
+超出时按 LRU 淘汰最久未访问的私聊房间 (pinned 房间不会被淘汰)。
+
+预热读磁盘时不持有缓冲的锁，其他房间的请求照常命中；同一房间的并发请求等待这一次预热。
+预热期间到达的新消息先记在预热标记里，加载完后按 (时间戳, uid, 内容) 去重再补进缓冲
+(预热前会 flush 日志，这些消息可能已经在读到的内容里)。预热算作未命中。
+"""
+import threading
+from collections import Counter, OrderedDict, deque
+
+import history_reader
+
+# 单条消息的内存占用粗略估算：字段字符串长度 + dict / 对象本身的开销
+MSG_OVERHEAD_BYTES = 400
+
+
+def estimate_size(msg):
+    return MSG_OVERHEAD_BYTES + sum(len(str(v)) for v in msg.values())
+
+
+def _fingerprint(msg):
+    return msg.get('timestamp'), msg.get('uid'), msg.get('content')
+
+
+class _Room:
+    __slots__ = ('messages', 'size', 'complete')
+
+    def __init__(self, capacity):
+        self.messages = deque(maxlen=capacity)
+        self.size = 0
+        # complete=True 表示缓冲里已经是该房间的全部历史 (磁盘上的消息不足 capacity 条)
+        self.complete = False
+
+
+class _Warming:
+    __slots__ = ('done', 'appended')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.appended = []  # 预热期间 append 进来的消息
+
+
+class RoomHistoryCache:
+    def __init__(self, loader, per_room=512, max_bytes=64 * 1024 * 1024, pinned=('global_chat',)):
+        """
+        loader(room_key, n) -> 该房间最近 n 条消息 (按时间正序)
+        """
+        self.loader = loader
+        self.per_room = per_room
+        self.max_bytes = max_bytes
+        self.pinned = set(pinned)
+        self.rooms = OrderedDict()
+        self.warming = {}  # key -> _Warming (正在从磁盘加载的房间)
+        self.total_bytes = 0
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.warmups = 0
+        self.evictions = 0
+
+    def _warm(self, key, pending):
+        """在锁外加载，完成后把房间放进缓冲 (加载期间被 invalidate 的不放)"""
+        try:
+            messages = self.loader(key, self.per_room)
+        except Exception:
+            with self.lock:
+                if self.warming.get(key) is pending:
+                    del self.warming[key]
+            pending.done.set()
+            raise
+        room = _Room(self.per_room)
+        with self.lock:
+            for msg in messages:
+                self._push(room, msg)
+            room.complete = len(messages) < self.per_room
+            loaded = Counter(_fingerprint(m) for m in messages)
+            for msg in pending.appended:
+                fp = _fingerprint(msg)
+                if loaded[fp]:
+                    loaded[fp] -= 1
+                else:
+                    self._push(room, msg)
+            if self.warming.get(key) is pending:
+                del self.warming[key]
+                self.rooms[key] = room
+                self._evict()
+            else:
+                self.total_bytes -= room.size
+            self.warmups += 1
+        pending.done.set()
+        return room
+
+    def _push(self, room, msg):
+        if len(room.messages) == room.messages.maxlen:
+            old = room.messages[0]
+            room.size -= estimate_size(old)
+            self.total_bytes -= estimate_size(old)
+            room.complete = False
+        room.messages.append(msg)
+        size = estimate_size(msg)
+        room.size += size
+        self.total_bytes += size
+
+    def _evict(self):
+        for key in list(self.rooms):
+            if self.total_bytes <= self.max_bytes:
+                return
+            if key in self.pinned:
+                continue
+            room = self.rooms.pop(key)
+            self.total_bytes -= room.size
+            self.evictions += 1
+
+    def get(self, key, limit):
+        """
+        从缓冲取最近 limit 条。返回 (messages, cursor)；
+        缓冲不够 (limit 超过容量且房间历史更长) 时返回 None，调用方应回退到磁盘读取。
+        """
+        missed = False
+        while True:
+            with self.lock:
+                room = self.rooms.get(key)
+                if room is not None:
+                    self.rooms.move_to_end(key)
+                    return self._page(room, limit, missed)
+                pending = self.warming.get(key)
+                owner = pending is None
+                if owner:
+                    pending = self.warming[key] = _Warming()
+            missed = True
+            if owner:
+                room = self._warm(key, pending)
+                with self.lock:
+                    return self._page(room, limit, missed)
+            # 另一个线程正在预热，等它完成后重新查 (预热失败或刚被淘汰时由本线程重新预热)
+            pending.done.wait()
+
+    def _page(self, room, limit, missed):
+        if limit > len(room.messages) and not room.complete:
+            self.misses += 1
+            return None
+        if missed:
+            self.misses += 1
+        else:
+            self.hits += 1
+        page = list(room.messages)[-limit:] if limit > 0 else []
+        if not page or (room.complete and len(page) == len(room.messages)):
+            return page, None
+        return page, history_reader.cursor_before_message(page)
+
+    def append(self, key, msg):
+        """新消息写入日志后调用。房间尚未预热时忽略 (之后预热会从磁盘读到它)，正在预热时暂存"""
+        with self.lock:
+            room = self.rooms.get(key)
+            if room is None:
+                pending = self.warming.get(key)
+                if pending is not None:
+                    pending.appended.append(msg)
+                return
+            self._push(room, msg)
+            self.rooms.move_to_end(key)
+            self._evict()
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.rooms.clear()
+                self.warming.clear()
+                self.total_bytes = 0
+            else:
+                self.warming.pop(key, None)
+                if key in self.rooms:
+                    self.total_bytes -= self.rooms.pop(key).size
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'rooms': len(self.rooms),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'per_room': self.per_room,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'warmups': self.warmups,
+                'warming': len(self.warming),
+                'evictions': self.evictions,
+            }
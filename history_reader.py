@@ -0,0 +1,250 @@
+"""
+聊天日志的倒序读取。
+
+日志是按天切分的 JSON Lines 文件 (YYYY-MM-DD.log)。读取最近 N 条时
+从最新一天的文件末尾按块向前 seek，只解析真正要返回的那几行；
+当天不够再懒加载前一天，不会把整天的文件读进内存。
+
+分页游标有两种格式:
+- "<文件名>:<字节偏移>"  该文件中此偏移之前、以及更早日期的消息
+- "@<timestamp>#<n>"      时间戳为 timestamp 的消息里除去最新 n 条后更早的消息
+                          (由内存缓冲生成，此时不知道字节偏移)
+
+已结束的日期可能被压缩成 .logz 归档 (见 log_archive.py)，归档保留了原文件的字节偏移，
+这里按日期统一成 "<日期>.log" 处理，读取时有归档就读归档。
+"""
+import json
+import os
+
+import log_archive
+
+BLOCK_SIZE = 64 * 1024
+LOG_SUFFIX = '.log'
+
+
+def iter_lines_reverse(path, end=None, block_size=BLOCK_SIZE):
+    """
+    从文件末尾 (或指定的 end 偏移) 向前逐行产出 (行起始偏移, 行内容 bytes)。
+    空行会被跳过。
+    """
+    with open(path, 'rb') as f:
+        pos = f.seek(0, os.SEEK_END)
+        if end is not None:
+            pos = min(pos, end)
+        buf = b''
+        while pos > 0:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+            pieces = buf.split(b'\n')
+            # pieces[0] 可能是被块边界截断的半行，留到下一轮
+            buf = pieces[0]
+            cur_end = pos + len(buf)
+            starts = []
+            for piece in pieces[1:]:
+                starts.append(cur_end + 1)
+                cur_end += 1 + len(piece)
+            for start, piece in zip(reversed(starts), reversed(pieces[1:])):
+                if piece.strip():
+                    yield start, piece
+        if buf.strip():
+            yield 0, buf
+
+
+def _line_timestamp(f, pos):
+    """返回 pos 之后第一个完整行的 (起始偏移, timestamp)，到达文件尾返回 (None, None)"""
+    f.seek(pos)
+    if pos > 0:
+        f.readline()  # 跳过被截断的半行
+    while True:
+        start = f.tell()
+        line = f.readline()
+        if not line:
+            return None, None
+        try:
+            return start, str(json.loads(line).get('timestamp', ''))
+        except ValueError:
+            continue
+
+
+def offset_before_ts(path, before_ts):
+    """
+    日志按时间顺序追加，因此可以对字节偏移二分查找：
+    返回第一条 timestamp >= before_ts 的行起始偏移 (都更早时返回文件长度)。
+    """
+    with open(path, 'rb') as f:
+        lo, hi = 0, f.seek(0, os.SEEK_END)
+        size = hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, ts = _line_timestamp(f, mid)
+            if start is None or ts >= before_ts:
+                hi = mid
+            else:
+                lo = mid + 1
+        start, _ = _line_timestamp(f, lo)
+        return size if start is None else start
+
+
+def list_log_files(folder):
+    """返回文件夹内的日志文件名 (归档也按 "<日期>.log" 返回)，按日期倒序 (最新的在前面)"""
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return []
+    files = {f for f in names if f.endswith(LOG_SUFFIX)}
+    files.update(f[:-len(log_archive.ARCHIVE_SUFFIX)] + LOG_SUFFIX
+                 for f in names if f.endswith(log_archive.ARCHIVE_SUFFIX))
+    return sorted(files, reverse=True)
+
+
+def _day_exists(path):
+    return os.path.exists(path) or os.path.exists(log_archive.archive_path(path))
+
+
+def iter_day_reverse(path, end=None):
+    """
+    倒序产出某一天的 (偏移, 消息)，坏行跳过。path 为 .log 路径；
+    有归档时读归档 (压缩过程中两者可能同时存在，内容相同)。
+    """
+    archive = log_archive.archive_path(path)
+    if os.path.exists(archive):
+        yield from log_archive.open_archive(archive).iter_reverse(end)
+        return
+    for offset, raw in iter_lines_reverse(path, end):
+        try:
+            yield offset, json.loads(raw)
+        except ValueError:
+            continue
+
+
+def day_offset_before_ts(path, before_ts):
+    archive = log_archive.archive_path(path)
+    if os.path.exists(archive):
+        return log_archive.open_archive(archive).offset_before_ts(before_ts)
+    return offset_before_ts(path, before_ts)
+
+
+def cursor_before_message(page):
+    """为一页消息 (按时间正序) 生成指向其最早一条之前的时间戳游标"""
+    ts = str(page[0].get('timestamp', ''))
+    same = sum(1 for m in page if str(m.get('timestamp', '')) == ts)
+    return f"@{ts}#{same}"
+
+
+def parse_since(since):
+    """"@timestamp#n" -> (timestamp, n)，格式不对返回 None"""
+    since = str(since or '')
+    if not since.startswith('@') or '#' not in since:
+        return None
+    ts, _, count = since[1:].rpartition('#')
+    try:
+        return ts, max(0, int(count))
+    except ValueError:
+        return None
+
+
+def trim_since(page, cursor, since):
+    """
+    增量同步：since 为 "@timestamp#n"，表示客户端已有 timestamp 之前的全部消息和这一秒内的前 n 条。
+    page / cursor 为 read_logs_page 的结果 (按时间正序)，只保留 since 之后的消息，返回 (messages, cursor)。
+    返回的 cursor 不为 None 表示更早处还有客户端缺的消息，用 before=cursor 和同一个 since 继续请求。
+    同一秒的消息跨页时，前一页里这一秒的消息会全部返回 (可能有客户端已有的)，客户端需按内容去重。
+    """
+    parsed = parse_since(since)
+    if parsed is None:
+        return page, cursor
+    ts, skip = parsed
+    newer = [m for m in page if str(m.get('timestamp', '')) > ts]
+    if cursor is None or (page and str(page[0].get('timestamp', '')) < ts):
+        same = [m for m in page if str(m.get('timestamp', '')) == ts]
+        return same[skip:] + newer, None
+    return page, cursor
+
+
+def _resolve_ts_cursor(folder, ts, skip):
+    """把 "@timestamp#n" 游标换算成 (文件名, 字节偏移)"""
+    filename = ts[:10] + LOG_SUFFIX
+    path = os.path.join(folder, filename)
+    if not _day_exists(path):
+        return filename, 0
+    # 同一秒内的消息位于 [offset_before_ts(ts), offset_before_ts(ts 的后继)) 区间
+    end = day_offset_before_ts(path, ts + '\x7f')
+    for offset, _ in iter_day_reverse(path, end):
+        if skip <= 0:
+            break
+        end = offset
+        skip -= 1
+    return filename, end
+
+
+def parse_cursor(cursor, folder=None):
+    """"2024-01-01.log:1234" -> ("2024-01-01.log", 1234)，格式不对返回 None"""
+    if not cursor:
+        return None
+    cursor = str(cursor)
+    if cursor.startswith('@') and '#' in cursor and folder is not None:
+        ts, _, skip = cursor[1:].rpartition('#')
+        try:
+            return _resolve_ts_cursor(folder, ts, int(skip))
+        except (ValueError, OSError):
+            return None
+    if ':' not in cursor:
+        return None
+    name, _, offset = str(cursor).rpartition(':')
+    try:
+        return os.path.basename(name), int(offset)
+    except ValueError:
+        return None
+
+
+def read_logs_page(folder, limit=128, before=None, before_ts=None):
+    """
+    读取 folder 中最新的 limit 条消息 (按时间正序返回)。
+    - before: 分页游标，只返回游标之前的消息
+    - before_ts: "YYYY-MM-DD HH:MM:SS"，只返回早于该时间的消息
+    返回 (messages, next_cursor)。next_cursor 指向本页最早一条消息，
+    已经读到最开始时为 None。
+    """
+    if limit <= 0:
+        return [], None
+
+    start = parse_cursor(before, folder)
+    ts_day = before_ts[:10] if before_ts else None
+    newest_first = []
+    next_cursor = None
+
+    for filename in list_log_files(folder):
+        end = None
+        if start:
+            if filename > start[0]:
+                continue
+            if filename == start[0]:
+                end = start[1]
+        if ts_day and filename[:10] > ts_day:
+            continue
+
+        file_path = os.path.join(folder, filename)
+        try:
+            if ts_day and filename[:10] == ts_day:
+                ts_end = day_offset_before_ts(file_path, before_ts)
+                end = ts_end if end is None else min(end, ts_end)
+            for offset, msg in iter_day_reverse(file_path, end):
+                if before_ts and str(msg.get('timestamp', '')) >= before_ts:
+                    continue
+                newest_first.append(msg)
+                if len(newest_first) >= limit:
+                    next_cursor = f"{filename}:{offset}"
+                    newest_first.reverse()
+                    return newest_first, next_cursor
+        except (OSError, log_archive.ArchiveError) as e:
+            print(f"[HISTORY READ ERROR] {filename}: {e}")
+
+    newest_first.reverse()
+    return newest_first, None
+
+
+def read_recent_logs(folder, limit=128):
+    """兼容旧接口：只返回最近 limit 条消息"""
+    return read_logs_page(folder, limit)[0]
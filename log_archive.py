@@ -0,0 +1,369 @@
+"""
+已结束日期的聊天日志压缩归档 (<日期>.log -> <日期>.logz)。
+
+当天的 .log 照常由 log_writer 追加；更早的日期由后台任务 (或命令行) 转成归档：
+- 每 BLOCK_ROWS 条消息一个块，块内按列存放 (同一个键的值放在一起，压缩率更高)，
+  整块用 zlib 压缩 (装了 zstandard 时可选 zstd)
+- 文件末尾是稀疏索引：每块的 [文件偏移, 长度, 条数, 原始字节偏移, 首条时间, 末条时间]
+- 保留每条消息在原 .log 中的字节偏移，"<日期>.log:<偏移>" 形式的分页游标压缩前后都有效
+
+文件布局:
+    MAGIC | 块 ... | 索引 (zlib 压缩的 JSON) | 索引偏移 u64 | 索引长度 u32 | MAGIC
+
+history_reader 读取时先找 .logz，没有再读 .log，对调用方透明。
+
+命令行:
+    python log_archive.py compact [日志目录]      压缩所有已结束日期的日志
+    python log_archive.py expand <.logz 或目录>   还原为 .log (删除归档)
+    python log_archive.py stats [日志目录]        原始大小 / 归档大小
+"""
+import json
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+try:
+    import zstandard
+except ImportError:  # 可选依赖
+    zstandard = None
+
+MAGIC = b'CHATLOGZ'
+FOOTER = struct.Struct('<QI8s')
+LOG_SUFFIX = '.log'
+ARCHIVE_SUFFIX = '.logz'
+BLOCK_ROWS = 1024
+DEFAULT_CODEC = 'zlib'
+MIN_AGE_SECONDS = 3600  # 最后一次写入后至少过这么久才压缩，等 log_writer 关闭句柄、迟到的消息写完
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def archive_path(log_path):
+    """"…/2024-01-01.log" -> "…/2024-01-01.logz" """
+    return log_path[:-len(LOG_SUFFIX)] + ARCHIVE_SUFFIX if log_path.endswith(LOG_SUFFIX) else log_path
+
+
+def _compress(codec, data):
+    if codec == 'zlib':
+        return zlib.compress(data, 9)
+    if codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=19).compress(data)
+    raise ArchiveError(f"Unsupported codec: {codec}")
+
+
+def _decompress(codec, data):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ArchiveError("Archive uses zstd, pip install zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ArchiveError(f"Unsupported codec: {codec}")
+
+
+# ==========================================
+#   块编码 (按列)
+# ==========================================
+
+def _encode_block(rows):
+    """rows: [(原始偏移, 行长度, 消息字典)] -> 块的 JSON 字节"""
+    shapes, shape_index, shape_ids, lengths, cols = [], {}, [], [], {}
+    for _, length, msg in rows:
+        keys = tuple(msg)
+        sid = shape_index.get(keys)
+        if sid is None:
+            sid = shape_index[keys] = len(shapes)
+            shapes.append(list(keys))
+        shape_ids.append(sid)
+        lengths.append(length)
+        for k, v in msg.items():
+            cols.setdefault(k, []).append(v)
+    block = {'shapes': shapes, 'shape': shape_ids, 'len': lengths, 'cols': cols}
+    return json.dumps(block, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _decode_block(raw, src_start):
+    """-> [(原始偏移, 消息字典)]，按写入顺序"""
+    block = json.loads(raw)
+    shapes, cols = block['shapes'], block['cols']
+    pos = {k: 0 for k in cols}
+    out, offset = [], src_start
+    for sid, length in zip(block['shape'], block['len']):
+        msg = {}
+        for k in shapes[sid]:
+            msg[k] = cols[k][pos[k]]
+            pos[k] += 1
+        out.append((offset, msg))
+        offset += length
+    return out
+
+
+# ==========================================
+#   读取
+# ==========================================
+
+class ArchiveReader:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            end = f.seek(0, os.SEEK_END)
+            if end < len(MAGIC) + FOOTER.size:
+                raise ArchiveError(f"{path}: truncated")
+            f.seek(end - FOOTER.size)
+            index_offset, index_len, magic = FOOTER.unpack(f.read(FOOTER.size))
+            if magic != MAGIC:
+                raise ArchiveError(f"{path}: bad footer")
+            f.seek(index_offset)
+            index = json.loads(zlib.decompress(f.read(index_len)))
+        self.codec = index['codec']
+        self.size = index['size']        # 原 .log 的字节数
+        self.count = index['count']
+        self.source = index.get('source')  # 压缩时 .log 的 [inode, 字节数]
+        self.blocks = index['blocks']    # [offset, length, count, src_start, first_ts, last_ts]
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()       # 块号 -> 解码后的行，只留最近几块
+
+    def block(self, i):
+        with self.lock:
+            rows = self.cache.get(i)
+            if rows is not None:
+                self.cache.move_to_end(i)
+                return rows
+        offset, length, _, src_start = self.blocks[i][:4]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            rows = _decode_block(_decompress(self.codec, f.read(length)), src_start)
+        with self.lock:
+            self.cache[i] = rows
+            while len(self.cache) > 4:
+                self.cache.popitem(last=False)
+        return rows
+
+    def iter_reverse(self, end=None):
+        """倒序产出 (原始偏移, 消息)，只包含原始偏移 < end 的消息"""
+        for i in range(len(self.blocks) - 1, -1, -1):
+            if end is not None and self.blocks[i][3] >= end:
+                continue
+            for offset, msg in reversed(self.block(i)):
+                if end is None or offset < end:
+                    yield offset, msg
+
+    def iter_forward(self):
+        for i in range(len(self.blocks)):
+            yield from self.block(i)
+
+    def offset_before_ts(self, before_ts):
+        """第一条 timestamp >= before_ts 的原始偏移 (都更早时返回原文件长度)，对应 history_reader.offset_before_ts"""
+        for i, entry in enumerate(self.blocks):
+            if str(entry[5]) < before_ts:
+                continue
+            for offset, msg in self.block(i):
+                if str(msg.get('timestamp', '')) >= before_ts:
+                    return offset
+        return self.size
+
+
+_readers = OrderedDict()  # (路径, mtime, 大小) -> ArchiveReader
+_readers_lock = threading.Lock()
+
+
+def open_archive(path):
+    """带缓存地打开归档 (文件被重写后 mtime / 大小变化，自动换新的 reader)"""
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    with _readers_lock:
+        reader = _readers.get(key)
+        if reader is not None:
+            _readers.move_to_end(key)
+            return reader
+    reader = ArchiveReader(path)
+    with _readers_lock:
+        _readers[key] = reader
+        while len(_readers) > 64:
+            _readers.popitem(last=False)
+    return reader
+
+
+# ==========================================
+#   写入 / 压缩 / 还原
+# ==========================================
+
+def _iter_log_rows(path, base=0, start=0):
+    """
+    从 start 开始顺序读取 .log，返回 ([原始偏移, 行长度, 消息] 列表, 文件长度)。
+    空行和坏行的字节计入上一条，保证偏移不变
+    """
+    rows = []
+    with open(path, 'rb') as f:
+        offset = f.seek(start)
+        for line in f:
+            try:
+                msg = json.loads(line) if line.strip() else None
+            except ValueError:
+                msg = None
+            if isinstance(msg, dict):
+                rows.append([base + offset, len(line), msg])
+            elif rows:
+                rows[-1][1] += len(line)
+            offset += len(line)
+    return rows, offset
+
+
+def write_archive(path, rows, size, codec=DEFAULT_CODEC, block_rows=BLOCK_ROWS, source=None):
+    """rows: [(原始偏移, 行长度, 消息)]，先写临时文件再原子替换"""
+    tmp = path + '.tmp'
+    blocks = []
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        for i in range(0, len(rows), block_rows):
+            chunk = rows[i:i + block_rows]
+            data = _compress(codec, _encode_block(chunk))
+            blocks.append([f.tell(), len(data), len(chunk), chunk[0][0],
+                           str(chunk[0][2].get('timestamp', '')), str(chunk[-1][2].get('timestamp', ''))])
+            f.write(data)
+        index = zlib.compress(json.dumps({'v': 1, 'codec': codec, 'size': size, 'count': len(rows),
+                                          'source': source, 'blocks': blocks}).encode('utf-8'))
+        index_offset = f.tell()
+        f.write(index)
+        f.write(FOOTER.pack(index_offset, len(index), MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def compact_file(log_path, codec=DEFAULT_CODEC):
+    """
+    把一个 .log 压成 .logz 并删除原文件，返回 (原始字节数, 归档字节数)。
+    已有归档时 (压缩后又有迟到的消息写进 .log，或上次删除原文件失败) 把新内容接在归档后面重新生成。
+    """
+    target = archive_path(log_path)
+    st = os.stat(log_path)
+    rows, base, start = [], 0, 0
+    if os.path.exists(target):
+        old = ArchiveReader(target)
+        prev = None
+        for offset, msg in old.iter_forward():
+            if prev is not None:
+                rows.append([prev[0], offset - prev[0], prev[1]])
+            prev = (offset, msg)
+        if prev is not None:
+            rows.append([prev[0], old.size - prev[0], prev[1]])
+        if old.source and old.source[0] and old.source[0] == st.st_ino and st.st_size >= old.source[1]:
+            start = old.source[1]  # 还是上次压缩的那个文件，只取之后追加的部分
+        else:
+            base = old.size
+    new_rows, size = _iter_log_rows(log_path, base, start)
+    rows.extend(new_rows)
+    write_archive(target, rows, base + size, codec, source=[st.st_ino, size])
+    os.remove(log_path)
+    return size - start, os.path.getsize(target)
+
+
+def expand_file(path):
+    """.logz -> .log (与 log_writer 相同的序列化)，删除归档。原文件中的坏行不会恢复，之后的偏移可能变化"""
+    log_path = path[:-len(ARCHIVE_SUFFIX)] + LOG_SUFFIX
+    reader = ArchiveReader(path)
+    tmp = log_path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        for _, msg in reader.iter_forward():
+            f.write(json.dumps(msg) + "\n")
+        if os.path.exists(log_path):  # 迟到的消息
+            with open(log_path, 'r', encoding='utf-8') as tail:
+                f.write(tail.read())
+    os.replace(tmp, log_path)
+    os.remove(path)
+    return log_path
+
+
+def compact_logs(logs_dir, min_age=MIN_AGE_SECONDS, codec=DEFAULT_CODEC, today=None):
+    """压缩 logs_dir 下各房间中早于今天、且 min_age 秒内没有写入的 .log，返回统计"""
+    today = today or time.strftime('%Y-%m-%d')
+    now = time.time()
+    stats = {'files': 0, 'bytes_in': 0, 'bytes_out': 0, 'errors': 0}
+    started = time.perf_counter()
+    for room in sorted(os.listdir(logs_dir)) if os.path.isdir(logs_dir) else []:
+        folder = os.path.join(logs_dir, room)
+        if not os.path.isdir(folder):
+            continue
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name)
+            if not name.endswith(LOG_SUFFIX) or name[:10] >= today:
+                continue
+            try:
+                if now - os.path.getmtime(path) < min_age:
+                    continue
+                before, after = compact_file(path, codec)
+            except (OSError, ValueError, ArchiveError) as e:
+                stats['errors'] += 1
+                print(f"[LOG ARCHIVE ERROR] {room}/{name}: {e}")
+                continue
+            stats['files'] += 1
+            stats['bytes_in'] += before
+            stats['bytes_out'] += after
+    stats['seconds'] = round(time.perf_counter() - started, 3)
+    return stats
+
+
+def find_references(paths, url_prefix):
+    """media_store.find_references 的归档版本：在解压后的块里查找被引用的媒体文件名"""
+    pattern = re.compile(re.escape(url_prefix) + rb'([A-Za-z0-9_.\-]+)')
+    found = set()
+    for path in paths:
+        try:
+            reader = ArchiveReader(path)
+            with open(path, 'rb') as f:
+                for offset, length in (b[:2] for b in reader.blocks):
+                    f.seek(offset)
+                    raw = _decompress(reader.codec, f.read(length))
+                    found.update(m.decode() for m in pattern.findall(raw))
+        except (OSError, ValueError, ArchiveError) as e:
+            # 读不出来就不能确定哪些文件没被引用，交给调用方放弃本次清理
+            raise ArchiveError(f"{path}: {e}")
+    return found
+
+
+def usage(logs_dir):
+    """{'log': (文件数, 字节), 'logz': (文件数, 字节), 'logz_original': 归档前的字节}"""
+    out = {'log': [0, 0], 'logz': [0, 0], 'logz_original': 0}
+    for root, _, names in os.walk(logs_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            if name.endswith(LOG_SUFFIX):
+                out['log'][0] += 1
+                out['log'][1] += os.path.getsize(path)
+            elif name.endswith(ARCHIVE_SUFFIX):
+                out['logz'][0] += 1
+                out['logz'][1] += os.path.getsize(path)
+                try:
+                    out['logz_original'] += open_archive(path).size
+                except (OSError, ArchiveError):
+                    pass
+    return out
+
+
+if __name__ == '__main__':
+    cmd = sys.argv[1] if len(sys.argv) > 1 else ''
+    target = sys.argv[2] if len(sys.argv) > 2 else os.path.join('server_storage', 'chat_logs')
+    if cmd == 'compact':
+        # 命令行手动运行时不等 MIN_AGE_SECONDS，但仍然跳过今天
+        print(compact_logs(target, min_age=0, codec='zstd' if '--zstd' in sys.argv else DEFAULT_CODEC))
+    elif cmd == 'expand' and len(sys.argv) > 2:
+        paths = [target] if target.endswith(ARCHIVE_SUFFIX) else \
+            [os.path.join(root, n) for root, _, names in os.walk(target) for n in names if n.endswith(ARCHIVE_SUFFIX)]
+        for p in paths:
+            print(f"{p} -> {expand_file(p)}")
+    elif cmd == 'stats':
+        u = usage(target)
+        ratio = u['logz_original'] / u['logz'][1] if u['logz'][1] else 0
+        print(f".log  {u['log'][0]} files, {u['log'][1]:,} bytes\n"
+              f".logz {u['logz'][0]} files, {u['logz'][1]:,} bytes "
+              f"(originally {u['logz_original']:,}, x{ratio:.1f})")
+    else:
+        print(__doc__)
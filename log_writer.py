@@ -0,0 +1,243 @@
+"""
+异步批量聊天日志写入器。
+
+消息处理函数只负责把日志条目放进队列，由独立的写线程批量写盘：
+- 每个房间 / 每天的文件句柄保持打开，不再每条消息 open/close 一次
+- 一次取出队列里积压的多条，按房间合并后一次 write + flush
+- fsync 策略可选: 'batch' 每批一次, 'interval' 最多每 fsync_interval 秒一次, 'never' 交给操作系统
+- 按条目的日期 (timestamp 前 10 位) 选择文件，跨过零点自然切换到新文件并关闭旧句柄
+- close() 会先写完队列中剩余的条目再退出
+"""
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+FSYNC_POLICIES = ('batch', 'interval', 'never')
+
+
+class _FlushMarker:
+    __slots__ = ('event',)
+
+    def __init__(self):
+        self.event = threading.Event()
+
+
+_STOP = object()
+
+
+class ChatLogWriter:
+    def __init__(self, logs_dir, fsync_policy='interval', fsync_interval=1.0,
+                 batch_size=512, max_open_files=256, idle_close_seconds=300):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"fsync_policy must be one of {FSYNC_POLICIES}")
+        self.logs_dir = logs_dir
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+        self.max_open_files = max_open_files
+        self.idle_close_seconds = idle_close_seconds
+
+        self.queue = queue.Queue()
+        # (room_key, date_str) -> [file, last_used]，按最近使用排序
+        self.handles = OrderedDict()
+        self.dirty = set()
+        self.last_fsync = time.monotonic()
+        # 每批写完后回调 listener(batch)，batch 为 [(room_key, entry), ...]
+        self.listeners = []
+
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        self.fsyncs = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+        self.max_queue_depth = 0
+
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name='chat-log-writer', daemon=True)
+        self.thread.start()
+
+    # ---------- 生产者接口 ----------
+
+    def write(self, room_key, entry):
+        """放入队列后立即返回"""
+        if self.closed:
+            raise RuntimeError('ChatLogWriter is closed')
+        self.queue.put((room_key, entry))
+        depth = self.queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+
+    def flush(self, timeout=5.0):
+        """阻塞直到此前入队的条目全部写入文件 (不保证 fsync)"""
+        if self.closed or threading.current_thread() is self.thread:
+            return True
+        marker = _FlushMarker()
+        self.queue.put(marker)
+        return marker.event.wait(timeout)
+
+    def close(self, timeout=10.0):
+        """优雅关闭：写完队列中剩余条目、fsync、关闭所有句柄"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(_STOP)
+        self.thread.join(timeout)
+
+    # ---------- 写线程 ----------
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                first = self.queue.get(timeout=self._wait_timeout())
+            except queue.Empty:
+                self._maintenance()
+                continue
+
+            batch, markers = [], []
+            item = first
+            while True:
+                if item is _STOP:
+                    stopping = True
+                elif isinstance(item, _FlushMarker):
+                    markers.append(item)
+                else:
+                    batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._write_batch(batch)
+            for m in markers:
+                m.event.set()
+            self._maintenance()
+
+        self._sync(force=True)
+        for f, _ in self.handles.values():
+            try:
+                f.close()
+            except OSError:
+                pass
+        self.handles.clear()
+
+    def _wait_timeout(self):
+        if self.fsync_policy == 'interval' and self.dirty:
+            return max(0.01, self.fsync_interval - (time.monotonic() - self.last_fsync))
+        return 1.0
+
+    def _handle(self, room_key, date_str, now):
+        key = (room_key, date_str)
+        slot = self.handles.get(key)
+        if slot is None:
+            # 零点切换：同一房间旧日期的句柄不会再被写入，直接关闭
+            for old in [k for k in self.handles if k[0] == room_key]:
+                self._close_handle(old)
+            folder = os.path.join(self.logs_dir, room_key)
+            os.makedirs(folder, exist_ok=True)
+            f = open(os.path.join(folder, f"{date_str}.log"), 'a', encoding='utf-8')
+            slot = self.handles[key] = [f, now]
+            while len(self.handles) > self.max_open_files:
+                self._close_handle(next(iter(self.handles)))
+        else:
+            slot[1] = now
+            self.handles.move_to_end(key)
+        return slot[0]
+
+    def _close_handle(self, key):
+        f, _ = self.handles.pop(key)
+        try:
+            if key in self.dirty and self.fsync_policy != 'never':
+                f.flush()
+                os.fsync(f.fileno())
+            f.close()
+        except OSError as e:
+            self.errors += 1
+            print(f"[LOG ERROR] close {key}: {e}")
+        self.dirty.discard(key)
+
+    def _write_batch(self, batch):
+        started = time.perf_counter()
+        now = time.monotonic()
+        grouped = OrderedDict()
+        for room_key, entry in batch:
+            date_str = str(entry.get('timestamp', ''))[:10] or time.strftime("%Y-%m-%d")
+            grouped.setdefault((room_key, date_str), []).append(json.dumps(entry) + "\n")
+
+        for (room_key, date_str), lines in grouped.items():
+            try:
+                f = self._handle(room_key, date_str, now)
+                f.write(''.join(lines))
+                f.flush()
+                self.dirty.add((room_key, date_str))
+                self.written += len(lines)
+            except OSError as e:
+                self.errors += 1
+                print(f"[LOG ERROR] {room_key}/{date_str}: {e}")
+
+        self._sync(force=self.fsync_policy == 'batch')
+
+        elapsed = (time.perf_counter() - started) * 1000
+        self.batches += 1
+        self.last_flush_ms = elapsed
+        self.total_flush_ms += elapsed
+        self.max_flush_ms = max(self.max_flush_ms, elapsed)
+
+        for listener in self.listeners:
+            try:
+                listener(batch)
+            except Exception as e:
+                print(f"[LOG LISTENER ERROR] {e}")
+
+    def _sync(self, force=False):
+        if not self.dirty or self.fsync_policy == 'never':
+            self.dirty.clear()
+            return
+        if not force and time.monotonic() - self.last_fsync < self.fsync_interval:
+            return
+        for key in list(self.dirty):
+            slot = self.handles.get(key)
+            if slot:
+                try:
+                    os.fsync(slot[0].fileno())
+                    self.fsyncs += 1
+                except OSError as e:
+                    self.errors += 1
+                    print(f"[LOG ERROR] fsync {key}: {e}")
+        self.dirty.clear()
+        self.last_fsync = time.monotonic()
+
+    def _maintenance(self):
+        if self.fsync_policy == 'interval':
+            self._sync()
+        now = time.monotonic()
+        today = time.strftime("%Y-%m-%d")
+        for key in [k for k, (_, used) in self.handles.items()
+                    if k[1] != today or now - used > self.idle_close_seconds]:
+            self._close_handle(key)
+
+    # ---------- 监控 ----------
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+            'written': self.written,
+            'batches': self.batches,
+            'avg_batch_size': round(self.written / self.batches, 2) if self.batches else 0,
+            'last_flush_ms': round(self.last_flush_ms, 3),
+            'avg_flush_ms': round(self.total_flush_ms / self.batches, 3) if self.batches else 0,
+            'max_flush_ms': round(self.max_flush_ms, 3),
+            'fsyncs': self.fsyncs,
+            'open_files': len(self.handles),
+            'errors': self.errors,
+            'fsync_policy': self.fsync_policy,
+        }
@@ -0,0 +1,119 @@
+"""
+媒体文件落盘：流式分块写入，内存占用与文件大小无关。
+
+上传内容 (multipart 的文件流或原始请求体) 每次读 CHUNK_SIZE 字节写入临时文件，
+超过该类型的大小上限立即中止并删除临时文件。
+
+文件按内容寻址：边写边算 SHA-256，最终文件名为 "<sha256><扩展名>"。
+相同内容 (转发的表情包、重复上传的头像) 只存一份，URL 永不变化，可以长期缓存。
+没有任何引用的文件由 sweep_orphans() 定期清理。
+"""
+import hashlib
+import mimetypes
+import os
+import re
+import time
+import uuid
+
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    def __init__(self, msg, status=400):
+        super().__init__(msg)
+        self.status = status
+
+
+def media_kind(content_type):
+    """'image/png' -> 'image'，用于查找大小上限"""
+    main = (content_type or '').split('/', 1)[0].lower()
+    return main if main in ('image', 'video', 'audio') else 'other'
+
+
+def guess_extension(content_type, default='.bin'):
+    return mimetypes.guess_extension((content_type or '').split(';')[0].strip()) or default
+
+
+def save_stream(stream, folder, content_type, max_bytes):
+    """
+    把 stream 分块写入 folder，返回 (文件名, 字节数, 是否命中已有文件)。
+    超过 max_bytes 抛出 UploadError(413)。
+    """
+    tmp_path = os.path.join(folder, f".upload_{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadError(f"File too large (>{max_bytes // 1024}KB)", 413)
+                digest.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            raise UploadError("Empty file")
+        file_name = f"{digest.hexdigest()}{guess_extension(content_type)}"
+        return (file_name, size) + (commit_file(tmp_path, folder, file_name),)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def commit_file(tmp_path, folder, file_name):
+    """临时文件转正。同名 (同内容) 文件已存在时丢弃临时文件，返回 True 表示去重命中"""
+    final_path = os.path.join(folder, file_name)
+    if os.path.exists(final_path):
+        os.remove(tmp_path)
+        # 刷新修改时间，避免刚被再次引用的文件在宽限期内被 GC
+        os.utime(final_path)
+        return True
+    os.replace(tmp_path, final_path)
+    return False
+
+
+def content_etag(file_name):
+    """内容寻址文件的 ETag 就是其哈希；旧的 uuid 文件名同样不会被覆盖，直接用文件名主体"""
+    return os.path.splitext(os.path.basename(file_name))[0]
+
+
+# ==========================================
+#   孤儿文件清理
+# ==========================================
+
+def find_references(paths, url_prefix):
+    """扫描文本文件 (聊天日志等) 中出现的 url_prefix/<文件名>，返回被引用的文件名集合"""
+    pattern = re.compile(re.escape(url_prefix) + rb'([A-Za-z0-9_.\-]+)')
+    found = set()
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                for line in f:
+                    if url_prefix in line:
+                        found.update(m.decode() for m in pattern.findall(line))
+        except OSError:
+            continue
+    return found
+
+
+def sweep_orphans(folder, referenced, grace_seconds=24 * 3600, dry_run=False):
+    """
+    删除 folder 中未被引用、且最近 grace_seconds 内没有被上传/命中的文件。
+    宽限期用来保护"已上传但消息还没发出"的文件。返回 (删除数, 释放字节数)。
+    """
+    now = time.time()
+    removed, freed = 0, 0
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if name in referenced or not os.path.isfile(path):
+            continue
+        st = os.stat(path)
+        if now - st.st_mtime < grace_seconds:
+            continue
+        if not dry_run:
+            os.remove(path)
+        removed += 1
+        freed += st.st_size
+    return removed, freed
@@ -0,0 +1,266 @@
+"""
+轻量级指标 (Prometheus 文本格式) 与采样分析器。
+
+    registry = Registry()
+    LAT = registry.histogram('chat_handler_seconds', 'Socket.IO 处理耗时', ('event',))
+    LAT.observe(0.003, 'client_message')
+    with LAT.time('client_message'): ...
+    registry.gauge_callback('chat_clients', '当前连接数', lambda: len(clients))
+    registry.render()   # /metrics 的响应正文
+
+开销：observe 是一次 bisect 加几次整数加法 (持有一把锁)，每个处理函数多约 1~2 微秒，
+可以在生产环境常开。没有外部依赖。
+
+SamplingProfiler 每隔 interval 秒抓一次所有线程的调用栈 (sys._current_frames)，
+按折叠栈 ("a;b;c 次数") 汇总，可直接喂给 flamegraph.pl / speedscope。
+协程模式 (eventlet / gevent) 下只能看到正在运行的那个协程的栈。
+"""
+import bisect
+import functools
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_str(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    body = ','.join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                    for k, v in pairs)
+    return '{' + body + '}'
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self.values = {}
+
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return self.header() + [f"{self.name}{_label_str(self.labels, k)} {v}" for k, v in items]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labels=(), callback=None):
+        """callback() 返回数值 (无标签) 或 {标签值元组: 数值}，在每次 render 时调用"""
+        super().__init__(name, help_text, labels)
+        self.values = {}
+        self.callback = callback
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def render(self):
+        if self.callback is not None:
+            try:
+                result = self.callback()
+            except Exception as e:
+                return self.header() + [f"# callback error: {e}"]
+            items = sorted(result.items()) if isinstance(result, dict) else [((), result)]
+        else:
+            with self.lock:
+                items = sorted(self.values.items())
+        return self.header() + [f"{self.name}{_label_str(self.labels, k)} {v}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        self.series = {}  # 标签值元组 -> [各桶计数..., +Inf 计数, 总和]
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            s = self.series.get(label_values)
+            if s is None:
+                s = self.series[label_values] = [0] * (len(self.buckets) + 2)
+            s[i] += 1
+            s[-1] += value
+
+    def time(self, *label_values):
+        return _Timer(self, label_values)
+
+    def render(self):
+        with self.lock:
+            items = sorted((k, list(v)) for k, v in self.series.items())
+        lines = self.header()
+        for key, s in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, s):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_label_str(self.labels, key, ('le', bound))} {cumulative}")
+            cumulative += s[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{_label_str(self.labels, key, ('le', '+Inf'))} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_str(self.labels, key)} {s[-1]:.6f}")
+            lines.append(f"{self.name}_count{_label_str(self.labels, key)} {cumulative}")
+        return lines
+
+    def snapshot(self):
+        """{标签值: {'count', 'sum', 'p50', 'p99'}}，分位数按桶上界估计，给管理页用"""
+        with self.lock:
+            items = [(k, list(v)) for k, v in self.series.items()]
+        out = {}
+        for key, s in items:
+            total = sum(s[:-1])
+            if not total:
+                continue
+            est = {}
+            for q in (0.5, 0.99):
+                target, acc = q * total, 0
+                for bound, n in zip(self.buckets + (float('inf'),), s):
+                    acc += n
+                    if acc >= target:
+                        est[f"p{int(q * 100)}"] = bound
+                        break
+            out['/'.join(map(str, key)) or self.name] = dict(count=total, sum=round(s[-1], 6), **est)
+        return out
+
+
+class _Timer:
+    __slots__ = ('hist', 'labels', 'started')
+
+    def __init__(self, hist, labels):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.started, *self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._add(Gauge(name, help_text, labels))
+
+    def gauge_callback(self, name, help_text, callback, labels=()):
+        return self._add(Gauge(name, help_text, labels, callback))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def render(self):
+        lines = []
+        for m in self.metrics:
+            lines.extend(m.render())
+        return '\n'.join(lines) + '\n'
+
+
+def timed(hist, *label_values):
+    """装饰器：把函数耗时记入 hist，异常同样计时"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                hist.observe(time.perf_counter() - started, *label_values)
+        return wrapper
+    return decorator
+
+
+# ==========================================
+#   采样分析器
+# ==========================================
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.lock = threading.Lock()
+        self.running = False
+        self.result = None      # 最近一次的折叠栈文本
+        self.info = {}
+
+    def start(self, seconds=10.0):
+        """后台采样 seconds 秒；已有一次在运行时返回 False"""
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+        self.info = {'started': time.strftime('%Y-%m-%d %H:%M:%S'), 'seconds': seconds, 'samples': 0}
+        threading.Thread(target=self._run, args=(seconds,), name='sampling-profiler', daemon=True).start()
+        return True
+
+    def _stack(self, frame):
+        parts = []
+        while frame is not None and len(parts) < self.max_depth:
+            code = frame.f_code
+            parts.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(parts))
+
+    def _run(self, seconds):
+        me = threading.get_ident()
+        tally = _Tally()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident != me:
+                        tally[self._stack(frame)] += 1
+                samples += 1
+                time.sleep(self.interval)
+        finally:
+            self.result = '\n'.join(f"{stack} {n}" for stack, n in tally.most_common())
+            self.info.update(samples=samples, finished=time.strftime('%Y-%m-%d %H:%M:%S'))
+            with self.lock:
+                self.running = False
+
+    def top(self, n=30):
+        """按叶子函数 (自身耗时) 汇总的前 n 项，给管理页直接显示"""
+        if not self.result:
+            return []
+        leaf = _Tally()
+        for line in self.result.splitlines():
+            stack, count = line.rsplit(' ', 1)
+            leaf[stack.rsplit(';', 1)[-1]] += int(count)
+        total = sum(leaf.values()) or 1
+        return [{'frame': f, 'samples': c, 'percent': round(c * 100 / total, 1)} for f, c in leaf.most_common(n)]
@@ -0,0 +1,90 @@
+"""
+离线收件箱：发给不在线用户的私聊消息先存在这里，登录成功时一次性取出。
+
+原来对方不在线时私聊只写日志，重新连上后客户端要把整个会话的历史重拉一遍才能找到错过的消息。
+现在服务器按收件人存一份 (SQLite，多个进程可共用同一个文件)，登录时用一个 receive_messages 事件发完，
+同时给出每个会话的未读数。
+
+- 每个用户最多保留 max_per_user 条，超出时丢最旧的并记下丢了多少 (dropped)，客户端据此改为拉历史
+- 超过 max_age 秒未取的消息在写入时顺带清理
+- 会话 key 与客户端一致：私聊为对方 uid
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+PURGE_EVERY = 1000  # 每写入这么多条清理一次过期消息
+
+
+class OfflineInbox:
+    def __init__(self, path, max_per_user=500, max_age=30 * 86400):
+        self.path = path
+        self.max_per_user = max_per_user
+        self.max_age = max_age
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS inbox (
+                id INTEGER PRIMARY KEY, uid TEXT NOT NULL, conversation TEXT NOT NULL,
+                body TEXT NOT NULL, created REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS inbox_uid ON inbox (uid, id);
+            CREATE TABLE IF NOT EXISTS inbox_dropped (uid TEXT PRIMARY KEY, dropped INTEGER NOT NULL);
+        ''')
+        self.conn.commit()
+        self.lock = threading.Lock()
+        self.pushed = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def push(self, uid, conversation, msg):
+        """存入一条发给 uid 的消息"""
+        uid = str(uid)
+        now = time.time()
+        with self.lock:
+            with self.conn:
+                self.conn.execute('INSERT INTO inbox (uid, conversation, body, created) VALUES (?, ?, ?, ?)',
+                                  (uid, str(conversation), json.dumps(msg, ensure_ascii=False), now))
+                cur = self.conn.execute(
+                    'DELETE FROM inbox WHERE uid = ? AND id <= '
+                    '(SELECT id FROM inbox WHERE uid = ? ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                    (uid, uid, self.max_per_user))
+                if cur.rowcount > 0:
+                    self.conn.execute('INSERT INTO inbox_dropped VALUES (?, ?) '
+                                      'ON CONFLICT (uid) DO UPDATE SET dropped = dropped + excluded.dropped',
+                                      (uid, cur.rowcount))
+                    self.dropped += cur.rowcount
+                self.pushed += 1
+                if self.pushed % PURGE_EVERY == 0:
+                    self.conn.execute('DELETE FROM inbox WHERE created < ?', (now - self.max_age,))
+
+    def drain(self, uid):
+        """
+        取出并删除 uid 的全部离线消息。
+        返回 {'messages': [...按时间正序], 'unread': {会话: 条数}, 'dropped': 因超出上限被丢弃的条数}
+        """
+        uid = str(uid)
+        with self.lock:
+            with self.conn:
+                rows = self.conn.execute('SELECT conversation, body FROM inbox WHERE uid = ? ORDER BY id',
+                                         (uid,)).fetchall()
+                dropped = self.conn.execute('SELECT dropped FROM inbox_dropped WHERE uid = ?', (uid,)).fetchone()
+                if rows:
+                    self.conn.execute('DELETE FROM inbox WHERE uid = ?', (uid,))
+                if dropped:
+                    self.conn.execute('DELETE FROM inbox_dropped WHERE uid = ?', (uid,))
+            self.delivered += len(rows)
+        unread = {}
+        for conversation, _ in rows:
+            unread[conversation] = unread.get(conversation, 0) + 1
+        return {'messages': [json.loads(body) for _, body in rows], 'unread': unread,
+                'dropped': dropped[0] if dropped else 0}
+
+    def stats(self):
+        with self.lock:
+            pending, users = self.conn.execute('SELECT COUNT(*), COUNT(DISTINCT uid) FROM inbox').fetchone()
+        return {'pending': pending, 'users': users, 'pushed': self.pushed, 'delivered': self.delivered,
+                'dropped': self.dropped,
+                'db_bytes': sum(os.path.getsize(p) for p in (self.path, self.path + '-wal') if os.path.exists(p))}
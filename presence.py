@@ -0,0 +1,232 @@
+"""
+在线状态 (presence) 的增量广播。
+
+原来每次连接 / 断开 / 登录 / 改资料都把完整在线列表发给 global_chat 的每个人，
+一波 n 个用户登录就是 O(n²) 条目 (每次 n 条 x n 个接收者，共 n 次)。
+现在只广播变化量：
+
+    {'version': 42, 'joins': [{uid, username, avatar}, ...],
+     'updates': [{uid, username, avatar}, ...], 'leaves': [uid, ...]}
+
+- 变化先记为"脏 uid"，debounce 秒后合并成一个 delta 发出，版本号 +1。
+  同一窗口内登录又断开的用户不会出现在 delta 里，1000 个客户端在重启后
+  集中重连也只产生少数几个 delta。
+- 客户端保存最近的 version，收到的 delta 版本不连续时发 request_presence_snapshot
+  取完整快照 (快照与 delta 使用同一份"已发布"状态，版本号一致)。
+- 按 uid 计数：同一用户多个连接时，只有最后一个断开才算离线。
+- 资料、已发布状态和版本号都放在 shared_state 存储里，多进程部署时
+  各进程共用一套 (版本号由存储原子递增)。不同进程的 delta 可能乱序到达，
+  客户端按版本不连续处理 (重新取快照)。
+- 连接数按进程分开记 (presence_conn:<worker>，只由该进程写)，进程每 heartbeat 秒
+  在 presence_workers 里续一次期 (TTL 为 worker_ttl)。start() 时先清掉本进程上次留下的记录；
+  其他进程发现某个进程的心跳过期 (崩溃 / 被杀) 就清掉它的记录，那些用户随之下线。
+  在线判断最多晚 worker_ttl 秒反映进程崩溃。
+"""
+import threading
+import time
+
+from shared_state import LocalStateStore
+
+# 始终在线的管理员条目，放在快照里，不参与增量
+ADMIN_ENTRY = {'username': 'Admin', 'uid': 'ADMIN', 'avatar': ''}
+
+
+class PresenceTracker:
+    def __init__(self, publish, debounce=0.25, start_task=None, sleep=time.sleep, store=None,
+                 make_lock=threading.Lock, worker_id='0', heartbeat=10.0, worker_ttl=30.0):
+        """
+        publish(delta) 在合并窗口结束时调用 (后台任务中)。
+        start_task(fn) 用于启动后台任务，默认新开线程；服务器传 socketio.start_background_task。
+        store: shared_state 存储，默认进程内。
+        make_lock: 两把锁持有期间都会读写 store (Redis 时是网络 I/O)，协程模式下须传 runtime.make_lock
+        """
+        self.publish = publish
+        self.debounce = debounce
+        self.start_task = start_task or (lambda fn: threading.Thread(target=fn, daemon=True).start())
+        self.sleep = sleep
+        self.store = store or LocalStateStore()
+
+        self.lock = make_lock()
+        self.publish_lock = make_lock()  # 保证本进程的 delta 按版本号顺序发出
+        self.sids = {}        # sid -> uid (只含本进程的连接)
+        self.counts = {}      # uid -> 本进程上的连接数
+        self.infos = {}       # uid -> info (本进程上在线的用户，心跳时补写)
+        self.dirty = set()
+        self.flush_pending = False
+        self.worker_id = str(worker_id)
+        self.conn_ns = f"presence_conn:{self.worker_id}"
+        self.heartbeat = heartbeat
+        self.worker_ttl = worker_ttl
+        self.purged = 0
+        # 共享存储中的名字空间：
+        #   presence_conn:<worker> uid -> 该进程上的连接数 (只由该进程写)
+        #   presence_workers       worker -> 最近一次心跳 (带 TTL，过期即视为进程已死)
+        #   presence_known         worker -> 1 (出现过的进程，用来发现心跳过期的)
+        #   presence_info          uid -> {uid, username, avatar} (实时)
+        #   presence_pub           uid -> info (已通过 delta 发布的状态，快照用)
+        #   presence (计数器)      version
+
+        self.deltas = 0
+        self.entries = 0
+
+    # ---------- 状态变化 ----------
+
+    def online(self, sid, uid, username, avatar=''):
+        with self.lock:
+            old_uid = self.sids.get(sid)
+            if old_uid == uid:
+                return self._set_info(uid, username, avatar)
+            if old_uid is not None:
+                self._release(sid)
+            self.sids[sid] = uid
+            self.counts[uid] = self.counts.get(uid, 0) + 1
+            self.store.set(self.conn_ns, uid, self.counts[uid])
+            self._set_info(uid, username, avatar)
+
+    def offline(self, sid):
+        with self.lock:
+            if sid in self.sids:
+                self._release(sid)
+
+    def update(self, uid, username, avatar=''):
+        with self.lock:
+            if self.is_online(uid):
+                self._set_info(uid, username, avatar)
+
+    def _set_info(self, uid, username, avatar):
+        info = {'uid': uid, 'username': username, 'avatar': avatar or ''}
+        if uid in self.counts:
+            self.infos[uid] = info
+        if self.store.get('presence_info', uid) != info:
+            self.store.set('presence_info', uid, info)
+            self._mark(uid)
+
+    def _release(self, sid):
+        uid = self.sids.pop(sid)
+        left = self.counts.get(uid, 1) - 1
+        if left > 0:
+            self.counts[uid] = left
+            self.store.set(self.conn_ns, uid, left)
+            return
+        self.counts.pop(uid, None)
+        self.infos.pop(uid, None)
+        self.store.delete(self.conn_ns, uid)
+        # 与其他进程并发上线时可能误删对方刚写的资料，对方下次心跳会补回
+        if not self.is_online(uid):
+            self.store.delete('presence_info', uid)
+            self._mark(uid)
+
+    def _mark(self, uid):
+        self.dirty.add(uid)
+        if not self.flush_pending:
+            self.flush_pending = True
+            self.start_task(self._delayed_flush)
+
+    # ---------- 进程心跳 ----------
+
+    def start(self):
+        """清掉本进程上次 (崩溃前) 留下的连接记录，开始心跳"""
+        with self.lock:
+            self._purge_worker(self.worker_id)
+            self._beat()
+        self.start_task(self._heartbeat_loop)
+
+    def _heartbeat_loop(self):
+        while True:
+            self.sleep(self.heartbeat)
+            try:
+                with self.lock:
+                    self._beat()
+            except Exception as e:
+                print(f"[PRESENCE ERROR] heartbeat: {e}")
+
+    def _beat(self):
+        self.store.set('presence_workers', self.worker_id, time.time(), ttl=self.worker_ttl)
+        self.store.set('presence_known', self.worker_id, 1)
+        # 补写本进程的连接与资料 (被其他进程清理或误删过也能恢复)
+        for uid, n in self.counts.items():
+            self.store.set(self.conn_ns, uid, n)
+            if uid in self.infos and self.store.get('presence_info', uid) != self.infos[uid]:
+                self.store.set('presence_info', uid, self.infos[uid])
+                self._mark(uid)
+        alive = self.store.items('presence_workers')
+        for worker in self.store.items('presence_known'):
+            if worker not in alive and worker != self.worker_id:
+                print(f"[PRESENCE] worker {worker} missed its heartbeat, clearing its connections")
+                self._purge_worker(worker)
+
+    def _purge_worker(self, worker):
+        ns = f"presence_conn:{worker}"
+        uids = list(self.store.items(ns))
+        for uid in uids:
+            self.store.delete(ns, uid)
+        self.store.delete('presence_known', worker)
+        for uid in uids:
+            if not self.is_online(uid):
+                self.store.delete('presence_info', uid)
+                self._mark(uid)
+        self.purged += len(uids)
+
+    # ---------- 合并与发布 ----------
+
+    def _delayed_flush(self):
+        self.sleep(self.debounce)
+        self.flush()
+
+    def flush(self):
+        """把窗口内的变化合并为一个 delta 发布，没有净变化时不发"""
+        with self.publish_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self.lock:
+            self.flush_pending = False
+            joins, updates, leaves = [], [], []
+            for uid in self.dirty:
+                now = self.store.get('presence_info', uid)
+                before = self.store.get('presence_pub', uid)
+                if now is not None and before is None:
+                    joins.append(now)
+                elif now is None and before is not None:
+                    leaves.append(uid)
+                elif now != before:
+                    updates.append(now)
+                if now is None:
+                    self.store.delete('presence_pub', uid)
+                else:
+                    self.store.set('presence_pub', uid, now)
+            self.dirty.clear()
+            if not (joins or updates or leaves):
+                return None
+            version = self.store.incr('presence', 'version')
+            delta = {'version': version, 'joins': joins, 'updates': updates, 'leaves': leaves}
+            self.deltas += 1
+            self.entries += len(joins) + len(updates) + len(leaves)
+        try:
+            self.publish(delta)
+        except Exception as e:
+            print(f"[PRESENCE ERROR] {e}")
+        return delta
+
+    # ---------- 查询 ----------
+
+    def snapshot(self):
+        """与 delta 同一版本序列的完整在线列表"""
+        # 先取版本再取列表：列表只可能比版本号更新，客户端随后收到的旧 delta 会被忽略或触发重取
+        version = self.store.counter('presence', 'version')
+        users = list(self.store.items('presence_pub').values())
+        return {'version': version, 'users': users + [ADMIN_ENTRY]}
+
+    def is_online(self, uid):
+        """uid 是否有连接在任意一个 (心跳未过期的) 服务器进程上"""
+        if uid in self.counts:
+            return True
+        return any(self.store.get(f"presence_conn:{worker}", uid)
+                   for worker in self.store.items('presence_workers') if worker != self.worker_id)
+
+    def stats(self):
+        with self.lock:
+            return {'online_users': len(self.store.items('presence_pub')), 'connections': len(self.sids),
+                    'version': self.store.counter('presence', 'version'),
+                    'deltas': self.deltas, 'delta_entries': self.entries, 'pending': len(self.dirty),
+                    'purged_connections': self.purged}
@@ -0,0 +1,103 @@
+"""
+令牌桶限流。
+
+每个 (类别, 键) 一个桶，键可以是 sid (单个连接)、uid (同一用户的所有连接) 或 IP。
+一次请求要同时通过它涉及的所有桶 (例如某个 sid 和它的 uid)，任何一个桶不够就拒绝，
+且拒绝时不扣任何桶的令牌。
+
+    limiter = RateLimiter({'message': (5, 20)})        # 每秒 5 个，最多攒 20 个
+    ok, retry_after = limiter.allow('message', 'sid:abc', 'uid:123')
+
+长时间不用且已攒满的桶会被定期清理，内存只和活跃的键数量有关。
+多进程部署时每个进程各算各的 (uid 的实际上限是 进程数 x 配额)。
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, cost):
+        """还差多少秒才能拿到 cost 个令牌"""
+        if self.tokens >= cost:
+            return 0.0
+        if self.rate <= 0:
+            return float('inf')
+        return (cost - self.tokens) / self.rate
+
+
+class RateLimiter:
+    def __init__(self, budgets, sweep_interval=60.0, clock=time.monotonic):
+        """budgets: {类别: (每秒令牌数, 桶容量)}"""
+        self.budgets = dict(budgets)
+        self.clock = clock
+        self.sweep_interval = sweep_interval
+        self.buckets = {}  # 键 -> {类别: TokenBucket}
+        self.lock = threading.Lock()
+        self.last_sweep = clock()
+        self.allowed = {}
+        self.denied = {}
+
+    def allow(self, category, *keys, cost=1):
+        """返回 (是否放行, 需要等待的秒数)。keys 为空或类别未配置时总是放行"""
+        budget = self.budgets.get(category)
+        if budget is None or not keys:
+            return True, 0.0
+        now = self.clock()
+        with self.lock:
+            buckets = []
+            for key in keys:
+                if key is None:
+                    continue
+                slot = self.buckets.setdefault(key, {})
+                b = slot.get(category)
+                if b is None:
+                    b = slot[category] = TokenBucket(budget[0], budget[1], now)
+                else:
+                    b.refill(now)
+                buckets.append(b)
+            wait = max((b.wait_time(cost) for b in buckets), default=0.0)
+            if wait > 0:
+                self.denied[category] = self.denied.get(category, 0) + 1
+                return False, wait
+            for b in buckets:
+                b.tokens -= cost
+            self.allowed[category] = self.allowed.get(category, 0) + 1
+            if now - self.last_sweep > self.sweep_interval:
+                self._sweep(now)
+            return True, 0.0
+
+    def forget(self, key):
+        """连接断开时丢掉该键的所有桶"""
+        with self.lock:
+            self.buckets.pop(key, None)
+
+    def _sweep(self, now):
+        self.last_sweep = now
+        for key, slot in list(self.buckets.items()):
+            for category, b in list(slot.items()):
+                b.refill(now)
+                if b.tokens >= b.burst:
+                    del slot[category]
+            if not slot:
+                del self.buckets[key]
+
+    def stats(self):
+        with self.lock:
+            out = {'keys': len(self.buckets)}
+            for category in self.budgets:
+                out[f"{category}_allowed"] = self.allowed.get(category, 0)
+                out[f"{category}_denied"] = self.denied.get(category, 0)
+            return out
@@ -0,0 +1,141 @@
+"""
+服务器运行模式 (并发引擎) 选择。
+
+    threading  Werkzeug 开发服务器，每个长连接占一个系统线程，适合开发调试 (默认)
+    eventlet   协程 + eventlet.wsgi，单进程可保持上万空闲 WebSocket 连接
+    gevent     协程 + gevent WSGIServer (WebSocket 用 gevent-websocket，未安装时用 simple-websocket)
+
+通过环境变量 CHAT_ASYNC_MODE 或命令行参数 --async-mode=<模式> 选择。
+setup() 必须在导入 flask / socketio / requests 之前调用，因为协程模式需要先打猴子补丁。
+
+协程模式下只给网络相关模块打补丁，threading 和 queue 保持原生：
+日志写线程、缩略图任务等仍在真正的系统线程里跑，磁盘 I/O 不会卡住事件循环。
+处理函数里其余会读写磁盘的调用 (历史回读、用户库写入、媒体 GC) 通过 run_blocking() 交给线程池执行，
+事件循环在等待期间继续处理其他连接。注意：协程模式下不要在原生线程里直接 socketio.emit。
+
+原生线程 (run_blocking、日志写线程、采样线程) 会碰到的同步原语，
+在 eventlet.monkey_patch(thread=False) / gevent patch_all(thread=False, queue=False) 下：
+
+    queue.Queue / SimpleQueue  gevent 默认会把它换成协程队列，原生线程在上面等待会 LoopExit
+                               或 "Can only use Waiter.switch method from the Hub greenlet"，
+                               所以打补丁时传 queue=False (eventlet 本来就不替换 queue)。
+                               log_writer 的队列、ThreadPoolExecutor 的任务队列因此保持原生。
+    ThreadPoolExecutor         协程模式下不用，后台任务池统一用 make_executor() (缩略图)。
+    threading.Lock / RLock     保持原生。各模块的进程内锁 (history_cache、chunked_upload、
+                               offline_inbox、search_index、user_store、session_tokens、rate_limit、
+                               admin_monitor、shared_state 进程内存储) 持有期间只做内存操作或本地
+                               磁盘 I/O，不会让出事件循环；协程等锁最多短暂阻塞，不会死锁。
+                               持有期间会做网络 I/O 并且只在协程里用的锁用 make_lock() (presence)。
+                               session_tokens 持锁读写 Redis 的 _save_revocations 只经 run_blocking 调用，
+                               网络 I/O 在原生线程自己的 hub 上完成。
+    threading.Event            保持原生 (thread=False 时 Event 不打补丁)。日志写线程的 flush 标记、
+                               history_cache 预热等待都在原生线程里 wait()。
+    time.sleep                 会被替换成协程 sleep，在原生线程里调用时用该线程自己的 hub，
+                               效果仍是普通休眠 (采样线程、load_secret 的重试)。
+"""
+import os
+import sys
+import threading
+
+ASYNC_MODES = ('threading', 'eventlet', 'gevent')
+MODE = 'threading'
+
+
+def requested_mode(argv=None, environ=None):
+    argv = sys.argv if argv is None else argv
+    environ = os.environ if environ is None else environ
+    mode = environ.get('CHAT_ASYNC_MODE', 'threading')
+    for arg in argv[1:]:
+        if arg.startswith('--async-mode='):
+            mode = arg.split('=', 1)[1]
+    if mode not in ASYNC_MODES:
+        raise SystemExit(f"Unknown async mode {mode!r}, choose from {ASYNC_MODES}")
+    return mode
+
+
+def setup(mode=None):
+    """选择并初始化运行模式，返回实际使用的模式名 (传给 SocketIO 的 async_mode)"""
+    global MODE
+    mode = mode or requested_mode()
+    if mode == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch(thread=False)
+    elif mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all(thread=False, queue=False)
+    MODE = mode
+    return mode
+
+
+def run_blocking(fn, *args, **kwargs):
+    """在原生线程池中执行会阻塞的函数并等待结果；threading 模式下直接调用"""
+    if MODE == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute(fn, *args, **kwargs)
+    if MODE == 'gevent':
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+    return fn(*args, **kwargs)
+
+
+class _GreenExecutor:
+    """协程模式下的后台任务池：协程排队，任务本身经 run_blocking 在原生线程池执行，最多 workers 个同时运行"""
+
+    def __init__(self, workers):
+        if MODE == 'eventlet':
+            import eventlet
+            from eventlet.semaphore import Semaphore
+            self._spawn = eventlet.spawn_n
+        else:
+            import gevent
+            from gevent.lock import Semaphore
+            self._spawn = gevent.spawn
+        self.slots = Semaphore(workers)
+
+    def submit(self, fn, *args, **kwargs):
+        self._spawn(self._run, fn, args, kwargs)
+
+    def _run(self, fn, args, kwargs):
+        with self.slots:
+            run_blocking(fn, *args, **kwargs)
+
+
+def make_executor(workers, name):
+    """
+    提交后不等待结果的后台任务池 (只用 submit)。threading 模式下就是 ThreadPoolExecutor；
+    协程模式下任务经 run_blocking 交给 hub 线程池 / eventlet tpool，不另开一组线程
+    (gevent 替换 queue 时 ThreadPoolExecutor 的工作线程会 LoopExit，见模块说明)。
+    submit() 只能在处理函数 / 后台任务里调用。
+    """
+    if MODE == 'threading':
+        from concurrent.futures import ThreadPoolExecutor
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+    return _GreenExecutor(workers)
+
+
+def make_lock():
+    """
+    持有期间会做网络 I/O (如 Redis) 的锁。协程模式下网络 I/O 会让出事件循环，
+    原生 threading.Lock 被另一个协程等待时会卡住整个事件循环 (死锁)，因此改用协程锁。
+    只能在处理函数 / 后台任务里使用，不要在原生线程 (run_blocking、日志写线程) 里获取。
+    """
+    if MODE == 'eventlet':
+        from eventlet.semaphore import Semaphore
+        return Semaphore(1)
+    if MODE == 'gevent':
+        from gevent.lock import Semaphore
+        return Semaphore(1)
+    return threading.Lock()
+
+
+def run_kwargs(max_connections=20000):
+    """
+    socketio.run() 的额外参数：开发服务器需要 allow_unsafe_werkzeug；
+    eventlet.wsgi 默认最多 1024 个并发请求 (每个 WebSocket 长连接占一个)，需要调大。
+    实际上限还受进程文件描述符数 (ulimit -n) 限制。
+    """
+    if MODE == 'threading':
+        return {'allow_unsafe_werkzeug': True}
+    if MODE == 'eventlet':
+        return {'max_size': max_connections}
+    return {}
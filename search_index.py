@@ -0,0 +1,192 @@
+"""
+聊天记录全文检索 (SQLite FTS5)。
+
+- 由 log_writer 的 listeners 在每批日志写盘后增量写入，与 append_to_chat_log 走同一条路径
+- 中日韩文字没有空格分词：连续的 CJK 字符切成相邻二字组 (bigram)，
+  并额外保留每段的最后一个字，单字查询用前缀匹配 ("饭" -> 饭*) 也能命中；其它文字交给 unicode61 分词
+- 多词查询为 AND，CJK 片段按二字组短语匹配；结果按 bm25 排序，同分时新消息在前
+- messages 表按内容摘要去重，历史回填与实时写入重叠时不会出现重复结果
+- room_members 记录每个私聊房间的两个 uid，用户只能搜 global_chat 和自己参与的私聊
+
+只索引文本消息 (图片 / 视频的内容只是 URL)。
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# 汉字 (含扩展 A 与兼容区)、日文假名、韩文音节
+_CJK = '぀-ヿ㐀-䶿一-鿿가-힯豈-﫿'
+_SEGMENT = re.compile(f'([{_CJK}]+)|([^{_CJK}]+)')
+_WORD = re.compile(f'[^\\W_{_CJK}]+')
+GLOBAL_ROOM = 'global_chat'
+MAX_PAGE = 50
+
+
+def tokenize(text):
+    """文档分词：CJK 片段 -> 二字组 + 末字，其余原样交给 unicode61"""
+    out = []
+    for cjk, other in _SEGMENT.findall(text or ''):
+        if cjk:
+            out.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+            out.append(cjk[-1])
+        else:
+            out.append(other)
+    return ' '.join(out)
+
+
+def build_query(text):
+    """把用户输入转成 FTS5 查询 (每一项都加引号，输入里的运算符不会生效)；没有可查的词时返回 None"""
+    terms = []
+    for cjk, other in _SEGMENT.findall(text or ''):
+        if cjk:
+            if len(cjk) == 1:
+                terms.append(f'"{cjk}"*')
+            else:
+                terms.append('"' + ' '.join(cjk[i:i + 2] for i in range(len(cjk) - 1)) + '"')
+        else:
+            terms.extend(f'"{w}"' for w in _WORD.findall(other))
+    return ' AND '.join(terms) if terms else None
+
+
+class SearchIndex:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY, digest BLOB NOT NULL UNIQUE, room TEXT NOT NULL, ts TEXT,
+                sender TEXT, uid TEXT, target_uid TEXT, content TEXT);
+            CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+                body, content='', tokenize='unicode61 remove_diacritics 2');
+            CREATE TABLE IF NOT EXISTS room_members (
+                uid TEXT NOT NULL, room TEXT NOT NULL, PRIMARY KEY (uid, room)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        ''')
+        self.conn.commit()
+        self.lock = threading.Lock()
+        self.indexed = 0
+        self.searches = 0
+        self.total_search_ms = 0.0
+        self.max_search_ms = 0.0
+
+    # ---------- 写入 ----------
+
+    def add_batch(self, batch):
+        """batch: [(room_key, entry), ...]，即 ChatLogWriter 的 listener 参数"""
+        rows = []
+        for room, entry in batch:
+            if entry.get('type', 'text') != 'text' or not entry.get('content'):
+                continue
+            content = str(entry['content'])
+            key = '\x00'.join((room, str(entry.get('timestamp', '')), str(entry.get('uid', '')), content))
+            rows.append((hashlib.blake2b(key.encode('utf-8'), digest_size=12).digest(), room,
+                         entry.get('timestamp'), entry.get('sender'), entry.get('uid'),
+                         entry.get('target_uid'), content))
+        if not rows:
+            return 0
+        added = 0
+        with self.lock:
+            with self.conn:
+                for row in rows:
+                    cur = self.conn.execute(
+                        'INSERT OR IGNORE INTO messages (digest, room, ts, sender, uid, target_uid, content) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)', row)
+                    if not cur.rowcount:
+                        continue
+                    self.conn.execute('INSERT INTO message_fts (rowid, body) VALUES (?, ?)',
+                                      (cur.lastrowid, tokenize(row[6])))
+                    added += 1
+                    room = row[1]
+                    if room != GLOBAL_ROOM:
+                        for uid in (row[4], row[5]):
+                            if uid is not None:
+                                self.conn.execute('INSERT OR IGNORE INTO room_members VALUES (?, ?)', (str(uid), room))
+        self.indexed += added
+        return added
+
+    def backfill(self, logs_dir, batch_size=2000):
+        """
+        把 logs_dir 下已有的日志 (含 .logz 归档) 全部补进索引，完成后记一个标记，以后启动不再重复。
+        与实时写入同时进行也没关系 (按摘要去重)。返回补入的条数。
+        """
+        import history_reader  # 只有回填时需要
+        if self.get_meta('backfilled'):
+            return 0
+        added = 0
+        for room in sorted(os.listdir(logs_dir)) if os.path.isdir(logs_dir) else []:
+            folder = os.path.join(logs_dir, room)
+            if not os.path.isdir(folder):
+                continue
+            for filename in history_reader.list_log_files(folder):
+                batch = []
+                for _, msg in history_reader.iter_day_reverse(os.path.join(folder, filename)):
+                    batch.append((room, msg))
+                    if len(batch) >= batch_size:
+                        added += self.add_batch(batch)
+                        batch = []
+                added += self.add_batch(batch)
+        self.set_meta('backfilled', time.strftime('%Y-%m-%d %H:%M:%S'))
+        return added
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock:
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    # ---------- 查询 ----------
+
+    def search(self, text, uid=None, room=None, offset=0, limit=20):
+        """
+        uid 不为 None 时只搜 global_chat 与该用户参与的私聊 (普通用户)；为 None 时不限 (管理员)。
+        room 可进一步限定到某一个房间。返回 {'results', 'offset', 'next_offset', 'took_ms'}。
+        """
+        started = time.perf_counter()
+        query = build_query(text)
+        limit = max(1, min(int(limit), MAX_PAGE))
+        offset = max(0, int(offset))
+        results = []
+        if query:
+            sql = ('SELECT m.room, m.ts, m.sender, m.uid, m.target_uid, m.content FROM message_fts '
+                   'JOIN messages m ON m.id = message_fts.rowid WHERE message_fts MATCH ?')
+            args = [query]
+            if uid is not None:
+                sql += ' AND (m.room = ? OR m.room IN (SELECT room FROM room_members WHERE uid = ?))'
+                args += [GLOBAL_ROOM, str(uid)]
+            if room:
+                sql += ' AND m.room = ?'
+                args.append(room)
+            sql += ' ORDER BY message_fts.rank, m.ts DESC LIMIT ? OFFSET ?'
+            args += [limit + 1, offset]
+            with self.lock:
+                rows = self.conn.execute(sql, args).fetchall()
+            results = [{'room': r[0], 'timestamp': r[1], 'sender': r[2], 'uid': r[3], 'target_uid': r[4],
+                        'content': r[5], 'type': 'text'} for r in rows]
+        more = len(results) > limit
+        took = (time.perf_counter() - started) * 1000
+        self.searches += 1
+        self.total_search_ms += took
+        self.max_search_ms = max(self.max_search_ms, took)
+        return {'results': results[:limit], 'offset': offset,
+                'next_offset': offset + limit if more else None, 'took_ms': round(took, 2)}
+
+    def stats(self):
+        with self.lock:
+            total = self.conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+        return {
+            'messages': total,
+            'indexed_since_start': self.indexed,
+            'searches': self.searches,
+            'avg_search_ms': round(self.total_search_ms / self.searches, 2) if self.searches else 0.0,
+            'max_search_ms': round(self.max_search_ms, 2),
+            'db_bytes': sum(os.path.getsize(p) for p in (self.path, self.path + '-wal') if os.path.exists(p)),
+        }
@@ -1,25 +1,46 @@
+# 运行模式必须最先确定：eventlet / gevent 要在导入网络相关模块之前打补丁 (见 runtime.py)
+import runtime
+ASYNC_MODE = runtime.setup()
+MAX_CONNECTIONS = 20000  # 协程模式下单进程的连接上限，同时需要 ulimit -n 足够大
+
 import string
 import random
-import webbrowser
 import csv
 import os
-import sys
 import time
-import socket
-import requests
-import json
-import base64
-import uuid
 import datetime
-import mimetypes
-from threading import Timer, Thread
-from flask import Flask, render_template, request, redirect, send_from_directory, jsonify
+import atexit
+import shutil
+import inspect
+import functools
+import hmac
+from threading import Timer
+from flask import Flask, render_template, request, redirect, send_from_directory, jsonify, make_response
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from pyngrok import ngrok, conf
+import user_store
+import history_reader
+from log_writer import ChatLogWriter
+from history_cache import RoomHistoryCache
+import media_store
+import thumbnails
+from thumbnails import ThumbnailService
+from chunked_upload import ChunkedUploadManager
+from presence import PresenceTracker
+import shared_state
+import metrics
+from rate_limit import RateLimiter
+import wire_format
+import log_archive
+from search_index import SearchIndex
+from offline_inbox import OfflineInbox
+from session_tokens import SessionTokens, load_secret
+from admin_monitor import AdminMonitor
+from tunnel import TunnelManager
 
 # --- 配置存储路径 ---
+# CHAT_STORAGE_ROOT 可把全部数据 (日志、媒体、用户库、密钥) 放到别处，压测脚本用它指向临时目录
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-STORAGE_ROOT = os.path.join(BASE_DIR, 'server_storage')
+STORAGE_ROOT = os.path.abspath(os.environ.get('CHAT_STORAGE_ROOT') or os.path.join(BASE_DIR, 'server_storage'))
 MEDIA_DIR = os.path.join(STORAGE_ROOT, 'media')
 AVATAR_DIR = os.path.join(STORAGE_ROOT, 'avatars')
 LOGS_DIR = os.path.join(STORAGE_ROOT, 'chat_logs')
@@ -34,6 +55,12 @@ for d in [STORAGE_ROOT, MEDIA_DIR, AVATAR_DIR, LOGS_DIR]:
 NGROK_TOKEN = "XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX"
 JSON_BIN_ID = "b45083904e075c083709"
 JSON_BIN_URL = f"https://api.npoint.io/{JSON_BIN_ID}"
+# 隧道与地址发布 (见 tunnel.py)：
+#   background  先监听端口，隧道在后台建立，失败自动重试 (默认)
+#   blocking    启动前先同步尝试一次 (旧行为)，失败后同样转入后台重试
+#   off         只在局域网内使用
+TUNNEL_MODE = os.environ.get('CHAT_TUNNEL', 'background')
+OPEN_BROWSER = os.environ.get('CHAT_OPEN_BROWSER', '1') != '0'
 
 # 扩大 CSV 字段限制
 csv.field_size_limit(100 * 1024 * 1024)
@@ -42,80 +69,299 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = 'real_server_secret_key'
 app.config['MAX_CONTENT_LENGTH'] = 130 * 1024 * 1024  # Flask上传限制
 
+# 各类上传的大小上限 (字节)，按 Content-Type 的主类型区分。
+# 大文件请走 /api/upload/chunked/* 分块上传，单次请求仍受 MAX_CONTENT_LENGTH 限制
+UPLOAD_LIMITS = {
+    'avatar': 2 * 1024 * 1024,
+    'image': 20 * 1024 * 1024,
+    'video': 512 * 1024 * 1024,
+    'audio': 64 * 1024 * 1024,
+    'other': 128 * 1024 * 1024,
+}
+
+# ==========================================
+#   多进程部署 (可选)
+# ==========================================
+# 多个服务器进程 (可在不同机器上) 通过消息队列互相转发房间广播，
+# 登录 Token / 验证码 / 在线状态放进共享存储。两项都为空时即原来的单进程模式；
+# 设置了消息队列就必须同时设置共享存储，否则各进程的状态互不可见，启动时直接报错。
+#   CHAT_MESSAGE_QUEUE=redis://127.0.0.1:6379/0  Socket.IO 跨进程广播
+#   CHAT_STATE_STORE=redis://127.0.0.1:6379/0    共享状态 (见 shared_state.py)
+# 负载均衡需要按客户端做会话粘滞 (如 nginx ip_hash)，同一连接的轮询请求与分块上传必须落在同一进程。
+MESSAGE_QUEUE = os.environ.get('CHAT_MESSAGE_QUEUE') or None
+STATE_STORE_URL = os.environ.get('CHAT_STATE_STORE') or None
+MULTI_WORKER = bool(MESSAGE_QUEUE)
+if MULTI_WORKER and (not STATE_STORE_URL or STATE_STORE_URL == 'local'):
+    raise RuntimeError('CHAT_MESSAGE_QUEUE is set but CHAT_STATE_STORE is not: multi-worker mode needs a shared '
+                       'state store (e.g. CHAT_STATE_STORE=redis://127.0.0.1:6379/0)')
+WORKER_ID = os.environ.get('CHAT_WORKER_ID', '0')
+SERVER_PORT = int(os.environ.get('CHAT_PORT', 5005))
+# 管理接口 (/admin 页面、/admin/* 路由、管理端 Socket 事件) 只对本机直连开放；
+# 经隧道 / 反向代理进来的请求需带 CHAT_ADMIN_SECRET (?admin_secret=... 或 X-Admin-Secret 头，
+# 带参数打开管理页后写入 Cookie)，未设置时远程一律拒绝
+ADMIN_SECRET = os.environ.get('CHAT_ADMIN_SECRET') or None
+ADMIN_COOKIE = 'chat_admin'
+state_store = shared_state.open_state_store(STATE_STORE_URL)
+
+# 文件一律走 HTTP 流式上传 (/api/upload/<kind>)，Socket 只传文本和 URL，缓冲上限 1MB 足够
 socketio = SocketIO(app,
+                    message_queue=MESSAGE_QUEUE,
                     cors_allowed_origins="*",
-                    async_mode='threading',
-                    max_http_buffer_size=209715200,
+                    async_mode=ASYNC_MODE,
+                    max_http_buffer_size=1024 * 1024,
                     ping_timeout=60,
                     ping_interval=25
                     )
 
-clients = {}  # sid -> client_info
-uid_to_sid = {}  # uid -> sid (用于私聊快速查找在线用户)
-verification_store = {}
+# ==========================================
+#   指标 (/metrics，Prometheus 文本格式，见 metrics.py)
+# ==========================================
+registry = metrics.Registry()
+HANDLER_SECONDS = registry.histogram('chat_handler_seconds', 'Socket.IO handler latency', ('event',))
+HTTP_SECONDS = registry.histogram('chat_http_seconds', 'HTTP endpoint latency', ('endpoint',))
+LOG_APPEND_SECONDS = registry.histogram('chat_log_append_seconds', 'append_to_chat_log latency (enqueue)')
+LOG_READ_SECONDS = registry.histogram('chat_log_read_seconds', 'read_recent_logs latency (disk)')
+EMITS = registry.counter('chat_emits_total', 'Socket.IO emits by event', ('event',))
+EMIT_RECIPIENTS = registry.counter('chat_emit_recipients_total', 'Local recipients of emits (fan-out)', ('event',))
+ERRORS = registry.counter('chat_errors_total', 'Errors by kind', ('kind',))
+profiler = metrics.SamplingProfiler()
+
+
+def socket_handler(event):
+    """@socketio.on 加处理耗时直方图。按原函数的参数个数截断实参 (connect 会额外传入 auth)"""
+    def decorator(fn):
+        n_params = len(inspect.signature(fn).parameters)
+
+        @functools.wraps(fn)
+        def wrapper(*args):
+            with HANDLER_SECONDS.time(event):
+                return fn(*args[:n_params])
+        return socketio.on(event)(wrapper)
+    return decorator
+
+
+def _instrument_emits(manager):
+    """统计每次 emit 在本进程的接收者数量 (房间大小，O(1))"""
+    original = manager.emit
+
+    def emit(event, data, namespace, room=None, skip_sid=None, callback=None, **kwargs):
+        EMITS.inc(1, event)
+        if room is not None:
+            ns_rooms = manager.rooms.get(namespace or '/', {})
+            # room 也可以是房间列表 (同一连接只收一份，这里按各房间人数相加，可能略多)
+            count = sum(len(ns_rooms.get(r) or ()) for r in ([room] if isinstance(room, str) else room))
+            if count:
+                EMIT_RECIPIENTS.inc(count, event)
+        return original(event, data, namespace, room=room, skip_sid=skip_sid, callback=callback, **kwargs)
+    manager.emit = emit
+
+
+_instrument_emits(socketio.server.manager)
+
+clients = {}  # sid -> client_info (只含连到本进程的 socket)
+
+# ==========================================
+#   限流与背压
+# ==========================================
+# 令牌桶配额 {类别: (每秒令牌数, 桶容量)}，同时按 sid 与 uid (未登录时按 IP) 计数
+RATE_LIMITS = {
+    'message': (5, 20),
+    'history': (2, 10),
+    'upload': (1, 10),        # 按 IP，只计整文件上传与分块上传的 init，不计每个分块
+    'verify_code': (0.2, 3),
+    'login': (0.5, 5),
+    'search': (1, 5),
+}
+MAX_HISTORY_PAGE = 256             # 单次历史请求最多返回的条数
+OUTBOUND_QUEUE_LIMIT = 1000        # 单个连接待发送的包超过该数时视为慢消费者并断开
+SLOW_CONSUMER_CHECK_INTERVAL = 2.0
+RATE_LIMIT_NOTICE_INTERVAL = 1.0   # 同一连接的限流提示最多每秒一条
+
+limiter = RateLimiter(RATE_LIMITS)
+RATE_LIMITED = registry.counter('chat_rate_limited_total', 'Requests rejected by the rate limiter', ('category',))
+SLOW_CONSUMERS = registry.counter('chat_slow_consumer_disconnects_total',
+                                  'Sockets dropped for exceeding OUTBOUND_QUEUE_LIMIT')
+
+
+def client_ip():
+    """经本机 ngrok 隧道进来的请求 remote_addr 都是 127.0.0.1，此时取 X-Forwarded-For 的第一项"""
+    ip = request.remote_addr
+    if ip in ('127.0.0.1', '::1') and request.headers.get('X-Forwarded-For'):
+        ip = request.headers['X-Forwarded-For'].split(',')[0].strip()
+    return ip
+
+
+def is_admin_request():
+    """本机直连 (ngrok 转发的请求带 X-Forwarded-For，不算)，或带了正确的 ADMIN_SECRET"""
+    if request.remote_addr in ('127.0.0.1', '::1') and not request.headers.get('X-Forwarded-For'):
+        return True
+    if not ADMIN_SECRET:
+        return False
+    given = (request.headers.get('X-Admin-Secret') or request.args.get('admin_secret')
+             or request.cookies.get(ADMIN_COOKIE) or '')
+    return hmac.compare_digest(given.encode('utf-8'), ADMIN_SECRET.encode('utf-8'))
+
+
+def admin_denied():
+    """当前 socket 连接时没有通过 is_admin_request()"""
+    return not clients.get(request.sid, {}).get('admin')
+
+
+def ip_key(ip):
+    """按 IP 计数的键；本机直连 (压测脚本、同机客户端) 共用一个地址，不按 IP 限流"""
+    return None if ip in (None, '127.0.0.1', '::1') else f"ip:{ip}"
+
+
+def rate_limited(category):
+    """当前 socket 请求超出配额时提示客户端并返回 True。已登录按 sid + uid，未登录按 sid + IP"""
+    sid = request.sid
+    info = clients.get(sid, {})
+    second = f"uid:{info['uid']}" if info.get('uid') else ip_key(info.get('ip'))
+    ok, retry_after = limiter.allow(category, f"sid:{sid}", second)
+    if ok:
+        return False
+    RATE_LIMITED.inc(1, category)
+    now = time.monotonic()
+    if info and now - info.get('limit_notice', 0) >= RATE_LIMIT_NOTICE_INTERVAL:
+        info['limit_notice'] = now
+        emit('show_notification', {'msg': f'Too many requests ({category}), retry in {retry_after:.1f}s'}, room=sid)
+    return True
+
+
+def clamp_history_limit(value, default=128):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(value, MAX_HISTORY_PAGE))
+
+
+def slow_consumer_loop():
+    """
+    定期检查每个 Engine.IO 连接的发送队列。客户端不读 (网络卡死、页面挂起) 时
+    发往它的包会一直堆积，群聊扇出越多堆得越快；超过上限就断开，由客户端重连后重新拉历史。
+    """
+    eio = socketio.server.eio
+    while True:
+        socketio.sleep(SLOW_CONSUMER_CHECK_INTERVAL)
+        for eio_sid, sock in list(eio.sockets.items()):
+            if sock.closed or sock.queue.qsize() <= OUTBOUND_QUEUE_LIMIT:
+                continue
+            print(f"[BACKPRESSURE] Dropping slow consumer {eio_sid} ({sock.queue.qsize()} queued packets)")
+            SLOW_CONSUMERS.inc()
+            try:
+                eio.disconnect(eio_sid)
+            except Exception as e:
+                print(f"[BACKPRESSURE ERROR] {e}")
+
+
+VERIFICATION_CODE_TTL = 600
 CSV_FILE = 'users.csv'
-# uid -> {token: "xxx", expiry: timestamp}
-user_tokens = {}
+USER_DB_FILE = os.path.join(STORAGE_ROOT, 'users.db')
+LEGACY_USER_DB_FILE = 'users.db'  # 旧版本放在当前目录，首次启动时搬到 STORAGE_ROOT 下
+USER_STORE_BACKEND = 'sqlite'  # 'sqlite' 或 'csv' (追加写，兼容旧格式)
+# 登录 Token 为自签名 Token (见 session_tokens.py)，服务器重启后仍然有效；
+# 多台机器部署时用 CHAT_SESSION_SECRET 指定同一个密钥，否则用 STORAGE_ROOT 下自动生成的密钥文件
+SESSION_TOKEN_TTL = 30 * 86400
+SESSION_SECRET = os.environ.get('CHAT_SESSION_SECRET') or None
+
+
+def user_room(uid):
+    """每个登录用户加入自己的房间，私聊发到这个房间即可，不管对方连在哪个进程"""
+    return f"user:{uid}"
 
 
 # ==========================================
-#   辅助函数：文件与日志
+#   消息编码 (见 wire_format.py)
 # ==========================================
+# 客户端连接时在 auth 里声明编码 ('json' / 'compact' / 'msgpack')，管理页和浏览器默认 json。
+# 同一个逻辑房间按编码拆成几个 Socket.IO 房间，扇出时每种编码只编码一次。
 
-def save_base64_file(base64_str, folder, prefix='file'):
-    """将Base64字符串解码并保存为实体文件"""
-    try:
-        if ',' in base64_str:
-            header, encoded = base64_str.split(',', 1)
-        else:
-            return None, "Invalid Base64"
+def wire_room(room, fmt):
+    return room if fmt == 'json' else f"{room}#{fmt}"
 
-        extension = '.bin'
-        if 'image/' in header:
-            extension = mimetypes.guess_extension(header.split(';')[0].split(':')[1]) or '.png'
-        elif 'video/' in header:
-            extension = mimetypes.guess_extension(header.split(';')[0].split(':')[1]) or '.mp4'
 
-        if len(encoded) * 0.75 > 128 * 1024 * 1024:
-            return None, "File too large (Max 128MB)"
+def join_chat_room(room):
+    join_room(wire_room(room, clients[request.sid].get('wire', 'json')))
 
-        file_name = f"{prefix}_{uuid.uuid4().hex}{extension}"
-        file_path = os.path.join(folder, file_name)
 
-        with open(file_path, "wb") as f:
-            f.write(base64.b64decode(encoded))
+def _room_active(room):
+    # 多进程时其他进程上的成员本进程看不到，只能照发
+    return MULTI_WORKER or bool(socketio.server.manager.rooms.get('/', {}).get(room))
 
-        if folder == AVATAR_DIR:
-            return f"/uploads/avatars/{file_name}", None
-        else:
-            return f"/uploads/media/{file_name}", None
-    except Exception as e:
-        return None, str(e)
 
+def emit_fanout(event, data, room):
+    """按编码分别发给 room 的各组成员；json 组与原来一样总是发送"""
+    for fmt in wire_format.available_formats():
+        target = wire_room(room, fmt)
+        if fmt == 'json' or _room_active(target):
+            socketio.emit(event, wire_format.encode(event, data, fmt), to=target)
 
-def get_log_file_path(target_uid=None, sender_uid=None):
-    """
-    获取日志文件路径。
-    - target_uid 为 None -> 公共聊天室 (global_chat)
-    - 否则 -> 私聊，文件夹名为 '较小UID_较大UID'，确保双方对话在同一个文件夹。
-    """
-    date_str = datetime.datetime.now().strftime("%Y-%m-%d")
 
-    if target_uid is None:
-        folder = os.path.join(LOGS_DIR, "global_chat")
-    else:
-        # 确保 A和B私聊 与 B和A私聊 指向同一个文件夹
-        u1, u2 = sorted([str(sender_uid), str(target_uid)])
-        folder_name = f"{u1}_{u2}"
-        folder = os.path.join(LOGS_DIR, folder_name)
+def emit_to_sid(event, data, sid=None):
+    """单独发给某个连接 (默认当前请求的连接)，按它协商的编码"""
+    sid = sid or request.sid
+    fmt = clients.get(sid, {}).get('wire', 'json')
+    socketio.emit(event, wire_format.encode(event, data, fmt), to=sid)
 
-    os.makedirs(folder, exist_ok=True)
-    return os.path.join(folder, f"{date_str}.log")
 
+# 历史消息内存缓冲：每个房间保留的条数 / 所有房间合计的内存预算
+# 多进程时各进程只能看到自己收到的消息，缓冲会缺少其他进程写入的部分，因此直接读日志文件
+HISTORY_CACHE_ENABLED = not MULTI_WORKER
+HISTORY_CACHE_PER_ROOM = 512
+HISTORY_CACHE_MAX_BYTES = 64 * 1024 * 1024
 
+# 日志 fsync 策略: 'batch' 每批一次 / 'interval' 每 LOG_FSYNC_INTERVAL 秒最多一次 / 'never'
+LOG_FSYNC_POLICY = 'interval'
+LOG_FSYNC_INTERVAL = 1.0
+
+
+# ==========================================
+#   辅助函数：文件与日志
+# ==========================================
+
+def get_room_key(target_uid=None, sender_uid=None):
+    """
+    房间 key，同时也是日志文件夹名。
+    - target_uid 为 None -> 公共聊天室 (global_chat)
+    - 否则 -> 私聊，'较小UID_较大UID'，确保双方对话在同一个文件夹。
+    """
+    if target_uid is None:
+        return "global_chat"
+    # 确保 A和B私聊 与 B和A私聊 指向同一个文件夹
+    u1, u2 = sorted([str(sender_uid), str(target_uid)])
+    return f"{u1}_{u2}"
+
+
+# 日志由独立线程批量写入 (见 log_writer.py)，文件为 LOGS_DIR/<房间key>/<日期>.log，
+# 已结束的日期由后台任务压缩为 <日期>.logz (见 log_archive.py)
+log_writer = ChatLogWriter(LOGS_DIR, fsync_policy=LOG_FSYNC_POLICY, fsync_interval=LOG_FSYNC_INTERVAL)
+atexit.register(log_writer.close)
+
+# 全文检索 (见 search_index.py)：每批日志写盘后由写线程顺带写入索引，已有日志在启动后后台回填
+search_index = SearchIndex(os.path.join(STORAGE_ROOT, 'search.db'))
+log_writer.listeners.append(search_index.add_batch)
+
+# 离线收件箱 (见 offline_inbox.py)：对方不在线时私聊另存一份，登录成功后一次性发出
+OFFLINE_INBOX_MAX_PER_USER = 500
+OFFLINE_INBOX_MAX_AGE = 30 * 86400
+offline_inbox = OfflineInbox(os.path.join(STORAGE_ROOT, 'offline_inbox.db'),
+                             max_per_user=OFFLINE_INBOX_MAX_PER_USER, max_age=OFFLINE_INBOX_MAX_AGE)
+
+# 管理端只收订阅的房间 (Socket.IO 房间 admin:<房间key>)，其余房间每 ADMIN_SAMPLE_EVERY 条抽一条
+# 发给开了抽样的管理端 (admin:sample)；与 ADMIN 的私聊总是发给 admin_room。
+# 各进程统计自己处理的消息，每 ADMIN_STATS_INTERVAL 秒推一次 admin_stats，管理页按 worker 合并
+ADMIN_SAMPLE_EVERY = 10
+ADMIN_SAMPLE_ROOM = 'admin:sample'
+ADMIN_STATS_WINDOW = 60
+ADMIN_STATS_INTERVAL = 2
+admin_monitor = AdminMonitor(window=ADMIN_STATS_WINDOW, sample_every=ADMIN_SAMPLE_EVERY)
+
+
+@metrics.timed(LOG_APPEND_SECONDS)
 def append_to_chat_log(sender, sender_uid, target_uid, content, msg_type, timestamp_str):
-    """写入日志，支持私聊和群聊"""
-    log_file = get_log_file_path(target_uid, sender_uid)
+    """写入日志，支持私聊和群聊。只入队，不阻塞消息处理"""
+    room_key = get_room_key(target_uid, sender_uid)
 
     # 使用 JSON 格式存储，方便读取解析
     entry = {
@@ -128,96 +374,78 @@ def append_to_chat_log(sender, sender_uid, target_uid, content, msg_type, timest
     }
 
     try:
-        with open(log_file, "a", encoding="utf-8") as f:
-            f.write(json.dumps(entry) + "\n")
+        log_writer.write(room_key, entry)
     except Exception as e:
+        ERRORS.inc(1, 'log_write')
         print(f"[LOG ERROR] {e}")
 
+    if HISTORY_CACHE_ENABLED:
+        history_cache.append(room_key, entry)
+    return entry
+
 
-def read_recent_logs(folder, limit=128):
+@metrics.timed(LOG_READ_SECONDS)
+def read_recent_logs(folder, limit=128, before=None, before_ts=None):
     """
-    倒序读取文件夹下的日志文件，直到获取 limit 条消息。
-    处理跨天逻辑：如果今天不够，读昨天，以此类推。
+    倒序读取文件夹下的日志文件，直到获取 limit 条消息 (按块从文件末尾向前 seek，见 history_reader.py)。
+    返回 (messages, cursor)，cursor 可作为下一页的 before 参数继续向前翻。
     """
-    if not os.path.exists(folder):
-        return []
+    return history_reader.read_logs_page(folder, limit, before=before, before_ts=before_ts)
 
-    # 获取所有日志文件，按日期倒序排列 (最新的在前面)
-    files = [f for f in os.listdir(folder) if f.endswith('.log')]
-    files.sort(reverse=True)
 
-    messages = []
+# 每个房间最近 HISTORY_CACHE_PER_ROOM 条消息常驻内存，命中时历史请求不读磁盘
+def _warm_history(room_key, n):
+    # 预热前先等写线程把队列里的消息落盘，避免缓冲漏掉尚未写入的消息
+    log_writer.flush()
+    return read_recent_logs(os.path.join(LOGS_DIR, room_key), n)[0]
 
-    for filename in files:
-        file_path = os.path.join(folder, filename)
-        day_msgs = []
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                # 读取该文件的所有行
-                for line in f:
-                    try:
-                        day_msgs.append(json.loads(line))
-                    except:
-                        pass
-
-            # 因为 files 是倒序 (今天, 昨天...),
-            # 所以我们要把旧日期的消息拼接到当前消息列表的"前面"
-            # 例子: messages = [昨天的消息...] + [今天的消息...]
-            messages = day_msgs + messages
-
-            # 如果累积的消息已经超过了限制，就可以停止读取更早的文件了
-            if len(messages) >= limit:
-                # 截取最后 limit 条 (保留最新的)
-                messages = messages[-limit:]
-                return messages
-        except Exception as e:
-            print(f"[HISTORY READ ERROR] {filename}: {e}")
 
-    return messages
+history_cache = RoomHistoryCache(
+    loader=_warm_history,
+    per_room=HISTORY_CACHE_PER_ROOM,
+    max_bytes=HISTORY_CACHE_MAX_BYTES
+)
 
 
-# ==========================================
-#   数据库简易操作
-# ==========================================
-def init_db():
-    if not os.path.exists(CSV_FILE):
-        with open(CSV_FILE, mode='w', newline='', encoding='utf-8') as f:
-            csv.writer(f).writerow(['uid', 'username', 'password', 'avatar'])
+def load_room_history(room_key, limit, before=None, before_ts=None):
+    """读取房间历史：最新一页优先走内存缓冲，翻页或缓冲不够时回退到日志文件 (协程模式下在线程池执行)"""
+    return runtime.run_blocking(_load_room_history, room_key, limit, before, before_ts)
 
 
-def get_all_users():
-    if not os.path.exists(CSV_FILE): return []
-    with open(CSV_FILE, mode='r', encoding='utf-8') as f:
-        return list(csv.DictReader(f))
+def _load_room_history(room_key, limit, before, before_ts):
+    if not HISTORY_CACHE_ENABLED:
+        log_writer.flush()
+    elif not before and not before_ts:
+        cached = history_cache.get(room_key, limit)
+        if cached is not None:
+            return cached
+    return read_recent_logs(os.path.join(LOGS_DIR, room_key), limit, before=before, before_ts=before_ts)
 
 
-def save_all_users(users):
-    with open(CSV_FILE, mode='w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=['uid', 'username', 'password', 'avatar'])
-        writer.writeheader()
-        writer.writerows(users)
+# ==========================================
+#   数据库简易操作
+# ==========================================
+# 用户数据只在启动时加载一次，之后全部走内存索引 (见 user_store.py)
+if not os.path.exists(USER_DB_FILE) and os.path.isfile(LEGACY_USER_DB_FILE):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(LEGACY_USER_DB_FILE + suffix):
+            shutil.move(LEGACY_USER_DB_FILE + suffix, USER_DB_FILE + suffix)
+    print(f"[USER STORE] Moved {os.path.abspath(LEGACY_USER_DB_FILE)} to {USER_DB_FILE}")
+user_repo = user_store.open_repository(USER_STORE_BACKEND, CSV_FILE, USER_DB_FILE, shared=MULTI_WORKER)
+session_tokens = SessionTokens(load_secret(os.path.join(STORAGE_ROOT, 'session_secret.key'), SESSION_SECRET),
+                               state_store, ttl=SESSION_TOKEN_TTL,
+                               revocation_path=os.path.join(STORAGE_ROOT, 'session_revocations.json'))
 
 
 def check_user_login(login_input, password):
-    init_db()
-    for row in get_all_users():
-        if (row['username'] == login_input or row['uid'] == login_input) and row['password'] == password:
-            return 2, row['username'], row['uid'], row.get('avatar', '')
+    row = user_repo.check_login(login_input, password)
+    if row:
+        return 2, row['username'], row['uid'], row.get('avatar', '')
     return 0, None, None, None
 
 
-def add_user_to_csv(username, password):
-    init_db()
-    users = get_all_users()
-    for row in users:
-        if row['username'] == username: return False, None
-    new_uid = ''.join(random.choices(string.digits, k=6))
-    with open(CSV_FILE, mode='a', newline='', encoding='utf-8') as f:
-        csv.writer(f).writerow([new_uid, username, password, ''])
-    return True, new_uid
-
-
-init_db()
+def add_user(username, password):
+    return runtime.run_blocking(user_repo.add, username, password)
 
 
 # ==========================================
@@ -225,206 +453,667 @@ init_db()
 # ==========================================
 
 @app.route('/')
-def index(): return "Server is running."
+def index():
+    return "Server is running."
+
+
+@app.before_request
+def guard_admin_routes():
+    if (request.path == '/admin' or request.path.startswith('/admin/')) and not is_admin_request():
+        return jsonify({'status': 'error', 'msg': 'Admin access only'}), 403
 
 
 @app.route('/admin')
-def admin_ui(): return render_template('server_ui.html')
+def admin_ui():
+    resp = make_response(render_template('server_ui.html'))
+    if ADMIN_SECRET and request.args.get('admin_secret'):
+        # 之后页面里的 fetch 和 Socket.IO 握手都带上这个 Cookie
+        resp.set_cookie(ADMIN_COOKIE, ADMIN_SECRET, httponly=True, samesite='Strict')
+    return resp
+
+
+# 图片缩略图由后台线程池生成 (需要 Pillow，未安装时直接返回原图)
+thumbnail_service = ThumbnailService(MEDIA_DIR)
+
+# 上传文件按内容哈希命名，URL 对应的内容永远不会变，可以让浏览器 / 代理缓存一年
+MEDIA_CACHE_MAX_AGE = 365 * 24 * 3600
+MEDIA_GC_INTERVAL = 24 * 3600  # 孤儿文件清理周期 (秒)
+
+
+def send_immutable(folder, filename):
+    """带 ETag / 长期 Cache-Control 的静态文件响应，If-None-Match 命中时返回 304"""
+    response = send_from_directory(folder, filename, max_age=MEDIA_CACHE_MAX_AGE,
+                                   etag=media_store.content_etag(filename))
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 
 @app.route('/uploads/media/<path:filename>')
+@metrics.timed(HTTP_SECONDS, 'serve_media')
 def serve_media(filename):
-    return send_from_directory(MEDIA_DIR, filename)
+    """?w=<宽度> 返回不小于该宽度的缩略图版本"""
+    width = request.args.get('w', type=int)
+    if width:
+        variant = thumbnail_service.find_variant(filename, width)
+        if variant:
+            return send_immutable(thumbnail_service.variant_dir, variant)
+        # 版本还没生成好，先给原图，但不能让缓存把原图当成这个 URL 的永久内容
+        response = send_from_directory(MEDIA_DIR, filename, max_age=60)
+        response.cache_control.public = True
+        return response
+    return send_immutable(MEDIA_DIR, filename)
+
+
+def attach_media_variants(msg):
+    """
+    图片消息附带缩略图 URL，聊天列表先加载小图，点开再看原图。
+    返回副本：历史消息是 history_cache 里的对象 (也是交给日志写线程的那一份)，不能原地修改
+    """
+    if thumbnails.ENABLED and msg.get('type') == 'image' and str(msg.get('content', '')).startswith('/uploads/media/') \
+            and 'thumb' not in msg:
+        return dict(msg, thumb=f"{msg['content']}?w={thumbnails.THUMB_WIDTH}")
+    return msg
 
 
 @app.route('/uploads/avatars/<path:filename>')
 def serve_avatar(filename):
-    return send_from_directory(AVATAR_DIR, filename)
+    return send_immutable(AVATAR_DIR, filename)
+
+
+def collect_media_garbage(grace_seconds=24 * 3600, dry_run=False):
+    """
+    标记-清除：头像以用户表为准，聊天媒体以日志中出现的 URL 为准，
+    两者都没有引用且超过宽限期的文件会被删除。
+    多进程共享用户库时 user_repo.all() 每次从 SQLite 读，其他进程刚换的头像也算引用。
+    """
+    log_writer.flush()
+    avatar_refs = {row['avatar'].rsplit('/', 1)[-1] for row in user_repo.all() if row.get('avatar')}
+    log_files = [os.path.join(root, name) for root, _, names in os.walk(LOGS_DIR) for name in names]
+    archives = [p for p in log_files if p.endswith(log_archive.ARCHIVE_SUFFIX)]
+    media_refs = media_store.find_references([p for p in log_files if p.endswith('.log')], b'/uploads/media/')
+    media_refs |= log_archive.find_references(archives, b'/uploads/media/')
+    result = {
+        'avatars': media_store.sweep_orphans(AVATAR_DIR, avatar_refs, grace_seconds, dry_run),
+        'media': media_store.sweep_orphans(MEDIA_DIR, media_refs, grace_seconds, dry_run),
+    }
+    if not dry_run:
+        result['variants'] = thumbnail_service.sweep()
+    return result
+
+
+def media_gc_loop():
+    while True:
+        socketio.sleep(MEDIA_GC_INTERVAL)
+        try:
+            print(f"[MEDIA GC] {runtime.run_blocking(collect_media_garbage)}, "
+                  f"expired uploads: {runtime.run_blocking(chunked_uploads.expire)}")
+        except Exception as e:
+            ERRORS.inc(1, 'media_gc')
+            print(f"[MEDIA GC ERROR] {e}")
+
+
+# ==========================================
+#   日志归档 (见 log_archive.py)
+# ==========================================
+LOG_COMPACT_INTERVAL = 3600  # 每小时把已结束日期的 .log 压成 .logz
+log_compaction = {'runs': 0, 'files': 0, 'bytes_in': 0, 'bytes_out': 0, 'errors': 0, 'last_seconds': 0.0}
+
+
+def compact_chat_logs():
+    log_writer.flush()
+    result = log_archive.compact_logs(LOGS_DIR)
+    log_compaction['runs'] += 1
+    for k in ('files', 'bytes_in', 'bytes_out', 'errors'):
+        log_compaction[k] += result[k]
+    log_compaction['last_seconds'] = result['seconds']
+    return result
+
+
+def log_compaction_loop():
+    while True:
+        try:
+            result = runtime.run_blocking(compact_chat_logs)
+            if result['files'] or result['errors']:
+                print(f"[LOG ARCHIVE] {result}")
+        except Exception as e:
+            ERRORS.inc(1, 'log_archive')
+            print(f"[LOG ARCHIVE ERROR] {e}")
+        socketio.sleep(LOG_COMPACT_INTERVAL)
+
+
+@app.route('/admin/log_archive', methods=['GET', 'POST'])
+def log_archive_admin():
+    """GET 查看日志占用与累计压缩量；POST 立即压缩一次"""
+    if request.method == 'POST':
+        return jsonify(runtime.run_blocking(compact_chat_logs))
+    return jsonify({'usage': runtime.run_blocking(log_archive.usage, LOGS_DIR), 'compaction': log_compaction})
+
+
+def search_backfill_task():
+    try:
+        added = runtime.run_blocking(search_index.backfill, LOGS_DIR)
+        if added:
+            print(f"[SEARCH] backfilled {added} messages")
+    except Exception as e:
+        ERRORS.inc(1, 'search_backfill')
+        print(f"[SEARCH ERROR] {e}")
+
+
+def admin_room_id(room_key):
+    """日志房间 key -> 管理页的房间名 ('Global Chat' / 'UID1 <-> UID2' / 'ADMIN <-> UID')"""
+    if room_key == 'global_chat':
+        return 'Global Chat'
+    parts = room_key.split('_', 1)
+    if 'ADMIN' in parts:
+        return f"ADMIN <-> {parts[0] if parts[1] == 'ADMIN' else parts[1]}"
+    return ' <-> '.join(parts)
+
+
+@app.route('/admin/search')
+def admin_search():
+    """?q=关键词&offset=0&limit=20，可选 room=管理页房间名；不限房间与用户"""
+    room = request.args.get('room')
+    try:
+        result = runtime.run_blocking(search_index.search, request.args.get('q', ''),
+                                      room=admin_room_key(room) if room else None,
+                                      offset=request.args.get('offset', 0), limit=request.args.get('limit', 20))
+    except ValueError:
+        return jsonify({'status': 'error', 'msg': 'Bad offset / limit'}), 400
+    for r in result['results']:
+        r['room_id'] = admin_room_id(r['room'])
+    return jsonify(result)
+
+
+@app.route('/admin/search_index')
+def search_index_stats():
+    return jsonify(search_index.stats())
+
+
+@app.route('/admin/offline_inbox')
+def offline_inbox_stats():
+    return jsonify(offline_inbox.stats())
+
+
+@app.route('/admin/session_tokens')
+def session_token_stats():
+    return jsonify(session_tokens.stats())
+
+
+@app.route('/admin/revoke_tokens', methods=['POST'])
+def revoke_tokens():
+    """?uid=xxx 让该用户所有已签发的 Token 失效 (各设备需重新用验证码登录)"""
+    uid = request.args.get('uid')
+    if not uid or not user_repo.get_by_uid(uid):
+        return jsonify({'status': 'error', 'msg': 'Unknown uid'}), 404
+    return jsonify({'status': 'ok', 'version': runtime.run_blocking(session_tokens.revoke_user, uid)})
+
+
+@app.route('/admin/media_gc', methods=['POST'])
+def media_gc():
+    """手动触发孤儿文件清理，?dry_run=1 只统计不删除。返回 {类别: [删除数, 释放字节]}"""
+    return jsonify(runtime.run_blocking(collect_media_garbage, dry_run=request.args.get('dry_run') == '1'))
 
 
 @app.route('/api/avatar/<uid>')
 def serve_avatar_by_uid(uid):
     """UID -> 头像文件重定向"""
-    users = get_all_users()
-    for row in users:
-        if row['uid'] == uid:
-            if row['avatar']:
-                return redirect(row['avatar'])
-            else:
-                break
+    row = user_repo.get_by_uid(uid)
+    if row and row['avatar']:
+        return redirect(row['avatar'])
     return "No Avatar", 404
 
 
+def _cors(response):
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.headers.add('Access-Control-Allow-Headers', '*')
+    return response
+
+
 @app.route('/api/upload_media', methods=['POST', 'OPTIONS'])
-def upload_media_http():
+@app.route('/api/upload/<kind>', methods=['POST', 'OPTIONS'])
+@metrics.timed(HTTP_SECONDS, 'upload')
+def upload_media_http(kind='media'):
     """
-    HTTP 文件上传接口，支持 CORS。
+    HTTP 文件上传接口，支持 CORS。kind: media (聊天媒体) / avatar (头像)。
+    两种请求体都支持，均按块流式写盘：
+    - multipart/form-data，文件字段名 file (浏览器 FormData)
+    - 原始二进制请求体，Content-Type 为文件类型 (Python 客户端使用)
     """
     if request.method == 'OPTIONS':
-        response = jsonify({'status': 'ok'})
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        response.headers.add('Access-Control-Allow-Headers', '*')
-        return response
+        return _cors(jsonify({'status': 'ok'}))
+
+    if kind not in ('media', 'avatar'):
+        return jsonify({'status': 'error', 'msg': 'Unknown upload kind'}), 404
+    limited = _upload_rate_limited()
+    if limited:
+        return limited
+
+    if request.mimetype == 'multipart/form-data':
+        if 'file' not in request.files:
+            return jsonify({'status': 'error', 'msg': 'No file part'}), 400
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({'status': 'error', 'msg': 'No selected file'}), 400
+        stream, content_type = file.stream, file.content_type
+    else:
+        stream, content_type = request.stream, request.mimetype
 
-    if 'file' not in request.files:
-        return jsonify({'status': 'error', 'msg': 'No file part'}), 400
+    if kind == 'avatar':
+        if media_store.media_kind(content_type) != 'image':
+            return jsonify({'status': 'error', 'msg': 'Avatar must be an image'}), 400
+        folder, limit = AVATAR_DIR, UPLOAD_LIMITS['avatar']
+    else:
+        folder = MEDIA_DIR
+        limit = UPLOAD_LIMITS.get(media_store.media_kind(content_type), UPLOAD_LIMITS['other'])
 
+    try:
+        # 内容寻址：相同文件只存一份，重复上传直接返回已有 URL
+        file_name, _, _ = media_store.save_stream(stream, folder, content_type, limit)
+        if kind == 'media':
+            thumbnail_service.schedule(file_name)  # 后台生成缩略图，不阻塞上传响应
+    except media_store.UploadError as e:
+        return _cors(jsonify({'status': 'error', 'msg': f'Server Reject: {e}'})), e.status
+    except Exception as e:
+        ERRORS.inc(1, 'upload')
+        print(f"[UPLOAD ERROR] {e}")
+        return _cors(jsonify({'status': 'error', 'msg': str(e)})), 500
+
+    return _cors(jsonify({'status': 'ok', 'url': f"/uploads/{'avatars' if kind == 'avatar' else 'media'}/{file_name}"}))
 
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'status': 'error', 'msg': 'No selected file'}), 400
 
-    content_type = file.content_type
-    extension = mimetypes.guess_extension(content_type.split(';')[0]) or '.bin'
-    file_name = f"http_msg_{uuid.uuid4().hex}{extension}"
-    file_path = os.path.join(MEDIA_DIR, file_name)
+# ==========================================
+#   分块断点续传 (大文件 / 不稳定网络)
+# ==========================================
+chunked_uploads = ChunkedUploadManager(os.path.join(STORAGE_ROOT, 'upload_tmp'), UPLOAD_LIMITS)
 
-    file = request.files['file']
 
-    # 服务端强校验：300KB = 300 * 1024 bytes
-    file.seek(0, os.SEEK_END)
-    size = file.tell()
-    file.seek(0)  # 检查完大小记得把指针移回开头
+def _upload_error(e):
+    return _cors(jsonify({'status': 'error', 'msg': str(e)})), e.status
 
-    if size > 300 * 1024:
-        return jsonify({'status': 'error', 'msg': 'Server Reject: File too large (>300KB)'}), 400
 
+def _upload_rate_limited():
+    """超出上传配额时返回 429 响应，否则返回 None"""
+    ok, retry_after = limiter.allow('upload', ip_key(client_ip()))
+    if ok:
+        return None
+    RATE_LIMITED.inc(1, 'upload')
+    response = _cors(jsonify({'status': 'error', 'msg': 'Too many uploads', 'retry_after': round(retry_after, 1)}))
+    response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+    return response, 429
+
+
+@app.route('/api/upload/chunked/init', methods=['POST', 'OPTIONS'])
+def chunked_upload_init():
+    """{'content_type': 'video/mp4', 'size': 12345678, 'chunk_size': 1048576(可选)} -> upload_id 与分块信息"""
+    if request.method == 'OPTIONS':
+        return _cors(jsonify({'status': 'ok'}))
+    limited = _upload_rate_limited()
+    if limited:
+        return limited
+    data = request.json or {}
+    content_type = data.get('content_type') or 'application/octet-stream'
     try:
-        file.save(file_path)
-        file_url = f"/uploads/media/{file_name}"
-        response = jsonify({'status': 'ok', 'url': file_url})
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        return response
+        session = chunked_uploads.init(media_store.media_kind(content_type), content_type,
+                                       data.get('size', 0), data.get('chunk_size'))
+    except (media_store.UploadError, ValueError, TypeError) as e:
+        if not isinstance(e, media_store.UploadError):
+            e = media_store.UploadError('Bad size / chunk_size')
+        return _upload_error(e)
+    return _cors(jsonify({'status': 'ok', 'upload_id': session.upload_id,
+                          'chunk_size': session.chunk_size, 'chunks': session.chunks}))
+
+
+@app.route('/api/upload/chunked/<upload_id>/<int:index>', methods=['PUT', 'OPTIONS'])
+@metrics.timed(HTTP_SECONDS, 'upload_chunk')
+def chunked_upload_put(upload_id, index):
+    """请求体为第 index 块的原始字节，可重复上传"""
+    if request.method == 'OPTIONS':
+        return _cors(jsonify({'status': 'ok'}))
+    try:
+        session = chunked_uploads.put_chunk(upload_id, index, request.stream)
+    except media_store.UploadError as e:
+        return _upload_error(e)
+    return _cors(jsonify({'status': 'ok', 'received': len(session.received), 'chunks': session.chunks}))
 
-    except Exception as e:
-        print(f"[UPLOAD ERROR] {e}")
-        return jsonify({'status': 'error', 'msg': str(e)}), 500
 
+@app.route('/api/upload/chunked/<upload_id>', methods=['GET', 'DELETE', 'OPTIONS'])
+def chunked_upload_status(upload_id):
+    """GET 查询已收到的字节区间和缺失的块；DELETE 放弃本次上传"""
+    if request.method == 'OPTIONS':
+        return _cors(jsonify({'status': 'ok'}))
+    if request.method == 'DELETE':
+        chunked_uploads.abort(upload_id)
+        return _cors(jsonify({'status': 'ok'}))
+    try:
+        session = chunked_uploads.get(upload_id)
+    except media_store.UploadError as e:
+        return _upload_error(e)
+    return _cors(jsonify({'status': 'ok', 'size': session.size, 'chunk_size': session.chunk_size,
+                          'ranges': session.ranges(), 'missing': session.missing()}))
 
-def start_ngrok_and_upload():
-    print("\n[BOOT] Starting Ngrok...")
-    local_ngrok = "./ngrok.exe"
-    if os.path.exists(local_ngrok): conf.get_default().ngrok_path = local_ngrok
-    if NGROK_TOKEN: conf.get_default().auth_token = NGROK_TOKEN
+
+@app.route('/api/upload/chunked/<upload_id>/finalize', methods=['POST', 'OPTIONS'])
+@metrics.timed(HTTP_SECONDS, 'upload_finalize')
+def chunked_upload_finalize(upload_id):
+    if request.method == 'OPTIONS':
+        return _cors(jsonify({'status': 'ok'}))
     try:
-        url = ngrok.connect(5005).public_url
-        print(f"[NGROK] {url}")
-        requests.post(JSON_BIN_URL, json={"url": url})
-    except Exception as e:
-        print(f"[NGROK ERROR] {e}")
+        file_name, _ = runtime.run_blocking(chunked_uploads.finalize, upload_id, MEDIA_DIR)
+    except media_store.UploadError as e:
+        return _upload_error(e)
+    thumbnail_service.schedule(file_name)
+    return _cors(jsonify({'status': 'ok', 'url': f"/uploads/media/{file_name}"}))
+
+
+# ==========================================
+#   ngrok 隧道 (见 tunnel.py)
+# ==========================================
+tunnel = TunnelManager(SERVER_PORT, JSON_BIN_URL, auth_token=NGROK_TOKEN,
+                       ngrok_path="./ngrok.exe" if os.path.exists("./ngrok.exe") else None,
+                       sleep=socketio.sleep, blocking=runtime.run_blocking)
+
+
+def start_ngrok_and_upload():
+    """启动隧道与地址发布；background 模式下立即返回"""
+    if TUNNEL_MODE == 'off':
+        tunnel.stop()
+        return
+    if TUNNEL_MODE == 'blocking':
+        print("\n[BOOT] Starting Ngrok...")
+        tunnel.try_once()
+    socketio.start_background_task(tunnel.run)
+
+
+def open_admin_page():
+    import webbrowser  # 只有 0 号进程启动时用到
+    webbrowser.open(f'http://127.0.0.1:{SERVER_PORT}/admin')
+
+
+@app.route('/admin/tunnel')
+def tunnel_status():
+    """隧道状态：state 为 idle / connecting / publishing / up / retrying / disabled / off"""
+    return jsonify(tunnel.stats())
 
 
 # ==========================================
 #   SocketIO 事件
 # ==========================================
 
-def broadcast_user_list():
-    """向所有在线用户广播当前的在线列表 (侧边栏使用)"""
-    safe_list = []
-    for sid, info in clients.items():
-        if info.get('verified'):
-            safe_list.append({
-                'username': info['username'],
-                'uid': info['uid'],
-                'avatar': info.get('avatar', '')
-            })
+# 在线列表只广播增量 (见 presence.py)，同一窗口内的上下线合并为一个 delta
+PRESENCE_DEBOUNCE = 0.25
+
+
+def publish_presence(delta):
+    emit_fanout('presence_delta', delta, 'global_chat')
+    # 管理端只需要知道列表变了，不再下发带 IP 的原始 clients 字典
+    socketio.emit('presence_delta', dict(delta, connections=len(clients)), to='admin_room')
+
+
+presence = PresenceTracker(publish_presence, PRESENCE_DEBOUNCE,
+                           start_task=socketio.start_background_task, sleep=socketio.sleep, store=state_store,
+                           make_lock=runtime.make_lock, worker_id=WORKER_ID)
+
+
+@socket_handler('request_presence_snapshot')
+def handle_presence_snapshot():
+    """客户端发现 delta 版本不连续时调用"""
+    emit_to_sid('presence_snapshot', presence.snapshot())
+
+
+@app.route('/admin/presence')
+def presence_stats():
+    return jsonify(presence.stats())
+
+
+@app.route('/admin/history_cache')
+def history_cache_stats():
+    """历史缓冲命中率等统计，用于调整 HISTORY_CACHE_PER_ROOM / HISTORY_CACHE_MAX_BYTES"""
+    return jsonify(history_cache.stats())
+
+
+@app.route('/admin/log_writer')
+def log_writer_stats():
+    """日志写入队列深度、批大小与落盘耗时"""
+    return jsonify(log_writer.stats())
+
+
+def _numeric_stats(stats_fn):
+    """把各组件的 stats() 字典转成 {(字段名,): 数值}，供带 stat 标签的 gauge 使用"""
+    return lambda: {(k,): v for k, v in stats_fn().items()
+                    if isinstance(v, (int, float)) and not isinstance(v, bool)}
+
+
+def _room_sizes():
+    rooms = socketio.server.manager.rooms.get('/', {})
+    return {(name,): sum(len(rooms.get(wire_room(name, fmt)) or ()) for fmt in wire_format.FORMATS)
+            for name in ('global_chat', 'admin_room')}
+
+
+registry.gauge_callback('chat_clients', 'Sockets connected to this process', labels=('state',),
+                        callback=lambda: {('connected',): len(clients),
+                                          ('verified',): sum(1 for c in list(clients.values()) if c.get('verified'))})
+registry.gauge_callback('chat_room_members', 'Members of shared rooms on this process', _room_sizes, ('room',))
+registry.gauge_callback('chat_rooms', 'Socket.IO rooms on this process',
+                        lambda: len(socketio.server.manager.rooms.get('/', {})))
+registry.gauge_callback('chat_log_writer', 'ChatLogWriter.stats()', _numeric_stats(log_writer.stats), ('stat',))
+registry.gauge_callback('chat_history_cache', 'RoomHistoryCache.stats()', _numeric_stats(history_cache.stats), ('stat',))
+registry.gauge_callback('chat_presence', 'PresenceTracker.stats()', _numeric_stats(presence.stats), ('stat',))
+registry.gauge_callback('chat_chunked_uploads', 'ChunkedUploadManager.stats()',
+                        _numeric_stats(chunked_uploads.stats), ('stat',))
+registry.gauge_callback('chat_rate_limiter', 'RateLimiter.stats()', _numeric_stats(limiter.stats), ('stat',))
+registry.gauge_callback('chat_outbound_queue_max', 'Largest Engine.IO send queue on this process',
+                        lambda: max((s.queue.qsize() for s in list(socketio.server.eio.sockets.values())
+                                     if not s.closed), default=0))
+registry.gauge_callback('chat_log_compaction', 'Cumulative log archive compaction', _numeric_stats(lambda: log_compaction),
+                        ('stat',))
+registry.gauge_callback('chat_search_index', 'SearchIndex.stats()', _numeric_stats(search_index.stats), ('stat',))
+registry.gauge_callback('chat_session_tokens', 'SessionTokens.stats()', _numeric_stats(session_tokens.stats),
+                        ('stat',))
+registry.gauge_callback('chat_admin_monitor', 'AdminMonitor.stats()', _numeric_stats(admin_monitor.stats), ('stat',))
+registry.gauge_callback('chat_offline_inbox', 'OfflineInbox.stats()', _numeric_stats(offline_inbox.stats), ('stat',))
+registry.gauge_callback('chat_tunnel', 'TunnelManager.stats()', _numeric_stats(tunnel.stats), ('stat',))
+registry.gauge_callback('chat_thumbnails', 'ThumbnailService.stats()', _numeric_stats(thumbnail_service.stats),
+                        ('stat',))
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/admin/handler_latency')
+def handler_latency():
+    """管理页用的简要汇总 (按桶估计的 p50 / p99，单位秒)"""
+    return jsonify({'socket': HANDLER_SECONDS.snapshot(), 'http': HTTP_SECONDS.snapshot()})
+
 
-    # 始终加入 Admin
-    safe_list.append({'username': 'Admin', 'uid': 'ADMIN', 'avatar': ''})
+@app.route('/admin/rate_limit')
+def rate_limit_stats():
+    """各类别放行 / 拒绝次数，以及当前发送队列最长的几个连接"""
+    queues = sorted(((s.queue.qsize(), eio_sid) for eio_sid, s in list(socketio.server.eio.sockets.items())
+                     if not s.closed), reverse=True)[:10]
+    return jsonify({'limits': RATE_LIMITS, 'max_history_page': MAX_HISTORY_PAGE,
+                    'outbound_queue_limit': OUTBOUND_QUEUE_LIMIT, 'stats': limiter.stats(),
+                    'top_queues': [{'eio_sid': s, 'queued': n} for n, s in queues]})
 
-    emit('update_user_list', safe_list, to='global_chat')
-    emit('admin_update_client_list', clients, to='admin_room')
 
+@app.route('/admin/profile', methods=['GET', 'POST'])
+def admin_profile():
+    """POST ?seconds=10 开始一次采样；GET 取状态与结果 (?format=collapsed 返回完整折叠栈)"""
+    if request.method == 'POST':
+        seconds = min(120.0, max(1.0, float(request.args.get('seconds', 10))))
+        started = profiler.start(seconds)
+        return jsonify({'status': 'ok' if started else 'busy', 'running': True, 'info': profiler.info})
+    if request.args.get('format') == 'collapsed':
+        return profiler.result or '', 200, {'Content-Type': 'text/plain; charset=utf-8'}
+    return jsonify({'running': profiler.running, 'info': profiler.info, 'top': profiler.top()})
 
-@socketio.on('connect')
-def handle_connect():
-    clients[request.sid] = {'ip': request.remote_addr, 'verified': False}
-    emit('admin_update_client_list', clients, to='admin_room')
 
+@socket_handler('connect')
+def handle_connect(auth=None):
+    wire = wire_format.negotiate(auth.get('wire') if isinstance(auth, dict) else None)
+    clients[request.sid] = {'ip': client_ip(), 'verified': False, 'wire': wire, 'admin': is_admin_request()}
 
-@socketio.on('disconnect')
+
+@socket_handler('disconnect')
 def handle_disconnect():
-    if request.sid in clients:
-        uid = clients[request.sid].get('uid')
-        if uid and uid in uid_to_sid: del uid_to_sid[uid]
-        del clients[request.sid]
-    broadcast_user_list()
+    clients.pop(request.sid, None)
+    limiter.forget(f"sid:{request.sid}")
+    presence.offline(request.sid)
 
 
-@socketio.on('admin_join')
-def handle_admin_join():
+# ==========================================
+#   管理端监控 (见 admin_monitor.py)
+# ==========================================
+
+def emit_to_admins(payload, room_key):
+    sampled = admin_monitor.record(room_key, payload.get('uid'), payload.get('sender'))
+    if 'ADMIN' in (str(payload.get('uid')), str(payload.get('target_uid'))):
+        rooms = ['admin_room']
+    else:
+        rooms = [f"admin:{room_key}"] + ([ADMIN_SAMPLE_ROOM] if sampled else [])
+    rooms = [r for r in rooms if _room_active(r)]
+    if rooms:
+        # 一次发给多个房间时同一个连接只收一份
+        socketio.emit('receive_message', payload, to=rooms)
+
+
+def admin_stats_loop():
+    while True:
+        socketio.sleep(ADMIN_STATS_INTERVAL)
+        if _room_active('admin_room'):
+            socketio.emit('admin_stats', dict(admin_monitor.snapshot(admin_room_id), worker=WORKER_ID,
+                                              connections=len(clients), interval=ADMIN_STATS_INTERVAL),
+                          to='admin_room')
+
+
+def apply_admin_subscription(data):
+    """data: {'rooms': [管理页房间名...], 'sample': 是否接收其余房间的抽样}，替换该连接原来的订阅"""
+    sid = request.sid
+    wanted = {f"admin:{key}" for key in (admin_room_key(str(r)) for r in (data.get('rooms') or [])[:50]) if key}
+    if data.get('sample', True):
+        wanted.add(ADMIN_SAMPLE_ROOM)
+    current = clients[sid].get('admin_rooms', set())
+    for room in current - wanted:
+        leave_room(room)
+    for room in wanted - current:
+        join_room(room)
+    clients[sid]['admin_rooms'] = wanted
+    return {'status': 'ok', 'rooms': sorted(admin_room_id(r[len('admin:'):]) for r in wanted if r != ADMIN_SAMPLE_ROOM),
+            'sample': ADMIN_SAMPLE_ROOM in wanted, 'sample_every': ADMIN_SAMPLE_EVERY}
+
+
+@socket_handler('admin_join')
+def handle_admin_join(data=None):
+    if admin_denied():
+        return {'status': 'error', 'msg': 'Admin access only'}
     join_room('admin_room')
+    # 默认订阅群聊并接收其余房间的抽样
+    subscription = apply_admin_subscription(data if isinstance(data, dict) else {'rooms': ['Global Chat']})
     # 管理员连接时，读取 256 条全局历史
-    global_folder = os.path.join(LOGS_DIR, "global_chat")
-    history = read_recent_logs(global_folder, limit=256)
-    emit('admin_history_load', history, to='admin_room')
-    broadcast_user_list()
+    history, _ = load_room_history("global_chat", MAX_HISTORY_PAGE)
+    emit('admin_history_load', [attach_media_variants(m) for m in history], to=request.sid)
+    emit('presence_snapshot', presence.snapshot())
+    return subscription
 
 
+@socket_handler('admin_subscribe')
+def handle_admin_subscribe(data):
+    if admin_denied():
+        return {'status': 'error', 'msg': 'Admin access only'}
+    if 'admin_rooms' not in clients.get(request.sid, {}):
+        return {'status': 'error', 'msg': 'admin_join first'}
+    return apply_admin_subscription(data or {})
 
-@socketio.on('request_verification_code')
+
+@socket_handler('request_verification_code')
 def generate_code():
-    sid = request.sid;
+    sid = request.sid
     ip = clients[sid]['ip']
+    if rate_limited('verify_code'):
+        return
     code = ''.join(random.choices(string.digits, k=6))
-    verification_store[ip] = code
+    state_store.set('verify', ip, code, ttl=VERIFICATION_CODE_TTL)
     print(f"\n[SEC] Code for {ip}: {code}\n")
     emit('system_send_code', {'code': code}, room=sid)
 
 
-@socketio.on('submit_login_verify')
+def stash_if_offline(target_uid, payload):
+    """私聊对方不在任何进程上在线时存入离线收件箱 (会话 key 为发送者 uid，与客户端一致)"""
+    if not presence.is_online(target_uid):
+        runtime.run_blocking(offline_inbox.push, target_uid, payload['uid'], payload)
+
+
+def deliver_offline_inbox(uid):
+    """
+    登录成功后把离线期间收到的私聊用一个 receive_messages 事件发完，
+    附带 unread {会话: 条数}；dropped > 0 表示超出上限丢了更早的，客户端应向服务器拉历史补齐
+    """
+    box = runtime.run_blocking(offline_inbox.drain, uid)
+    if box['messages'] or box['dropped']:
+        emit_to_sid('receive_messages', box)
+
+
+@socket_handler('submit_login_verify')
 def handle_login_verify(data):
     sid = request.sid
     ip = clients[sid]['ip']
+    if rate_limited('login'):
+        return
 
-    # 逻辑 A：通过 Token 静默重连
+    # 逻辑 A：通过 Token 静默重连 (只校验签名，不查任何存储；资料走内存)
     if data.get('token') and data.get('uid'):
-        uid = data['uid']
-        saved_info = user_tokens.get(uid)
-        if saved_info and saved_info['token'] == data['token']:
-            # Token 匹配，直接找回身份
-            users = get_all_users()
-            user_row = next((r for r in users if r['uid'] == uid), None)
+        uid = str(data['uid'])
+        valid, _ = session_tokens.verify(uid, data['token'])
+        if valid:
+            # Token 有效，直接找回身份
+            user_row = user_repo.get_profile(uid)
             if user_row:
+                token = session_tokens.issue(uid) if session_tokens.needs_refresh(data['token']) else data['token']
                 clients[sid].update({
                     'verified': True,
                     'username': user_row['username'],
                     'uid': uid,
-                    'avatar': user_row.get('avatar', '')
+                    'avatar': user_row.get('avatar', ''),
+                    'token': token
                 })
-                uid_to_sid[uid] = sid
-                join_room('global_chat')
+                join_chat_room(user_room(uid))
+                join_chat_room('global_chat')
                 emit('verification_success', {
                     'username': user_row['username'],
                     'uid': uid,
                     'avatar': user_row.get('avatar', ''),
-                    'token': data['token']  # 确认 Token 依然有效
+                    'token': token  # 确认 Token 依然有效 (快过期时换发新的)
                 })
-                broadcast_user_list()
+                presence.online(sid, uid, user_row['username'], user_row.get('avatar', ''))
+                emit_to_sid('presence_snapshot', presence.snapshot())
+                deliver_offline_inbox(uid)
                 return
 
     # 逻辑 B：原有的验证码登录逻辑 (保持不变，但增加 Token 生成)
-    real = verification_store.get(ip)
+    real = state_store.get('verify', ip)
     if not real or data.get('code') != real:
         emit('verification_failed', {'msg': 'Invalid Code'})
         return
 
     st, user, uid, ava = check_user_login(data.get('username'), data.get('password'))
     if st == 2:
-        # 生成新的 Token 并存入服务器内存
-        new_token = uuid.uuid4().hex
-        user_tokens[uid] = {'token': new_token}
-
-        clients[sid].update({'verified': True, 'username': user, 'uid': uid, 'avatar': ava})
-        uid_to_sid[uid] = sid
-        verification_store.pop(ip, None)
-        join_room('global_chat')
+        # 签发新的 Token (任意进程都能校验，重启后仍然有效)
+        new_token = session_tokens.issue(uid)
+
+        clients[sid].update({'verified': True, 'username': user, 'uid': uid, 'avatar': ava, 'token': new_token})
+        state_store.delete('verify', ip)
+        join_chat_room(user_room(uid))
+        join_chat_room('global_chat')
         # 将 Token 发回给客户端保存
         emit('verification_success', {'username': user, 'uid': uid, 'avatar': ava, 'token': new_token})
-        broadcast_user_list()
+        presence.online(sid, uid, user, ava)
+        emit_to_sid('presence_snapshot', presence.snapshot())
+        deliver_offline_inbox(uid)
 
     elif st == 0:
-        suc, new_uid = add_user_to_csv(data.get('username'), data.get('password'))
+        suc, new_uid = add_user(data.get('username'), data.get('password'))
         if suc:
             emit('show_notification', {'msg': f'Registered! UID: {new_uid}'})
         else:
@@ -433,42 +1122,66 @@ def handle_login_verify(data):
         emit('verification_failed', {'msg': 'Wrong Password'})
 
 
-@socketio.on('update_profile')
+@socket_handler('update_profile')
 def handle_update_profile(data):
     sid = request.sid
-    cur_user = clients[sid].get('username')
-    if not cur_user: return
-    users = get_all_users()
-    updated = False
-    new_avatar = None
-
-    for row in users:
-        if row['username'] == cur_user:
-            if data.get('new_avatar'):
-                url, _ = save_base64_file(data.get('new_avatar'), AVATAR_DIR, prefix=f"user_{row['uid']}")
-                if url: row['avatar'] = url; new_avatar = url; updated = True
-            if data.get('new_username'): row['username'] = data.get('new_username'); clients[sid]['username'] = row[
-                'username']; updated = True
-            if data.get('new_password'): row['password'] = data.get('new_password'); updated = True
-            break
-
-    if updated:
-        save_all_users(users)
+    uid = clients[sid].get('uid')
+    if not clients[sid].get('username') or not uid:
+        return
+    changes = {}
+
+    # 头像文件已经通过 /api/upload/avatar 上传，这里只接收其 URL
+    avatar_url = data.get('avatar_url')
+    if avatar_url:
+        name = avatar_url.rsplit('/', 1)[-1]
+        if avatar_url.startswith('/uploads/avatars/') and os.path.isfile(os.path.join(AVATAR_DIR, name)):
+            changes['avatar'] = f"/uploads/avatars/{name}"
+    if data.get('new_username'):
+        changes['username'] = data.get('new_username')
+    if data.get('new_password'):
+        changes['password'] = data.get('new_password')
+
+    if changes:
+        try:
+            row = runtime.run_blocking(user_repo.update, uid, **changes)
+        except ValueError as e:
+            emit('show_notification', {'msg': str(e)})
+            return
+        if not row:
+            return
+        clients[sid]['username'] = row['username']
+        clients[sid]['avatar'] = row['avatar']
+        if 'password' in changes:
+            # 改密码后其他设备上的旧 Token 全部失效，当前连接换发新的
+            runtime.run_blocking(session_tokens.revoke_user, uid)
+            clients[sid]['token'] = session_tokens.issue(uid)
         emit('verification_success',
-             {'username': clients[sid]['username'], 'uid': clients[sid]['uid'], 'avatar': new_avatar or row['avatar']})
-        broadcast_user_list()
+             {'username': row['username'], 'uid': uid, 'avatar': row['avatar'], 'token': clients[sid].get('token')})
+        presence.update(uid, row['username'], row['avatar'])
+
 
+@socket_handler('client_logout')
+def handle_logout():
+    """退出登录：吊销这个连接的 Token，之后不能再用它静默重连"""
+    token = clients.get(request.sid, {}).pop('token', None)
+    if token:
+        runtime.run_blocking(session_tokens.revoke_token, token)
 
-@socketio.on('client_message')
+
+@socket_handler('client_message')
 def handle_message(data):
     sid = request.sid
-    if not clients.get(sid, {}).get('verified'): return
+    if not clients.get(sid, {}).get('verified'):
+        return
+    if rate_limited('message'):
+        return
 
     sender = clients[sid]['username']
     sender_uid = clients[sid]['uid']
 
     target_uid = data.get('target_uid')
-    if target_uid == 'global': target_uid = None
+    if target_uid == 'global':
+        target_uid = None
 
     content = data.get('content')
     msg_type = data.get('type', 'text')
@@ -486,24 +1199,23 @@ def handle_message(data):
         'temp_id': temp_id,
         'target_uid': target_uid
     }
+    payload = attach_media_variants(payload)
 
     if target_uid:
         # 私聊
-        emit('receive_message', payload, room=sid)  # 发给自己
-        if target_uid == 'ADMIN':
-            emit('receive_message', payload, to='admin_room')
-        elif target_uid in uid_to_sid:
-            emit('receive_message', payload, room=uid_to_sid[target_uid])
-        # 始终发给 Admin 监控
+        emit_to_sid('receive_message', payload)  # 发给自己
         if target_uid != 'ADMIN':
-            emit('receive_message', payload, to='admin_room')
+            # 对方连在哪个进程都能收到 (经消息队列转发)，离线时房间为空，改存离线收件箱
+            emit_fanout('receive_message', payload, user_room(target_uid))
+            stash_if_offline(target_uid, payload)
     else:
         # 群聊
-        emit('receive_message', payload, to='global_chat')
-        emit('receive_message', payload, to='admin_room')
+        emit_fanout('receive_message', payload, 'global_chat')
+    # 管理端按订阅 / 抽样接收，并计入统计
+    emit_to_admins(payload, get_room_key(target_uid, sender_uid))
 
 
-@socketio.on('request_chat_history')
+@socket_handler('request_chat_history')
 def handle_history_request(data):
     sid = request.sid
 
@@ -515,76 +1227,109 @@ def handle_history_request(data):
         return
 
     requester_uid = client_info.get('uid')
+    if rate_limited('history'):
+        return
     # -------------------------------
 
     target_uid = data.get('target_uid')
-    limit = data.get('limit', 128)
+    limit = clamp_history_limit(data.get('limit', 128))
 
     if target_uid == 'global':
         target_uid = None
 
-    if target_uid is None:
-        folder = os.path.join(LOGS_DIR, "global_chat")
-    else:
-        # 确保 UID 是字符串，防止类型错误
-        u1, u2 = sorted([str(requester_uid), str(target_uid)])
-        folder = os.path.join(LOGS_DIR, f"{u1}_{u2}")
+    room_key = get_room_key(target_uid, requester_uid)
 
     # print(f"\n--- [DEBUG: HISTORY REQUEST] ---")
     # print(f"1. Request SID: {sid}")
     # print(f"2. Requester UID (Server view): {requester_uid}")  # 重点观察这里是否为 None
     # print(f"3. Target UID: {target_uid}")
-    # print(f"4. Absolute Path: {folder}")
-    # print(f"5. Path Exists?: {os.path.exists(folder)}")
+    # print(f"4. Room Key: {room_key}")
     # print(f"--------------------------------\n")
 
-    history = read_recent_logs(folder, limit=int(limit))
+    history, cursor = load_room_history(room_key, limit,
+                                        before=data.get('before'), before_ts=data.get('before_ts'))
+    # 增量同步：客户端本地已有的部分不再下发 (since 格式见 history_reader.trim_since)
+    if data.get('since'):
+        history, cursor = history_reader.trim_since(history, cursor, data['since'])
+
+    emit_to_sid('history_loaded', {
+        'messages': [attach_media_variants(m) for m in history],
+        'target_uid': target_uid or 'global',
+        'cursor': cursor,  # 继续向前翻页时作为 before 传回
+        'before': data.get('before'),
+        'since': data.get('since'),
+        'request_id': data.get('request_id')  # 原样带回，客户端据此匹配请求
+    }, sid)
+
+
+@socket_handler('search_history')
+def handle_search_history(data):
+    """
+    全文检索聊天记录，结果作为 ack 返回 (客户端用 call / 回调接收)
+    data: {'q': '关键词', 'offset': 0, 'limit': 20, 'target_uid': 可选，只搜与该用户的私聊 ('global' 为群聊)}
+    只能搜到群聊和自己参与的私聊
+    """
+    client_info = clients.get(request.sid, {})
+    if not client_info.get('verified'):
+        return {'status': 'error', 'msg': 'Please login first'}
+    if rate_limited('search'):
+        return {'status': 'error', 'msg': 'Too many searches, slow down'}
+
+    uid = client_info.get('uid')
+    target_uid = data.get('target_uid')
+    room = get_room_key(None if target_uid == 'global' else target_uid, uid) if target_uid else None
+    try:
+        result = runtime.run_blocking(search_index.search, str(data.get('q') or ''), uid=uid, room=room,
+                                      offset=data.get('offset', 0), limit=data.get('limit', 20))
+    except (TypeError, ValueError):
+        return {'status': 'error', 'msg': 'Bad offset / limit'}
+    result['status'] = 'ok'
+    return result
+
 
-    emit('history_loaded', {'messages': history, 'target_uid': target_uid or 'global'}, room=sid)
+def admin_room_key(room_id):
+    """管理页的房间名 -> 日志房间 key，无法解析时返回 None"""
+    if room_id == 'Global Chat':
+        return "global_chat"
+    if '<->' in room_id:
+        # 解析私聊房间名 "UID1 <-> UID2"
+        # ADMIN 相关的 (ADMIN <-> UID) 也一样：ADMIN 发的消息存入对应用户的文件夹，遵循 UID 排序规则
+        parts = room_id.split(' <-> ')
+        if len(parts) == 2:
+            # 重新排序以匹配文件夹命名规则
+            return get_room_key(parts[0], parts[1])
+    return None
 
-@socketio.on('admin_request_history')
+
+@socket_handler('admin_request_history')
 def handle_admin_request_history(data):
     """
     管理员请求特定房间的历史记录
     data: {'room_id': 'UID1 <-> UID2'} 或 {'room_id': 'Global Chat'}
     """
     room_id = data.get('room_id')
-    limit = 256  # 管理员端默认读取 256 条
+    limit = MAX_HISTORY_PAGE  # 管理员端默认读取一整页
 
-    if not room_id:
+    if not room_id or admin_denied():
         return
 
-    folder = None
-
-    if room_id == 'Global Chat':
-        folder = os.path.join(LOGS_DIR, "global_chat")
-    elif '<->' in room_id:
-        # 解析私聊房间名 "UID1 <-> UID2"
-        try:
-            parts = room_id.split(' <-> ')
-            if len(parts) == 2:
-                # 重新排序以匹配文件夹命名规则
-                u1, u2 = sorted([parts[0], parts[1]])
-                folder = os.path.join(LOGS_DIR, f"{u1}_{u2}")
-        except:
-            pass
-
-    # 如果是 ADMIN 相关的特殊格式 (ADMIN <-> UID)，逻辑类似
-    # 但由于 ADMIN 发消息也会存入对应用户的文件夹，通常遵循 UID 排序规则
-    # 这里假设 ADMIN 的 UID 就是 "ADMIN"
-
-    if folder:
-        history = read_recent_logs(folder, limit)
+    room_key = admin_room_key(room_id)
+    if room_key:
+        history, cursor = load_room_history(room_key, limit, before=data.get('before'))
         # 将历史记录发回给管理员
-        emit('admin_history_loaded', {'room_id': room_id, 'messages': history}, room='admin_room')
+        emit('admin_history_loaded', {'room_id': room_id, 'cursor': cursor,
+                                      'messages': [attach_media_variants(m) for m in history]},
+             room='admin_room')
+
 
-@socketio.on('admin_send_message')
+@socket_handler('admin_send_message')
 def handle_admin_message(data):
     target_uid = data.get('target_uid')
     content = data.get('content')
     ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    if not target_uid: return
+    if not target_uid or admin_denied():
+        return
 
     append_to_chat_log('Admin', 'ADMIN', target_uid, content, 'text', ts)
 
@@ -593,15 +1338,24 @@ def handle_admin_message(data):
         'type': 'text', 'timestamp': ts, 'target_uid': target_uid
     }
 
-    if target_uid in uid_to_sid:
-        emit('receive_message', payload, room=uid_to_sid[target_uid])
-    emit('receive_message', payload, to='admin_room')
+    emit_fanout('receive_message', payload, user_room(target_uid))
+    stash_if_offline(target_uid, payload)
+    emit_to_admins(payload, get_room_key(target_uid, 'ADMIN'))
 
 
 if __name__ == '__main__':
-    start_ngrok_and_upload()
-    Timer(1.5, lambda: webbrowser.open('http://127.0.0.1:5005/admin')).start()
-    print("SERVER STARTED ON 5005")
-
-    socketio.run(app, host='0.0.0.0', port=5005, allow_unsafe_werkzeug=True)
-
+    # 多进程部署时只由 0 号进程开隧道、打开管理页、做媒体 GC 和日志归档
+    if WORKER_ID == '0':
+        start_ngrok_and_upload()
+        if OPEN_BROWSER:
+            Timer(1.5, open_admin_page).start()
+        socketio.start_background_task(media_gc_loop)
+        socketio.start_background_task(log_compaction_loop)
+        socketio.start_background_task(search_backfill_task)
+    socketio.start_background_task(slow_consumer_loop)
+    presence.start()
+    socketio.start_background_task(admin_stats_loop)
+    print(f"SERVER STARTED ON {SERVER_PORT} ({ASYNC_MODE}, worker {WORKER_ID}"
+          f"{', message queue ' + MESSAGE_QUEUE if MESSAGE_QUEUE else ''})")
+
+    socketio.run(app, host='0.0.0.0', port=SERVER_PORT, **runtime.run_kwargs(MAX_CONNECTIONS))
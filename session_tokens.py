@@ -0,0 +1,171 @@
+"""
+自签名、带过期时间的登录 Token (静默重连用)。
+
+原来 Token 是随机串，存在共享存储的 'tokens' 名字空间里；单进程时那是内存字典，
+服务器一重启所有 Token 失效，全部客户端同时退回验证码登录，是负载最高的时刻。
+现在 Token 自带内容并用 HMAC-SHA256 签名，校验只需一次哈希，不依赖服务器端保存的会话：
+
+    <uid>.<签发时间>.<版本>.<随机数>.<签名>
+
+- 密钥存在 STORAGE_ROOT 下的文件里 (首次启动时生成)，重启后旧 Token 仍然有效；
+  多台机器部署时用环境变量 CHAT_SESSION_SECRET 让它们用同一个密钥
+- 有效期 ttl 秒，用过一半后重连时换发新的 (滑动续期)
+- 吊销：
+    revoke_token(token)  单个 Token (退出登录)，记到过期为止
+    revoke_user(uid)     该用户之前签发的全部 Token (改密码)，用户的版本号加一
+  吊销记录放在共享存储里 (多进程共用)，同时写入一个小 JSON 文件，重启时装回
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+SECRET_BYTES = 32
+TOKEN_PARTS = 5
+
+
+def load_secret(path, override=None):
+    """读取签名密钥，文件不存在时生成 (多个进程同时启动时只有一个能创建成功)"""
+    if override:
+        return override.encode('utf-8')
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        for _ in range(50):  # 另一个进程刚创建，可能还没写完
+            with open(path, 'rb') as f:
+                secret = f.read().strip()
+            if secret:
+                return bytes.fromhex(secret.decode('ascii'))
+            time.sleep(0.1)
+        raise RuntimeError(f"Empty session secret file: {path}")
+    secret = os.urandom(SECRET_BYTES)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(secret.hex().encode('ascii'))
+    return secret
+
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+class SessionTokens:
+    def __init__(self, secret, store, ttl=30 * 86400, revocation_path=None):
+        self.secret = secret
+        self.store = store  # shared_state 存储：'token_revoked' 记单个 Token，计数器 'token_version' 记用户版本
+        self.ttl = ttl
+        self.revocation_path = revocation_path
+        self.lock = threading.Lock()
+        self.issued = 0
+        self.verified = 0
+        self.rejected = {}
+        self._load_revocations()
+
+    # ---------- 签发与校验 ----------
+
+    def _sign(self, body):
+        return _b64(hmac.new(self.secret, body.encode('utf-8'), hashlib.sha256).digest()[:18])
+
+    def issue(self, uid):
+        # 随机数让同一秒内签发给同一用户的 Token 互不相同，可以单独吊销
+        body = f"{uid}.{int(time.time())}.{self.store.counter('token_version', str(uid))}.{_b64(os.urandom(6))}"
+        self.issued += 1
+        return f"{body}.{self._sign(body)}"
+
+    def _reject(self, reason):
+        with self.lock:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        return False, reason
+
+    def verify(self, uid, token):
+        """返回 (是否有效, 原因)；原因为 ok / malformed / uid_mismatch / bad_signature / expired / revoked"""
+        parts = str(token or '').split('.')
+        if len(parts) != TOKEN_PARTS or not parts[1].isdigit() or not parts[2].isdigit():
+            return self._reject('malformed')
+        token_uid, issued_at, version, _, signature = parts
+        if token_uid != str(uid):
+            return self._reject('uid_mismatch')
+        if not hmac.compare_digest(signature, self._sign('.'.join(parts[:-1]))):
+            return self._reject('bad_signature')
+        if int(issued_at) + self.ttl < time.time():
+            return self._reject('expired')
+        if int(version) < self.store.counter('token_version', token_uid) or \
+                self.store.get('token_revoked', signature):
+            return self._reject('revoked')
+        self.verified += 1
+        return True, 'ok'
+
+    def needs_refresh(self, token):
+        """已经用了一半有效期，应换发新 Token"""
+        try:
+            return int(str(token).split('.')[1]) + self.ttl / 2 < time.time()
+        except (IndexError, ValueError):
+            return True
+
+    # ---------- 吊销 ----------
+
+    def revoke_token(self, token):
+        parts = str(token or '').split('.')
+        if len(parts) != TOKEN_PARTS or not parts[1].isdigit():
+            return False
+        expires_at = int(parts[1]) + self.ttl
+        remaining = expires_at - time.time()
+        if remaining <= 0:
+            return False
+        self.store.set('token_revoked', parts[-1], expires_at, ttl=remaining)
+        self._save_revocations()
+        return True
+
+    def revoke_user(self, uid):
+        """让该用户之前签发的所有 Token 失效，返回新的版本号"""
+        version = self.store.incr('token_version', str(uid))
+        self._save_revocations({str(uid): version})
+        return version
+
+    def _read_file(self):
+        if not self.revocation_path or not os.path.exists(self.revocation_path):
+            return {'versions': {}, 'tokens': {}}
+        try:
+            with open(self.revocation_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return {'versions': data.get('versions', {}), 'tokens': data.get('tokens', {})}
+        except (OSError, ValueError) as e:
+            print(f"[SESSION] bad revocation file: {e}")
+            return {'versions': {}, 'tokens': {}}
+
+    def _load_revocations(self):
+        """把文件里的吊销记录装回共享存储 (版本号只升不降，已过期的跳过)"""
+        data = self._read_file()
+        now = time.time()
+        for uid, version in data['versions'].items():
+            behind = int(version) - self.store.counter('token_version', uid)
+            if behind > 0:
+                self.store.incr('token_version', uid, behind)
+        for signature, expires_at in data['tokens'].items():
+            if expires_at > now:
+                self.store.set('token_revoked', signature, expires_at, ttl=expires_at - now)
+
+    def _save_revocations(self, versions=None):
+        if not self.revocation_path:
+            return
+        with self.lock:
+            data = self._read_file()
+            for uid, version in (versions or {}).items():
+                data['versions'][uid] = max(int(data['versions'].get(uid, 0)), version)
+            now = time.time()
+            tokens = {s: e for s, e in data['tokens'].items() if e > now}
+            tokens.update(self.store.items('token_revoked'))
+            data['tokens'] = tokens
+            tmp_path = self.revocation_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.revocation_path)
+
+    def stats(self):
+        with self.lock:
+            rejected = dict(self.rejected)
+        return {'issued': self.issued, 'verified': self.verified, 'rejected': sum(rejected.values()),
+                **{f"rejected_{k}": v for k, v in rejected.items()},
+                'revoked_tokens': len(self.store.items('token_revoked'))}
@@ -0,0 +1,126 @@
+"""
+多个服务器进程共享的状态 (登录 Token、验证码、在线状态)。
+
+单进程时用 LocalStateStore (普通字典 + 锁)；多进程 / 多机部署时用 RedisStateStore，
+所有进程连同一个 Redis，互相能看到对方写入的数据。两者接口相同：
+
+    get(ns, key) / set(ns, key, value, ttl=None) / pop(ns, key) / delete(ns, key)
+    items(ns)                      -> {key: value}，ns 下所有未过期的条目
+    incr(ns, key, amount=1)        -> 原子加减后的整数 (计数器与普通值分开存放)
+    counter(ns, key)               -> 计数器当前值
+
+值必须能被 JSON 序列化。ttl 单位为秒，过期条目在读取时视为不存在。
+"""
+import json
+import threading
+import time
+
+
+def open_state_store(url=None, prefix='chat'):
+    """url 为空或 'local' 返回进程内存储，'redis://...' 返回 Redis 存储"""
+    if not url or url == 'local':
+        return LocalStateStore()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStateStore(url, prefix)
+    raise ValueError(f"Unsupported state store url: {url}")
+
+
+class LocalStateStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}      # ns -> {key: (value, expires_at 或 0)}
+        self.counters = {}  # ns -> {key: int}
+
+    @staticmethod
+    def _alive(slot):
+        return slot is not None and (not slot[1] or slot[1] > time.time())
+
+    def get(self, ns, key, default=None):
+        with self.lock:
+            slot = self.data.get(ns, {}).get(key)
+            return slot[0] if self._alive(slot) else default
+
+    def set(self, ns, key, value, ttl=None):
+        with self.lock:
+            self.data.setdefault(ns, {})[key] = (value, time.time() + ttl if ttl else 0)
+
+    def pop(self, ns, key, default=None):
+        with self.lock:
+            slot = self.data.get(ns, {}).pop(key, None)
+            return slot[0] if self._alive(slot) else default
+
+    def delete(self, ns, key):
+        self.pop(ns, key)
+
+    def items(self, ns):
+        with self.lock:
+            return {k: slot[0] for k, slot in self.data.get(ns, {}).items() if self._alive(slot)}
+
+    def incr(self, ns, key, amount=1):
+        with self.lock:
+            bucket = self.counters.setdefault(ns, {})
+            bucket[key] = bucket.get(key, 0) + amount
+            return bucket[key]
+
+    def counter(self, ns, key):
+        with self.lock:
+            return self.counters.get(ns, {}).get(key, 0)
+
+
+class RedisStateStore:
+    """
+    每个 ns 对应一个 Redis hash "<prefix>:<ns>"，字段值为 JSON [value, expires_at]；
+    计数器放在 "<prefix>:<ns>:n" 中用 HINCRBY 原子更新。
+    Redis 7.4 之前 hash 字段不能单独设置过期时间，因此过期在读取时判断，过期条目顺手删除。
+    """
+
+    def __init__(self, url, prefix='chat'):
+        import redis  # 可选依赖，只有多进程模式需要
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, ns):
+        return f"{self.prefix}:{ns}"
+
+    def _decode(self, ns, key, raw):
+        if raw is None:
+            return None, False
+        value, expires = json.loads(raw)
+        if expires and expires <= time.time():
+            self.redis.hdel(self._key(ns), key)
+            return None, False
+        return value, True
+
+    def get(self, ns, key, default=None):
+        value, ok = self._decode(ns, key, self.redis.hget(self._key(ns), key))
+        return value if ok else default
+
+    def set(self, ns, key, value, ttl=None):
+        self.redis.hset(self._key(ns), key, json.dumps([value, time.time() + ttl if ttl else 0]))
+
+    def pop(self, ns, key, default=None):
+        pipe = self.redis.pipeline()
+        pipe.hget(self._key(ns), key)
+        pipe.hdel(self._key(ns), key)
+        raw, _ = pipe.execute()
+        value, ok = self._decode(ns, key, raw)
+        return value if ok else default
+
+    def delete(self, ns, key):
+        self.redis.hdel(self._key(ns), key)
+
+    def items(self, ns):
+        out = {}
+        for key, raw in self.redis.hgetall(self._key(ns)).items():
+            key = key.decode()
+            value, ok = self._decode(ns, key, raw)
+            if ok:
+                out[key] = value
+        return out
+
+    def incr(self, ns, key, amount=1):
+        return int(self.redis.hincrby(self._key(ns) + ':n', key, amount))
+
+    def counter(self, ns, key):
+        raw = self.redis.hget(self._key(ns) + ':n', key)
+        return int(raw) if raw is not None else 0
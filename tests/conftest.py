@@ -0,0 +1,9 @@
+"""
+测试直接导入仓库根目录下的模块 (和服务器 / 客户端一样是平铺的脚本，没有打包)。
+
+    python -m pytest -q
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
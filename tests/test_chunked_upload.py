@@ -0,0 +1,144 @@
+import hashlib
+import io
+import os
+import random
+
+import pytest
+
+import chunked_upload
+import media_store
+from chunked_upload import MIN_CHUNK_SIZE, ChunkedUploadManager
+
+LIMITS = {'image': 4 * 1024 * 1024, 'video': 16 * 1024 * 1024, 'other': 1024 * 1024}
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    media = tmp_path / 'media'
+    media.mkdir()
+    return str(tmp_path / 'tmp'), str(media)
+
+
+def payload(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+
+def chunk(data, session, index):
+    start = index * session.chunk_size
+    return io.BytesIO(data[start:start + session.chunk_length(index)])
+
+
+def test_out_of_order_upload_names_file_by_content(dirs):
+    tmp_dir, media = dirs
+    data = payload(MIN_CHUNK_SIZE * 3 + 100)
+    uploads = ChunkedUploadManager(tmp_dir, LIMITS)
+    session = uploads.init('image', 'image/png', len(data), MIN_CHUNK_SIZE)
+    assert session.chunks == 4 and session.chunk_length(3) == 100
+    for index in (2, 0, 3, 1, 2):  # 乱序，第 2 块重传
+        uploads.put_chunk(session.upload_id, index, chunk(data, session, index))
+
+    file_name, deduped = uploads.finalize(session.upload_id, media)
+    # 与单次上传 (media_store.save_stream) 同一个名字
+    assert file_name == hashlib.sha256(data).hexdigest() + '.png' and not deduped
+    assert open(os.path.join(media, file_name), 'rb').read() == data
+    assert os.listdir(tmp_dir) == [] and uploads.stats() == {'active': 0, 'bytes_pending': 0}
+
+    again = uploads.init('image', 'image/png', len(data), MIN_CHUNK_SIZE)
+    for index in range(again.chunks):
+        uploads.put_chunk(again.upload_id, index, chunk(data, again, index))
+    assert uploads.finalize(again.upload_id, media) == (file_name, True)
+
+
+def test_resume_after_restart(dirs):
+    tmp_dir, media = dirs
+    data = payload(MIN_CHUNK_SIZE * 2 + 1, seed=1)
+    uploads = ChunkedUploadManager(tmp_dir, LIMITS)
+    session = uploads.init('video', 'video/mp4', len(data), MIN_CHUNK_SIZE)
+    uploads.put_chunk(session.upload_id, 0, chunk(data, session, 0))
+    uploads.put_chunk(session.upload_id, 2, chunk(data, session, 2))
+
+    restarted = ChunkedUploadManager(tmp_dir, LIMITS)
+    resumed = restarted.get(session.upload_id)
+    assert resumed.missing() == [1]
+    assert resumed.ranges() == [[0, MIN_CHUNK_SIZE], [MIN_CHUNK_SIZE * 2, len(data)]]
+    restarted.put_chunk(session.upload_id, 1, chunk(data, resumed, 1))
+    assert resumed.ranges() == [[0, len(data)]]
+    file_name, _ = restarted.finalize(session.upload_id, media)
+    assert open(os.path.join(media, file_name), 'rb').read() == data
+
+
+@pytest.mark.parametrize('kind, size, status', [('image', 0, 400), ('image', LIMITS['image'] + 1, 413),
+                                                ('document', LIMITS['other'] + 1, 413)])
+def test_init_rejects_bad_sizes(dirs, kind, size, status):
+    with pytest.raises(media_store.UploadError) as e:
+        ChunkedUploadManager(dirs[0], LIMITS).init(kind, 'application/octet-stream', size)
+    assert e.value.status == status
+
+
+def test_chunk_size_is_clamped(dirs):
+    uploads = ChunkedUploadManager(dirs[0], LIMITS)
+    assert uploads.init('image', 'image/png', 10, 1).chunk_size == MIN_CHUNK_SIZE
+    assert uploads.init('image', 'image/png', 10, 10 ** 9).chunk_size == chunked_upload.MAX_CHUNK_SIZE
+    assert uploads.init('image', 'image/png', 10).chunks == 1
+
+
+def test_bad_chunks_are_not_recorded(dirs):
+    tmp_dir, media = dirs
+    data = payload(MIN_CHUNK_SIZE + 10, seed=2)
+    uploads = ChunkedUploadManager(tmp_dir, LIMITS)
+    session = uploads.init('image', 'image/jpeg', len(data), MIN_CHUNK_SIZE)
+    with pytest.raises(media_store.UploadError):
+        uploads.put_chunk(session.upload_id, 2, io.BytesIO(b'x'))      # 越界
+    with pytest.raises(media_store.UploadError):
+        uploads.put_chunk(session.upload_id, 1, io.BytesIO(data[-5:]))  # 不完整
+    with pytest.raises(media_store.UploadError):
+        uploads.put_chunk(session.upload_id, 1, io.BytesIO(data))       # 超长
+    assert session.received == {} and session.writing == 0
+
+    uploads.put_chunk(session.upload_id, 0, chunk(data, session, 0))
+    with pytest.raises(media_store.UploadError) as e:
+        uploads.finalize(session.upload_id, media)
+    assert e.value.status == 409 and 'Missing chunks: [1]' in str(e.value)
+
+
+def test_no_chunks_accepted_after_finalize_or_abort(dirs):
+    tmp_dir, media = dirs
+    data = payload(100, seed=3)
+    uploads = ChunkedUploadManager(tmp_dir, LIMITS)
+    session = uploads.init('image', 'image/png', len(data))
+    uploads.put_chunk(session.upload_id, 0, io.BytesIO(data))
+    uploads.finalize(session.upload_id, media)
+    with pytest.raises(media_store.UploadError) as e:
+        uploads.put_chunk(session.upload_id, 0, io.BytesIO(data))
+    assert e.value.status == 404
+
+    aborted = uploads.init('image', 'image/png', len(data))
+    uploads.abort(aborted.upload_id)
+    with pytest.raises(media_store.UploadError):
+        uploads.finalize(aborted.upload_id, media)
+    assert os.listdir(tmp_dir) == []
+
+
+def test_finalizing_session_rejects_late_chunks(dirs):
+    # finalize 计算哈希期间 (不持锁) 到达的块必须被拒绝
+    tmp_dir, media = dirs
+    uploads = ChunkedUploadManager(tmp_dir, LIMITS)
+    session = uploads.init('image', 'image/png', 10)
+    session.finalizing = True
+    with pytest.raises(media_store.UploadError) as e:
+        uploads.put_chunk(session.upload_id, 0, io.BytesIO(b'0123456789'))
+    assert e.value.status == 409
+
+
+def test_expire_and_broken_metadata(dirs):
+    tmp_dir, _ = dirs
+    uploads = ChunkedUploadManager(tmp_dir, LIMITS)
+    old = uploads.init('image', 'image/png', 10)
+    fresh = uploads.init('image', 'image/png', 10)
+    old.created -= chunked_upload.SESSION_TTL + 1
+    assert uploads.expire() == 1
+    assert list(uploads.sessions) == [fresh.upload_id]
+
+    with open(os.path.join(tmp_dir, 'broken.json'), 'w') as f:
+        f.write('{')
+    assert list(ChunkedUploadManager(tmp_dir, LIMITS).sessions) == [fresh.upload_id]
@@ -0,0 +1,132 @@
+import json
+
+import pytest
+
+import history_reader
+
+
+def msg(ts, n, uid='1'):
+    return {'sender': f'u{uid}', 'uid': uid, 'target_uid': None, 'content': f'm{n}', 'type': 'text', 'timestamp': ts}
+
+
+def write_day(folder, day, messages):
+    with open(folder / f'{day}.log', 'w', encoding='utf-8') as f:
+        for m in messages:
+            f.write(json.dumps(m, ensure_ascii=False) + '\n')
+
+
+@pytest.fixture
+def room(tmp_path):
+    """两天的日志：第一天 5 条，第二天 6 条，其中 12:00:05 这一秒有 3 条"""
+    day1 = [msg(f'2024-05-01 09:00:0{i}', i) for i in range(5)]
+    day2 = [msg('2024-05-02 12:00:00', 5), msg('2024-05-02 12:00:01', 6),
+            msg('2024-05-02 12:00:05', 7), msg('2024-05-02 12:00:05', 8), msg('2024-05-02 12:00:05', 9),
+            msg('2024-05-02 12:00:09', 10)]
+    write_day(tmp_path, '2024-05-01', day1)
+    write_day(tmp_path, '2024-05-02', day2)
+    return tmp_path, day1 + day2
+
+
+def contents(messages):
+    return [m['content'] for m in messages]
+
+
+def test_iter_lines_reverse_small_blocks(tmp_path):
+    path = tmp_path / 'x.log'
+    path.write_bytes(b'alpha\n\nbeta\n' + '第三行'.encode('utf-8') + b'\n')
+    expected = [(12, '第三行'.encode('utf-8')), (7, b'beta'), (0, b'alpha')]
+    for block_size in (1, 3, 7, 64 * 1024):
+        assert list(history_reader.iter_lines_reverse(str(path), block_size=block_size)) == expected
+    # end 偏移之前的部分
+    assert list(history_reader.iter_lines_reverse(str(path), end=7, block_size=2)) == [(0, b'alpha')]
+
+
+def test_recent_page_spans_days(room):
+    folder, all_msgs = room
+    page, cursor = history_reader.read_logs_page(str(folder), 8)
+    assert contents(page) == contents(all_msgs[-8:])
+    assert cursor.startswith('2024-05-01.log:')
+
+
+def test_byte_cursor_pages_cover_everything_once(room):
+    folder, all_msgs = room
+    collected, cursor = [], None
+    while True:
+        page, cursor = history_reader.read_logs_page(str(folder), 3, before=cursor)
+        collected = page + collected
+        if cursor is None:
+            break
+    assert contents(collected) == contents(all_msgs)
+
+
+def test_timestamp_cursor_inside_one_second(room):
+    # 内存缓冲给出的 "@ts#n" 游标：这一秒除去最新 n 条后更早的消息
+    folder, all_msgs = room
+    newest = all_msgs[-3:]  # m8, m9, m10
+    cursor = history_reader.cursor_before_message(newest)
+    assert cursor == '@2024-05-02 12:00:05#2'
+    page, _ = history_reader.read_logs_page(str(folder), 3, before=cursor)
+    assert contents(page) == ['m5', 'm6', 'm7']
+
+
+def test_timestamp_cursor_for_missing_day(room):
+    folder, all_msgs = room
+    page, _ = history_reader.read_logs_page(str(folder), 10, before='@2024-05-03 00:00:00#1')
+    assert contents(page) == contents(all_msgs[-10:])
+
+
+def test_before_ts(room):
+    folder, _ = room
+    page, _ = history_reader.read_logs_page(str(folder), 10, before_ts='2024-05-02 12:00:05')
+    assert contents(page) == ['m0', 'm1', 'm2', 'm3', 'm4', 'm5', 'm6']
+
+
+def test_bad_lines_and_empty_folder(tmp_path):
+    (tmp_path / '2024-05-01.log').write_text('not json\n' + json.dumps(msg('2024-05-01 00:00:00', 0)) + '\n{broken')
+    assert contents(history_reader.read_recent_logs(str(tmp_path))) == ['m0']
+    assert history_reader.read_logs_page(str(tmp_path / 'missing'), 10) == ([], None)
+    assert history_reader.read_logs_page(str(tmp_path), 0) == ([], None)
+
+
+@pytest.mark.parametrize('cursor', [None, '', 'garbage', 'file.log:abc', '@no-count'])
+def test_parse_cursor_rejects_malformed(cursor):
+    assert history_reader.parse_cursor(cursor) is None
+
+
+def test_parse_cursor_strips_directories():
+    assert history_reader.parse_cursor('../../etc/2024-05-01.log:12') == ('2024-05-01.log', 12)
+
+
+# ---------- trim_since ----------
+
+@pytest.mark.parametrize('since, expected', [
+    ('@2024-05-02 12:00:05#2', ['m9', 'm10']),   # 这一秒已有前 2 条
+    ('@2024-05-02 12:00:05#0', ['m7', 'm8', 'm9', 'm10']),
+    ('@2024-05-02 12:00:09#1', []),              # 已是最新
+    ('@2024-05-02 12:00:03#0', ['m7', 'm8', 'm9', 'm10']),  # 这一秒没有消息
+])
+def test_trim_since_within_page(room, since, expected):
+    folder, _ = room
+    page, cursor = history_reader.read_logs_page(str(folder), 6)
+    trimmed, next_cursor = history_reader.trim_since(page, cursor, since)
+    assert contents(trimmed) == expected
+    assert next_cursor is None
+
+
+def test_trim_since_needs_more_pages(room):
+    # 本页最早一条都比 since 新：原样返回，带着游标继续要更早的
+    folder, all_msgs = room
+    page, cursor = history_reader.read_logs_page(str(folder), 2)
+    trimmed, next_cursor = history_reader.trim_since(page, cursor, '@2024-05-01 09:00:02#1')
+    assert (trimmed, next_cursor) == (page, cursor)
+    page, cursor = history_reader.read_logs_page(str(folder), 20, before=next_cursor)
+    trimmed, next_cursor = history_reader.trim_since(page, cursor, '@2024-05-01 09:00:02#1')
+    assert contents(trimmed) == contents(all_msgs[3:-2])
+    assert next_cursor is None
+
+
+def test_trim_since_ignores_malformed(room):
+    folder, _ = room
+    page, cursor = history_reader.read_logs_page(str(folder), 3)
+    assert history_reader.trim_since(page, cursor, 'garbage') == (page, cursor)
+    assert history_reader.parse_since('@2024-05-01 00:00:00#-4') == ('2024-05-01 00:00:00', 0)
@@ -0,0 +1,138 @@
+import json
+import os
+
+import pytest
+
+import history_reader
+import log_archive
+
+
+def msg(i, day='2024-05-01'):
+    m = {'sender': f'u{i % 3}', 'uid': str(i % 3), 'target_uid': None, 'content': f'消息 {i}', 'type': 'text',
+         'timestamp': f'{day} 10:{i // 60:02d}:{i % 60:02d}'}
+    if i % 7 == 0:
+        m = dict(m, type='image', content=f'/uploads/media/{i}.png')  # 不同形状的行
+    return m
+
+
+def write_log(path, messages, junk=False):
+    with open(path, 'w', encoding='utf-8') as f:
+        for i, m in enumerate(messages):
+            f.write(json.dumps(m) + '\n')
+            if junk and i % 5 == 0:
+                f.write('\n{not json\n')  # 坏行和空行的字节计入上一条，偏移保持不变
+
+
+def compact(log_path, block_rows=4):
+    """和 compact_file 相同，但块更小，方便覆盖跨块的情况"""
+    rows, size = log_archive._iter_log_rows(log_path)
+    log_archive.write_archive(log_archive.archive_path(log_path), rows, size, block_rows=block_rows,
+                              source=[os.stat(log_path).st_ino, size])
+    os.remove(log_path)
+
+
+def all_pages(folder, limit):
+    pages, cursor = [], None
+    while True:
+        page, cursor = history_reader.read_logs_page(folder, limit, before=cursor)
+        pages.append((page, cursor))
+        if cursor is None:
+            return pages
+
+
+def test_archive_keeps_messages_and_offsets(tmp_path):
+    log_path = str(tmp_path / '2024-05-01.log')
+    messages = [msg(i) for i in range(30)]
+    write_log(log_path, messages, junk=True)
+    expected = [(offset, json.loads(raw)) for offset, raw in history_reader.iter_lines_reverse(log_path)
+                if raw.startswith(b'{"')][::-1]
+    size = os.path.getsize(log_path)
+    compact(log_path)
+
+    reader = log_archive.ArchiveReader(log_path + 'z')
+    assert list(reader.iter_forward()) == expected
+    assert reader.count == 30 and reader.size == size and len(reader.blocks) == 8
+    assert list(reader.iter_reverse(end=expected[10][0])) == expected[:10][::-1]
+
+
+def test_history_pages_identical_before_and_after_compaction(tmp_path):
+    folder = str(tmp_path)
+    write_log(os.path.join(folder, '2024-05-01.log'), [msg(i) for i in range(25)], junk=True)
+    write_log(os.path.join(folder, '2024-05-02.log'), [msg(i, '2024-05-02') for i in range(10)])
+    before = all_pages(folder, 6)
+    by_ts = history_reader.read_logs_page(folder, 5, before_ts='2024-05-01 10:00:13')
+    by_ts_cursor = history_reader.read_logs_page(folder, 5, before='@2024-05-01 10:00:14#1')
+
+    compact(os.path.join(folder, '2024-05-01.log'))
+    assert history_reader.list_log_files(folder) == ['2024-05-02.log', '2024-05-01.log']
+    # 压缩前拿到的游标压缩后仍然有效
+    assert all_pages(folder, 6) == before
+    assert history_reader.read_logs_page(folder, 5, before_ts='2024-05-01 10:00:13') == by_ts
+    assert history_reader.read_logs_page(folder, 5, before='@2024-05-01 10:00:14#1') == by_ts_cursor
+
+
+def test_late_messages_are_merged_into_archive(tmp_path):
+    log_path = str(tmp_path / '2024-05-01.log')
+    write_log(log_path, [msg(i) for i in range(5)])
+    log_archive.compact_file(log_path)
+    # 压缩后又有迟到的消息写进新的 .log
+    write_log(log_path, [msg(i) for i in range(5, 8)])
+    log_archive.compact_file(log_path)
+    assert not os.path.exists(log_path)
+    reader = log_archive.ArchiveReader(log_path + 'z')
+    got = list(reader.iter_forward())
+    assert [m for _, m in got] == [msg(i) for i in range(8)]
+    assert [o for o, _ in got] == sorted({o for o, _ in got})  # 偏移严格递增
+
+
+def test_expand_restores_log(tmp_path):
+    log_path = str(tmp_path / '2024-05-01.log')
+    write_log(log_path, [msg(i) for i in range(12)])
+    original = open(log_path, 'rb').read()
+    log_archive.compact_file(log_path)
+    assert log_archive.expand_file(log_path + 'z') == log_path
+    assert open(log_path, 'rb').read() == original
+    assert not os.path.exists(log_path + 'z')
+
+
+def test_compact_logs_skips_today_and_recent(tmp_path):
+    room = tmp_path / 'global'
+    room.mkdir()
+    for day in ('2024-05-01', '2024-05-02', '2024-05-03'):
+        write_log(str(room / f'{day}.log'), [msg(i, day) for i in range(3)])
+    old = os.path.getmtime(room / '2024-05-01.log') - 7200
+    os.utime(room / '2024-05-01.log', (old, old))
+
+    stats = log_archive.compact_logs(str(tmp_path), today='2024-05-03')
+    assert stats['files'] == 1 and stats['errors'] == 0
+    assert sorted(os.listdir(room)) == ['2024-05-01.logz', '2024-05-02.log', '2024-05-03.log']
+    usage = log_archive.usage(str(tmp_path))
+    assert usage['log'][0] == 2 and usage['logz'][0] == 1 and usage['logz_original'] == stats['bytes_in']
+
+
+def test_find_references(tmp_path):
+    log_path = str(tmp_path / '2024-05-01.log')
+    write_log(log_path, [msg(i) for i in range(15)])
+    log_archive.compact_file(log_path)
+    assert log_archive.find_references([log_path + 'z'], b'/uploads/media/') == {'0.png', '7.png', '14.png'}
+
+
+def test_damaged_archive(tmp_path):
+    path = tmp_path / '2024-05-01.logz'
+    path.write_bytes(b'CHATLOGZ')
+    with pytest.raises(log_archive.ArchiveError):
+        log_archive.ArchiveReader(str(path))
+    path.write_bytes(b'CHATLOGZ' + b'\0' * 40)
+    with pytest.raises(log_archive.ArchiveError):
+        log_archive.ArchiveReader(str(path))
+    with pytest.raises(log_archive.ArchiveError):
+        log_archive.find_references([str(path)], b'/uploads/media/')
+
+
+@pytest.mark.skipif(log_archive.zstandard is None, reason='zstandard not installed')
+def test_zstd_codec(tmp_path):
+    log_path = str(tmp_path / '2024-05-01.log')
+    write_log(log_path, [msg(i) for i in range(10)])
+    log_archive.compact_file(log_path, codec='zstd')
+    reader = log_archive.ArchiveReader(log_path + 'z')
+    assert reader.codec == 'zstd' and [m for _, m in reader.iter_forward()] == [msg(i) for i in range(10)]
@@ -0,0 +1,108 @@
+import pytest
+
+import session_tokens
+from session_tokens import SessionTokens, load_secret
+from shared_state import LocalStateStore
+
+SECRET = b'k' * 32
+
+
+@pytest.fixture
+def tokens(tmp_path):
+    return SessionTokens(SECRET, LocalStateStore(), ttl=3600, revocation_path=str(tmp_path / 'revoked.json'))
+
+
+def restart(tokens, secret=SECRET):
+    """新进程：内存里的共享存储是空的，只剩密钥和吊销文件"""
+    return SessionTokens(secret, LocalStateStore(), ttl=tokens.ttl, revocation_path=tokens.revocation_path)
+
+
+def test_issue_and_verify(tokens):
+    token = tokens.issue('1001')
+    assert tokens.verify('1001', token) == (True, 'ok')
+    assert tokens.verify(1001, token) == (True, 'ok')  # uid 可以是数字
+    assert token != tokens.issue('1001')  # 同一秒签发的也互不相同
+
+
+@pytest.mark.parametrize('token', [None, '', 'abc', '1001.x.0.r.sig', '1001.1.y.r.sig', '1.2.3.4.5.6'])
+def test_malformed(tokens, token):
+    assert tokens.verify('1001', token) == (False, 'malformed')
+
+
+def test_uid_mismatch_and_tampering(tokens):
+    token = tokens.issue('1001')
+    assert tokens.verify('1002', token) == (False, 'uid_mismatch')
+    uid, issued, version, nonce, sig = token.split('.')
+    forged = '.'.join([uid, str(int(issued) + 100000), version, nonce, sig])
+    assert tokens.verify('1001', forged) == (False, 'bad_signature')
+    assert tokens.verify('1001', token[:-1] + ('A' if token[-1] != 'A' else 'B')) == (False, 'bad_signature')
+    assert tokens.stats()['rejected'] == 3
+
+
+def test_survives_restart_but_not_a_new_secret(tokens):
+    token = tokens.issue('1001')
+    assert restart(tokens).verify('1001', token) == (True, 'ok')
+    assert restart(tokens, b'x' * 32).verify('1001', token) == (False, 'bad_signature')
+
+
+def test_expiry_and_refresh(tokens, monkeypatch):
+    now = 1_700_000_000
+    monkeypatch.setattr(session_tokens.time, 'time', lambda: now)
+    token = tokens.issue('1001')
+    assert not tokens.needs_refresh(token)
+    now += tokens.ttl // 2 + 1
+    assert tokens.needs_refresh(token)
+    assert tokens.verify('1001', token) == (True, 'ok')
+    now += tokens.ttl
+    assert tokens.verify('1001', token) == (False, 'expired')
+    assert tokens.needs_refresh('garbage')
+
+
+def test_revoke_token_persists_across_restart(tokens):
+    token, other = tokens.issue('1001'), tokens.issue('1001')
+    assert tokens.revoke_token(token)
+    assert tokens.verify('1001', token) == (False, 'revoked')
+    assert tokens.verify('1001', other) == (True, 'ok')
+    fresh = restart(tokens)
+    assert fresh.verify('1001', token) == (False, 'revoked')
+    assert fresh.verify('1001', other) == (True, 'ok')
+    assert not tokens.revoke_token('garbage')
+
+
+def test_revoke_user_persists_across_restart(tokens):
+    old = tokens.issue('1001')
+    bystander = tokens.issue('1002')
+    assert tokens.revoke_user('1001') == 1
+    new = tokens.issue('1001')
+    fresh = restart(tokens)
+    assert fresh.verify('1001', old) == (False, 'revoked')
+    assert fresh.verify('1001', new) == (True, 'ok')
+    assert fresh.verify('1002', bystander) == (True, 'ok')
+    # 版本号只升不降：重启后再改一次密码
+    assert fresh.revoke_user('1001') == 2
+    assert restart(tokens).verify('1001', new) == (False, 'revoked')
+
+
+def test_expired_revocations_are_dropped(tokens, monkeypatch):
+    now = 1_700_000_000
+    monkeypatch.setattr(session_tokens.time, 'time', lambda: now)
+    tokens.revoke_token(tokens.issue('1001'))
+    assert len(tokens._read_file()['tokens']) == 1
+    now += tokens.ttl + 1
+    tokens.revoke_user('1003')  # 任何一次写文件都会顺带清掉过期的记录
+    assert tokens._read_file()['tokens'] == {}
+
+
+def test_bad_revocation_file_is_ignored(tokens):
+    with open(tokens.revocation_path, 'w') as f:
+        f.write('{not json')
+    token = tokens.issue('1001')
+    assert restart(tokens).verify('1001', token) == (True, 'ok')
+
+
+def test_load_secret(tmp_path):
+    path = str(tmp_path / 'secret.key')
+    secret = load_secret(path)
+    assert len(secret) == session_tokens.SECRET_BYTES
+    assert load_secret(path) == secret
+    assert load_secret(path, override='shared') == b'shared'
@@ -0,0 +1,99 @@
+import pytest
+
+import wire_format
+
+GLOBAL_MSG = {'sender': '张三', 'uid': '1001', 'target_uid': None, 'content': '你好',
+              'type': 'text', 'timestamp': '2024-05-01 12:00:00'}
+PRIVATE_MSG = {'sender': '李四', 'uid': '1002', 'target_uid': '1001', 'content': '/uploads/media/a.png',
+               'type': 'image', 'timestamp': '2024-05-01 12:00:07', 'thumb': '/uploads/media/a.png?w=240'}
+LIVE_MSG = {'sender': '张三', 'uid': '1001', 'content': 'hi', 'type': 'text',
+            'timestamp': '2024-05-01 23:59:59', 'temp_id': 'tmp-1', 'target_uid': '1002'}
+
+
+def formats():
+    return [f for f in wire_format.available_formats() if f != 'json']
+
+
+def decoded_shape(msg):
+    """位置编码的约定：末尾的 None 省略 (解码后没有这些键)，中间位置的缺失字段解码为 None"""
+    present = [i for i, f in enumerate(wire_format.MESSAGE_FIELDS) if msg.get(f) is not None]
+    shape = {f: msg.get(f) for f in wire_format.MESSAGE_FIELDS[:present[-1] + 1]}
+    shape.update({k: v for k, v in msg.items() if k not in wire_format.MESSAGE_FIELDS})
+    return shape
+
+
+@pytest.mark.parametrize('fmt', formats())
+@pytest.mark.parametrize('msg', [GLOBAL_MSG, PRIVATE_MSG, LIVE_MSG])
+def test_message_round_trip(fmt, msg):
+    packed = wire_format.encode('receive_message', msg, fmt)
+    assert wire_format.decode('receive_message', packed) == decoded_shape(msg)
+
+
+def test_interior_missing_field_decodes_as_none():
+    assert wire_format.decode_message(wire_format.encode_message(PRIVATE_MSG)) == dict(PRIVATE_MSG, temp_id=None)
+
+
+def test_omitted_trailing_fields_are_not_filled():
+    # 与 JSON 格式一致：没有 temp_id / target_uid / thumb 的消息解码后也没有这些键
+    msg = {k: v for k, v in GLOBAL_MSG.items() if k != 'target_uid'}
+    row = wire_format.encode_message(msg)
+    assert len(row) == len(wire_format.MESSAGE_FIELDS) - 3
+    assert wire_format.decode_message(row) == msg
+
+
+@pytest.mark.parametrize('fmt', formats())
+def test_history_page_round_trip(fmt):
+    page = {'messages': [GLOBAL_MSG, PRIVATE_MSG, GLOBAL_MSG], 'target_uid': 'global',
+            'cursor': '2024-05-01.log:123', 'request_id': 7}
+    decoded = wire_format.decode('history_loaded', wire_format.encode('history_loaded', page, fmt))
+    assert decoded['cursor'] == page['cursor'] and decoded['request_id'] == 7
+    assert decoded['messages'] == [decoded_shape(m) for m in page['messages']]
+    assert [m['timestamp'] for m in decoded['messages']] == [m['timestamp'] for m in page['messages']]
+
+
+def test_history_page_interns_repeated_strings():
+    page = wire_format.encode_messages([GLOBAL_MSG] * 3)
+    assert page['s'].count('张三') == 1
+    # 时间戳为与上一行的差值
+    assert [row[wire_format._TS_INDEX] for row in page['r']][1:] == [0, 0]
+
+
+def test_values_that_would_be_confused_with_encoding_go_to_extras():
+    # 数字 uid 会被当成字符串表下标，非标准时间戳不能换算成整数秒，都要原样还原
+    msg = {'sender': 'x', 'uid': 42, 'content': 'c', 'type': 'text', 'timestamp': 'yesterday', 'extra': [1, 2]}
+    assert wire_format.decode_messages(wire_format.encode_messages([msg])) == [msg]
+    assert wire_format.decode_message(wire_format.encode_message(msg)) == msg
+    # 附加字典紧跟在最后一个字段之后，末尾缺失的字段同样不补 None
+    assert len(wire_format.encode_message(msg)) == wire_format._TS_INDEX + 2
+
+
+def test_dict_field_value_is_not_mistaken_for_extras():
+    msg = {'sender': 'x', 'uid': '1', 'content': {'kind': 'card'}}
+    assert wire_format.decode_message(wire_format.encode_message(msg)) == msg
+    assert wire_format.decode_messages(wire_format.encode_messages([msg])) == [msg]
+
+
+def test_empty_history_page():
+    assert wire_format.decode('history_loaded', wire_format.encode('history_loaded', {'messages': []}, 'compact')) \
+        == {'messages': []}
+
+
+def test_presence_users_round_trip():
+    delta = {'version': 3, 'joins': [{'uid': '1', 'username': 'a', 'avatar': '/uploads/avatars/x.png'}],
+             'updates': [{'uid': '2', 'username': 'b'}], 'leaves': ['3']}
+    assert wire_format.decode('presence_delta', wire_format.encode('presence_delta', delta, 'compact')) == delta
+
+
+def test_json_and_unknown_events_pass_through():
+    assert wire_format.encode('receive_message', GLOBAL_MSG, 'json') is GLOBAL_MSG
+    assert wire_format.encode('show_notification', {'msg': 'x'}, 'compact') == {'msg': 'x'}
+    # 收到普通 JSON 也能按形状识别
+    assert wire_format.decode('receive_message', GLOBAL_MSG) == GLOBAL_MSG
+    assert wire_format.decode('history_loaded', {'messages': [GLOBAL_MSG]}) == {'messages': [GLOBAL_MSG]}
+
+
+def test_negotiate():
+    assert wire_format.negotiate('bogus') == 'json'
+    assert wire_format.negotiate('compact') == 'compact'
+    expected = 'msgpack' if wire_format.msgpack is not None else 'compact'
+    assert wire_format.negotiate('msgpack') == expected
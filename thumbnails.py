@@ -0,0 +1,121 @@
+"""
+聊天图片的服务端缩略图与多宽度版本。
+
+图片上传完成后把生成任务丢给后台线程池 (runtime.make_executor)，上传请求立即返回。
+每张图生成 VARIANT_WIDTHS 中比原图窄的几个宽度，保存为
+<variants 目录>/<原文件名主体>_w<宽度>.jpg，通过 /uploads/media/<文件名>?w=<宽度> 访问。
+
+依赖 Pillow (可选)。未安装时 ENABLED 为 False，所有请求都返回原图。
+"""
+import os
+import threading
+
+import runtime
+
+try:
+    from PIL import Image, ImageOps
+    ENABLED = True
+except ImportError:
+    Image = ImageOps = None
+    ENABLED = False
+
+VARIANT_WIDTHS = (240, 640, 1280)
+THUMB_WIDTH = VARIANT_WIDTHS[0]
+JPEG_QUALITY = 80
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+
+
+class ThumbnailService:
+    def __init__(self, media_dir, workers=2):
+        self.media_dir = media_dir
+        self.variant_dir = os.path.join(media_dir, 'variants')
+        os.makedirs(self.variant_dir, exist_ok=True)
+        self.pool = runtime.make_executor(workers, 'thumbnail')  # 协程模式下任务仍在原生线程执行
+        self.pending = set()
+        self.done = set()  # 已处理过的文件 (原图太窄时不会有对应版本，避免反复调度)
+        self.lock = threading.Lock()
+        self.generated = 0
+        self.failed = 0
+
+    @staticmethod
+    def is_image(file_name):
+        return os.path.splitext(file_name)[1].lower() in IMAGE_EXTENSIONS
+
+    def variant_name(self, file_name, width):
+        return f"{os.path.splitext(os.path.basename(file_name))[0]}_w{width}.jpg"
+
+    def pick_width(self, requested):
+        """请求的宽度向上取到最近的档位，超过最大档位返回 None (用原图)"""
+        for w in VARIANT_WIDTHS:
+            if requested <= w:
+                return w
+        return None
+
+    def find_variant(self, file_name, requested):
+        """
+        返回可直接发送的版本文件名 (位于 variant_dir)。
+        尚未生成时返回 None 并补一次后台生成 (兼容缩略图功能上线前的旧文件)。
+        原图本身比目标宽度还窄时不会有对应版本，此时同样返回 None。
+        """
+        if not ENABLED or not self.is_image(file_name):
+            return None
+        width = self.pick_width(requested)
+        if width is None:
+            return None
+        name = self.variant_name(file_name, width)
+        if os.path.exists(os.path.join(self.variant_dir, name)):
+            return name
+        if file_name not in self.done:
+            self.schedule(file_name)
+        return None
+
+    def schedule(self, file_name):
+        """后台生成所有宽度版本，重复调用会被合并"""
+        if not ENABLED or not self.is_image(file_name):
+            return
+        with self.lock:
+            if file_name in self.pending:
+                return
+            self.pending.add(file_name)
+        self.pool.submit(self._generate, file_name)
+
+    def _generate(self, file_name):
+        try:
+            src = os.path.join(self.media_dir, file_name)
+            with Image.open(src) as img:
+                img = ImageOps.exif_transpose(img)
+                if img.mode not in ('RGB', 'L'):
+                    img = img.convert('RGB')
+                for width in VARIANT_WIDTHS:
+                    if img.width <= width:
+                        break
+                    out = os.path.join(self.variant_dir, self.variant_name(file_name, width))
+                    if os.path.exists(out):
+                        continue
+                    height = max(1, round(img.height * width / img.width))
+                    tmp = out + '.part'
+                    img.resize((width, height), Image.LANCZOS).save(tmp, 'JPEG', quality=JPEG_QUALITY,
+                                                                     optimize=True)
+                    os.replace(tmp, out)
+            self.generated += 1
+            self.done.add(file_name)
+        except Exception as e:
+            self.failed += 1
+            print(f"[THUMBNAIL ERROR] {file_name}: {e}")
+        finally:
+            with self.lock:
+                self.pending.discard(file_name)
+
+    def sweep(self):
+        """删除原图已不存在的版本文件 (配合媒体 GC 使用)，返回删除数量"""
+        removed = 0
+        for name in os.listdir(self.variant_dir):
+            base = name.rsplit('_w', 1)[0]
+            if not any(os.path.exists(os.path.join(self.media_dir, base + ext)) for ext in IMAGE_EXTENSIONS):
+                os.remove(os.path.join(self.variant_dir, name))
+                removed += 1
+        return removed
+
+    def stats(self):
+        return {'enabled': ENABLED, 'pending': len(self.pending),
+                'generated': self.generated, 'failed': self.failed}
@@ -0,0 +1,150 @@
+"""
+ngrok 隧道与公网地址发布 (npoint)，在后台进行，不阻塞服务器启动。
+
+原来启动时先同步执行 ngrok.connect() 和 requests.post(npoint)，然后才 socketio.run：
+没有网络 / 首次要下载 ngrok 时会卡很久，局域网内的用户也只能干等。
+现在端口先监听，隧道与发布交给后台任务：
+
+    connecting -> publishing -> up ──(隧道断开)──> retrying -> connecting ...
+         └────── 失败 ──────> retrying (指数退避 + 抖动，上限 max_backoff)
+
+- 隧道已建好但发布失败时只重试发布，不重建隧道
+- up 之后每 check_interval 秒确认一次隧道还在，不在就重建并重新发布
+- 缺少 pyngrok / requests 时状态为 disabled，不再重试
+pyngrok 与 requests 只在第一次用到时才导入 (都不是启动必需的)。
+"""
+import random
+import time
+
+
+class TunnelManager:
+    def __init__(self, port, publish_url, auth_token=None, ngrok_path=None, sleep=time.sleep, blocking=None,
+                 initial_backoff=2.0, max_backoff=300.0, check_interval=60.0, publish_timeout=10.0):
+        self.port = port
+        self.publish_url = publish_url
+        self.auth_token = auth_token
+        self.ngrok_path = ngrok_path
+        self.sleep = sleep
+        # 会阻塞的调用 (启动 ngrok 进程、HTTP 请求) 经由它执行，协程模式下传 runtime.run_blocking
+        self.blocking = blocking or (lambda fn, *args: fn(*args))
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.check_interval = check_interval
+        self.publish_timeout = publish_timeout
+
+        self.state = 'idle'
+        self.public_url = None
+        self.published = False
+        self.attempts = 0
+        self.failures = 0
+        self.last_error = None
+        self.changed_at = time.time()
+        self.next_retry_at = None
+        self.created = time.monotonic()
+        self.ready_seconds = None  # 从创建到第一次发布成功
+        self.stopped = False
+
+    def _set(self, state, error=None):
+        self.state = state
+        self.changed_at = time.time()
+        if error is not None:
+            self.last_error = error
+
+    # ---------- 单步操作 (阻塞) ----------
+
+    def _connect(self):
+        from pyngrok import ngrok, conf  # 可选依赖，只在需要隧道时导入
+        config = conf.get_default()
+        if self.ngrok_path:
+            config.ngrok_path = self.ngrok_path
+        if self.auth_token:
+            config.auth_token = self.auth_token
+        return ngrok.connect(self.port).public_url
+
+    def _publish(self, url):
+        import requests
+        r = requests.post(self.publish_url, json={"url": url}, timeout=self.publish_timeout)
+        r.raise_for_status()
+
+    def _alive(self):
+        from pyngrok import ngrok
+        return any(t.public_url == self.public_url for t in ngrok.get_tunnels())
+
+    def step(self):
+        """建隧道 (如果还没有) 并发布地址 (如果还没发布)，失败时抛出异常"""
+        self.attempts += 1
+        if not self.public_url:
+            self._set('connecting')
+            self.public_url = self.blocking(self._connect)
+            self.published = False
+            print(f"[NGROK] {self.public_url}")
+        if not self.published:
+            self._set('publishing')
+            self.blocking(self._publish, self.public_url)
+            self.published = True
+        if self.ready_seconds is None:
+            self.ready_seconds = round(time.monotonic() - self.created, 2)
+        self.next_retry_at = None
+        self._set('up')
+
+    def try_once(self):
+        """step() 的不抛异常版本，返回是否成功；缺少依赖时置为 disabled"""
+        try:
+            self.step()
+            return True
+        except ImportError as e:
+            self._set('disabled', f"missing dependency: {e}")
+            print(f"[TUNNEL] disabled ({e})")
+        except Exception as e:
+            self.failures += 1
+            self._set('retrying', f"{type(e).__name__}: {e}")
+            print(f"[TUNNEL ERROR] {self.last_error}")
+        return False
+
+    # ---------- 后台任务 ----------
+
+    def run(self):
+        """后台任务主循环：失败退避重试，成功后定期检查隧道"""
+        delay = self.initial_backoff
+        while not self.stopped and self.state != 'disabled':
+            if self.state != 'up':
+                if not self.try_once():
+                    if self.state == 'disabled':
+                        return
+                    wait = delay * random.uniform(0.8, 1.2)
+                    self.next_retry_at = time.time() + wait
+                    self.sleep(wait)
+                    delay = min(delay * 2, self.max_backoff)
+                    continue
+                delay = self.initial_backoff
+
+            self.sleep(self.check_interval)
+            try:
+                alive = self.blocking(self._alive)
+                error = 'tunnel closed'
+            except Exception as e:
+                alive, error = False, f"{type(e).__name__}: {e}"
+            if not alive:
+                self.failures += 1
+                self.public_url = None
+                self._set('retrying', error)
+                print(f"[TUNNEL] {error}, reconnecting")
+
+    def stop(self):
+        self.stopped = True
+        self._set('off')
+
+    def stats(self):
+        now = time.time()
+        return {
+            'state': self.state,
+            'up': int(self.state == 'up'),
+            'public_url': self.public_url,
+            'published': self.published,
+            'attempts': self.attempts,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'state_seconds': round(now - self.changed_at, 1),
+            'next_retry_in': round(max(0.0, self.next_retry_at - now), 1) if self.next_retry_at else None,
+            'ready_seconds': self.ready_seconds,
+        }
@@ -0,0 +1,359 @@
+"""
+用户存储层：内存哈希索引 + 可插拔的持久化后端。
+
+原来每次登录 / 注册 / Token 重连 / 头像查询都要完整解析一遍 users.csv，
+现在启动时加载一次，之后按 uid / username 做 O(1) 查找，
+写入只落单行 (SQLite UPDATE 或 CSV 追加)，不再整表重写。
+
+用法:
+    python user_store.py migrate [users.csv] [users.db]   # 一次性把旧 CSV 迁移到 SQLite
+"""
+import csv
+import os
+import random
+import sqlite3
+import string
+import sys
+import threading
+import time
+
+USER_FIELDS = ['uid', 'username', 'password', 'avatar']
+ADD_RETRIES = 20  # 注册时 uid 被其他进程抢先用掉的重试次数
+UID_DIGITS = 6
+UID_MAX_DIGITS = 12
+UID_ATTEMPTS = 8  # 每种位数随机尝试的次数，全部冲突说明该位数快用完了，加一位
+
+csv.field_size_limit(100 * 1024 * 1024)
+
+
+def allocate_uid(taken, digits=UID_DIGITS):
+    """
+    随机生成 uid，taken(uid) 为 True 表示已被占用。
+    先用 digits 位；连续 UID_ATTEMPTS 次冲突就加一位，用户数接近该位数的容量时也不会一直重试。
+    """
+    for width in range(digits, UID_MAX_DIGITS + 1):
+        for _ in range(UID_ATTEMPTS):
+            uid = ''.join(random.choices(string.digits, k=width))
+            if not taken(uid):
+                return uid
+    raise RuntimeError('uid space exhausted')
+
+
+# ==========================================
+#   持久化后端
+# ==========================================
+
+class CsvUserBackend:
+    """
+    追加写的 CSV 后端，兼容原来的 users.csv 格式。
+    修改资料时追加一整行新记录，加载时同一 uid 以最后一行为准；
+    compact() 用临时文件 + os.replace 原子地去掉旧版本行。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            with open(path, mode='w', newline='', encoding='utf-8') as f:
+                csv.writer(f).writerow(USER_FIELDS)
+
+    def load_all(self):
+        latest = {}
+        with open(self.path, mode='r', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                latest[row['uid']] = {k: row.get(k) or '' for k in USER_FIELDS}
+        return list(latest.values())
+
+    def _append(self, row):
+        with open(self.path, mode='a', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerow([row[k] for k in USER_FIELDS])
+
+    def insert(self, row):
+        self._append(row)
+
+    def update(self, row):
+        self._append(row)
+
+    def compact(self, rows):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, mode='w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=USER_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        pass
+
+
+class SqliteUserBackend:
+    """
+    SQLite 后端，每次注册 / 修改都是一条独立事务，单行原子更新。
+    uid 为主键、username 唯一，多个进程同时注册时由数据库拒绝重复，
+    insert / update 冲突时抛出 sqlite3.IntegrityError。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS users (uid TEXT PRIMARY KEY, username TEXT NOT NULL UNIQUE, '
+            'password TEXT NOT NULL, avatar TEXT NOT NULL DEFAULT "")'
+        )
+        self.lock = threading.Lock()
+        self._unique_usernames()
+
+    def _unique_usernames(self):
+        """
+        旧版本建的表没有 UNIQUE(username)，里面可能存在重名 (改名时未查重)。
+        重名用户中最早插入的保留原名 (原来按用户名登录匹配的就是它)，其余改名为 "用户名#uid"，
+        然后补上唯一索引。
+        """
+        with self.lock, self.conn:
+            renamed = self.conn.execute(
+                "UPDATE users SET username = username || '#' || uid WHERE rowid NOT IN "
+                "(SELECT MIN(rowid) FROM users GROUP BY username)"
+            ).rowcount
+            self.conn.execute('DROP INDEX IF EXISTS idx_users_username')
+            self.conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username_unique ON users(username)')
+        if renamed:
+            print(f"[USER STORE] Renamed {renamed} users with duplicate usernames to 'name#uid'")
+
+    def load_all(self):
+        with self.lock:
+            cur = self.conn.execute('SELECT uid, username, password, avatar FROM users')
+            return [dict(zip(USER_FIELDS, r)) for r in cur]
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def find(self, field, value):
+        """按 uid 或 username 查一行，用于多进程共享模式"""
+        if field not in ('uid', 'username'):
+            raise ValueError(field)
+        with self.lock:
+            r = self.conn.execute(
+                f'SELECT uid, username, password, avatar FROM users WHERE {field} = ?', (value,)
+            ).fetchone()
+        return dict(zip(USER_FIELDS, r)) if r else None
+
+    def insert(self, row):
+        self.insert_many([row])
+
+    def insert_many(self, rows):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT INTO users (uid, username, password, avatar) VALUES (?, ?, ?, ?)',
+                [tuple(r.get(k) or '' for k in USER_FIELDS) for r in rows]
+            )
+
+    def update(self, row):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'UPDATE users SET username = ?, password = ?, avatar = ? WHERE uid = ?',
+                (row['username'], row['password'], row['avatar'], row['uid'])
+            )
+
+    def compact(self, rows):
+        with self.lock:
+            self.conn.execute('VACUUM')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# ==========================================
+#   内存索引
+# ==========================================
+
+class UserRepository:
+    """
+    对外的用户仓库。所有读操作只走内存字典，写操作先落后端再更新索引。
+    返回的 row 都是副本，调用方随意修改不会污染索引。
+
+    shared=True 用于多个服务器进程共用同一个 SQLite 文件：其他进程随时可能注册或改名，
+    因此每次查找都直接查库 (走主键 / username 索引)，内存字典只作为结果的副本。
+    get_profile() 允许用 profile_ttl 秒内的副本 (Token 重连只需要用户名和头像)。
+    """
+
+    def __init__(self, backend, shared=False, profile_ttl=60.0):
+        if shared and not hasattr(backend, 'find'):
+            raise ValueError('shared mode requires the sqlite backend')
+        self.backend = backend
+        self.shared = shared
+        self.profile_ttl = profile_ttl
+        self.lock = threading.RLock()
+        self.by_uid = {}
+        self.by_username = {}
+        self.fetched = {}  # uid -> 从库里读到的时间 (仅 shared 模式)
+        now = time.monotonic()
+        for row in backend.load_all():
+            self._index(row)
+            self.fetched[row['uid']] = now
+
+    def _index(self, row):
+        old = self.by_uid.get(row['uid'])
+        if old and self.by_username.get(old['username']) is old:
+            del self.by_username[old['username']]
+        self.by_uid[row['uid']] = row
+        # 重名时保留先出现的用户，与原来 CSV 顺序扫描的匹配结果一致
+        self.by_username.setdefault(row['username'], row)
+
+    def __len__(self):
+        return len(self.by_uid)
+
+    def _lookup(self, field, value):
+        """返回内部 row (不是副本)"""
+        index = self.by_uid if field == 'uid' else self.by_username
+        if not self.shared:
+            return index.get(value)
+        row = self.backend.find(field, value)
+        if row:
+            with self.lock:
+                self._index(row)
+                self.fetched[row['uid']] = time.monotonic()
+        return row
+
+    def get_by_uid(self, uid):
+        row = self._lookup('uid', str(uid))
+        return dict(row) if row else None
+
+    def get_profile(self, uid):
+        """
+        同 get_by_uid，但 shared 模式下 profile_ttl 秒内读过的直接用内存副本，不查库。
+        其他进程的改名 / 换头像最多晚 profile_ttl 秒才看到；本进程的修改立即可见。
+        """
+        uid = str(uid)
+        if self.shared:
+            row = self.by_uid.get(uid)
+            if row and time.monotonic() - self.fetched.get(uid, 0) < self.profile_ttl:
+                return dict(row)
+        return self.get_by_uid(uid)
+
+    def get_by_username(self, username):
+        row = self._lookup('username', username)
+        return dict(row) if row else None
+
+    def check_login(self, login_input, password):
+        """用户名或 UID 均可登录，返回匹配的 row，失败返回 None"""
+        for row in (self._lookup('username', login_input), self._lookup('uid', login_input)):
+            if row and row['password'] == password:
+                return dict(row)
+        return None
+
+    def _new_uid(self):
+        return allocate_uid(lambda uid: self._lookup('uid', uid) is not None)
+
+    def add(self, username, password, avatar=''):
+        """
+        注册新用户，用户名已存在返回 (False, None)。
+        查重只是提前返回；其他进程可能同时注册同名用户或用掉同一个 uid，以数据库的唯一约束为准：
+        用户名冲突按已存在处理，uid 冲突换一个 uid 重试。
+        """
+        with self.lock:
+            if self._lookup('username', username) is not None:
+                return False, None
+            for _ in range(ADD_RETRIES):
+                row = {'uid': self._new_uid(), 'username': username, 'password': password, 'avatar': avatar}
+                try:
+                    self.backend.insert(row)
+                except sqlite3.IntegrityError as e:
+                    if 'username' in str(e):
+                        return False, None
+                    continue
+                self._index(row)
+                return True, row['uid']
+            raise RuntimeError('Could not allocate a free uid')
+
+    def update(self, uid, **fields):
+        """
+        单行更新 username / password / avatar。
+        新用户名被其他人占用时抛出 ValueError，不做任何修改。
+        """
+        with self.lock:
+            current = self._lookup('uid', str(uid))
+            if current is None:
+                return None
+            new_name = fields.get('username')
+            if new_name and new_name != current['username']:
+                holder = self._lookup('username', new_name)
+                if holder is not None and holder['uid'] != current['uid']:
+                    raise ValueError('Username taken')
+            row = dict(current)
+            row.update({k: v for k, v in fields.items() if k in USER_FIELDS and k != 'uid' and v is not None})
+            try:
+                self.backend.update(row)
+            except sqlite3.IntegrityError:
+                raise ValueError('Username taken')  # 其他进程刚改成 / 注册了这个名字
+            self._index(row)
+            return dict(row)
+
+    def all(self):
+        """全部用户；shared 模式下内存字典只有本进程查过的用户，因此直接读库"""
+        if self.shared:
+            return self.backend.load_all()
+        return [dict(r) for r in self.by_uid.values()]
+
+    def compact(self):
+        with self.lock:
+            self.backend.compact(list(self.by_uid.values()))
+
+    def close(self):
+        self.backend.close()
+
+
+# ==========================================
+#   迁移与工厂
+# ==========================================
+
+def migrate_csv_to_sqlite(csv_path, db_path):
+    """
+    一次性把 users.csv 导入 SQLite。目标库已有数据时不做任何事，返回导入的行数。
+    CSV 中同一 uid 出现多次时以最后一行为准；重名用户除第一个外改名为 "用户名#uid"
+    (与 SqliteUserBackend 处理旧表的方式相同)。
+    """
+    backend = SqliteUserBackend(db_path)
+    try:
+        if backend.count() > 0 or not os.path.exists(csv_path):
+            return 0
+        rows = CsvUserBackend(csv_path).load_all()
+        seen = set()
+        for row in rows:
+            if row['username'] in seen:
+                print(f"[USER STORE] Duplicate username {row['username']!r}, renamed uid {row['uid']}")
+                row['username'] = f"{row['username']}#{row['uid']}"
+            seen.add(row['username'])
+        backend.insert_many(rows)
+        return len(rows)
+    finally:
+        backend.close()
+
+
+def open_repository(kind, csv_path, db_path, shared=False):
+    """
+    kind: 'sqlite' (默认) 或 'csv'。
+    使用 SQLite 但数据库还不存在时，会自动从 csv_path 迁移一次。
+    shared=True 表示多个进程共用 db_path (只支持 SQLite)。
+    """
+    if kind == 'csv':
+        if shared:
+            raise ValueError('The csv user store cannot be shared between processes, use sqlite')
+        return UserRepository(CsvUserBackend(csv_path))
+    if kind != 'sqlite':
+        raise ValueError(f"Unknown user store backend: {kind}")
+    if not os.path.exists(db_path) and os.path.exists(csv_path):
+        n = migrate_csv_to_sqlite(csv_path, db_path)
+        print(f"[USER STORE] Migrated {n} users from {csv_path} to {db_path}")
+    return UserRepository(SqliteUserBackend(db_path), shared=shared)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'migrate':
+        src = sys.argv[2] if len(sys.argv) > 2 else 'users.csv'
+        dst = sys.argv[3] if len(sys.argv) > 3 else 'users.db'
+        print(f"Migrated {migrate_csv_to_sqlite(src, dst)} users from {src} to {dst}")
+    else:
+        print(__doc__)
@@ -0,0 +1,268 @@
+"""
+聊天事件的紧凑编码 (连接时协商，可选)。
+
+默认的 JSON 里每条消息都重复带着 'sender' / 'uid' / 'content' ... 这些键，
+history_loaded 一次几百条，键名占了相当一部分流量；Socket.IO 的 JSON 还会把中文转成 \\uXXXX (6 字节)。
+
+    json     原样发送 (管理页、浏览器、旧客户端)
+    compact  按位置编码的列表，仍走 JSON 文本帧，不需要额外依赖
+    msgpack  同样的位置编码再用 MessagePack 打包成二进制帧 (pip install msgpack)
+
+位置编码：
+    消息   [sender, uid, content, type, timestamp, temp_id, target_uid, thumb (, {其它字段})]
+           timestamp 转成整数秒，末尾的 None 省略 (解码后没有这些键；中间位置的缺失与 None 不区分)，
+           附加字典紧跟在最后一个字段之后
+    历史页 (以及离线消息 receive_messages) messages 换成 {'s': 字符串表, 'r': 行}，行内 sender / uid / type / target_uid 为字符串表下标，
+           timestamp 为与上一行的差值 (第一行为绝对值)
+    用户   [uid, username, avatar (, {其它字段})]
+
+客户端连接时带 auth={'wire': 'msgpack'}；服务器不支持时退回 compact / json。
+decode() 按数据形状判断编码，收到普通 JSON 也能正常处理。
+"""
+import calendar
+import time
+
+try:
+    import msgpack
+except ImportError:  # 可选依赖
+    msgpack = None
+
+FORMATS = ('json', 'compact', 'msgpack')
+MESSAGE_FIELDS = ('sender', 'uid', 'content', 'type', 'timestamp', 'temp_id', 'target_uid', 'thumb')
+USER_FIELDS = ('uid', 'username', 'avatar')
+INTERNED_FIELDS = frozenset(('sender', 'uid', 'type', 'target_uid'))
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+_TS_INDEX = MESSAGE_FIELDS.index('timestamp')
+
+
+def available_formats():
+    return FORMATS if msgpack is not None else FORMATS[:2]
+
+
+def negotiate(requested):
+    """客户端请求的编码 -> 实际使用的编码"""
+    if requested == 'msgpack' and msgpack is None:
+        return 'compact'
+    return requested if requested in FORMATS else 'json'
+
+
+# ==========================================
+#   时间戳与单行
+# ==========================================
+
+# 日期部分的换算结果缓存起来，一页历史通常只跨一两天 (strptime 比拆字符串慢一个数量级)
+_day_seconds = {}
+_day_strings = {}
+
+
+def _ts_to_int(ts):
+    """'2024-01-02 03:04:05' -> 整数秒 (按 UTC 换算，只为了能原样还原)；格式不符时返回原值"""
+    if not (isinstance(ts, str) and len(ts) == 19 and ts[10] == ' ' and ts[13] == ':' and ts[16] == ':'):
+        return ts
+    day = _day_seconds.get(ts[:10])
+    if day is None:
+        try:
+            day = calendar.timegm(time.strptime(ts[:10], "%Y-%m-%d"))
+        except ValueError:
+            return ts
+        if time.strftime("%Y-%m-%d", time.gmtime(day)) != ts[:10]:
+            return ts
+        if len(_day_seconds) > 4096:
+            _day_seconds.clear()
+        _day_seconds[ts[:10]] = day
+    hms = ts[11:13] + ts[14:16] + ts[17:19]
+    if not (hms.isascii() and hms.isdigit()):
+        return ts
+    h, m, s = int(hms[:2]), int(hms[2:4]), int(hms[4:])
+    if h > 23 or m > 59 or s > 59:
+        return ts
+    return day + h * 3600 + m * 60 + s
+
+
+def _int_to_ts(value):
+    if not isinstance(value, int):
+        return value
+    day, rest = divmod(value, 86400)
+    date = _day_strings.get(day)
+    if date is None:
+        if len(_day_strings) > 4096:
+            _day_strings.clear()
+        date = _day_strings[day] = time.strftime("%Y-%m-%d", time.gmtime(day * 86400))
+    return f"{date} {rest // 3600:02d}:{rest // 60 % 60:02d}:{rest % 60:02d}"
+
+
+def _extras(obj, fields, row):
+    """
+    不在 fields 里的键，以及会和编码后的形式混淆的值 (数字类型的 uid / timestamp，
+    以及会被当成附加字典的 dict 值)，原样放进附加字典
+    """
+    extras = {k: v for k, v in obj.items() if k not in fields}
+    for i, f in enumerate(fields):
+        value = row[i]
+        if isinstance(value, dict) or \
+                (f in INTERNED_FIELDS or f == 'timestamp') and value is not None and not isinstance(value, str):
+            extras[f] = value
+            row[i] = None
+    return extras
+
+
+def _finish_row(row, extras):
+    """末尾的 None 省略，附加字典 (如果有) 放在最后"""
+    while row and row[-1] is None:
+        row.pop()
+    if extras:
+        row.append(extras)
+    return row
+
+
+def _split_row(row):
+    """-> (字段值, 附加字典或 None)"""
+    if row and isinstance(row[-1], dict):
+        return list(row[:-1]), row[-1]
+    return list(row), None
+
+
+def _to_row(obj, fields, convert=None):
+    row = [obj.get(f) for f in fields]
+    extras = _extras(obj, fields, row)
+    if convert:
+        convert(row)
+    return _finish_row(row, extras)
+
+
+def _from_row(row, fields, convert=None):
+    values, extras = _split_row(row)
+    values = values[:len(fields)]
+    if convert:
+        convert(values)
+    obj = dict(zip(fields, values))  # 省略的末尾字段不补 None，与 JSON 编码时的键保持一致
+    if extras:
+        obj.update(extras)
+    return obj
+
+
+def _ts_out(row):
+    row[_TS_INDEX] = _ts_to_int(row[_TS_INDEX])
+
+
+def _ts_in(row):
+    if len(row) > _TS_INDEX:
+        row[_TS_INDEX] = _int_to_ts(row[_TS_INDEX])
+
+
+def encode_message(msg):
+    return _to_row(msg, MESSAGE_FIELDS, _ts_out)
+
+
+def decode_message(row):
+    return row if isinstance(row, dict) else _from_row(row, MESSAGE_FIELDS, _ts_in)
+
+
+def encode_user(user):
+    return _to_row(user, USER_FIELDS)
+
+
+def decode_user(row):
+    return row if isinstance(row, dict) else _from_row(row, USER_FIELDS)
+
+
+# ==========================================
+#   历史页 (字符串表 + 时间戳差值)
+# ==========================================
+
+def encode_messages(messages):
+    table, index, rows = [], {}, []
+    prev_ts = 0
+    for msg in messages:
+        row = [msg.get(f) for f in MESSAGE_FIELDS]
+        extras = _extras(msg, MESSAGE_FIELDS, row)
+        for i, f in enumerate(MESSAGE_FIELDS):
+            value = row[i]
+            if f in INTERNED_FIELDS and isinstance(value, str):
+                slot = index.get(value)
+                if slot is None:
+                    slot = index[value] = len(table)
+                    table.append(value)
+                row[i] = slot
+        ts = _ts_to_int(row[_TS_INDEX])
+        if isinstance(ts, int):
+            row[_TS_INDEX], prev_ts = ts - prev_ts, ts
+        rows.append(_finish_row(row, extras))
+    return {'s': table, 'r': rows}
+
+
+def decode_messages(page):
+    table, out = page['s'], []
+    prev_ts = 0
+    for row in page['r']:
+        values, extras = _split_row(row)
+        for i, f in enumerate(MESSAGE_FIELDS[:len(values)]):
+            if f in INTERNED_FIELDS and isinstance(values[i], int):
+                values[i] = table[values[i]]
+        if len(values) > _TS_INDEX and isinstance(values[_TS_INDEX], int):
+            prev_ts += values[_TS_INDEX]
+            values[_TS_INDEX] = _int_to_ts(prev_ts)
+        out.append(_from_row(values + [extras] if extras else values, MESSAGE_FIELDS))
+    return out
+
+
+# ==========================================
+#   按事件编码 / 解码
+# ==========================================
+
+def _encode_presence(data):
+    out = dict(data)
+    for key in ('users', 'joins', 'updates'):
+        if key in out:
+            out[key] = [encode_user(u) for u in out[key]]
+    return out
+
+
+def _decode_presence(data):
+    out = dict(data)
+    for key in ('users', 'joins', 'updates'):
+        if key in out:
+            out[key] = [decode_user(u) for u in out[key]]
+    return out
+
+
+def _encode_history(data):
+    out = {k: v for k, v in data.items() if k != 'messages'}
+    out['m'] = encode_messages(data.get('messages', []))
+    return out
+
+
+def _decode_history(data):
+    if 'm' not in data or 'messages' in data:
+        return data
+    out = {k: v for k, v in data.items() if k != 'm'}
+    out['messages'] = decode_messages(data['m'])
+    return out
+
+
+ENCODERS = {
+    'receive_message': (encode_message, decode_message),
+    'history_loaded': (_encode_history, _decode_history),
+    'receive_messages': (_encode_history, _decode_history),
+    'presence_snapshot': (_encode_presence, _decode_presence),
+    'presence_delta': (_encode_presence, _decode_presence),
+}
+
+
+def encode(event, data, fmt):
+    """按 fmt 编码 event 的数据；不在 ENCODERS 中的事件与 json 格式原样返回"""
+    codec = ENCODERS.get(event)
+    if fmt == 'json' or codec is None:
+        return data
+    packed = codec[0](data)
+    if fmt == 'msgpack':
+        return msgpack.packb(packed, use_bin_type=True)
+    return packed
+
+
+def decode(event, data):
+    """接收端：二进制先用 msgpack 解包，再按形状还原成与 JSON 格式相同的字典"""
+    if isinstance(data, (bytes, bytearray)):
+        data = msgpack.unpackb(data, raw=False)
+    codec = ENCODERS.get(event)
+    return codec[1](data) if codec else data